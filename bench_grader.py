@@ -0,0 +1,401 @@
+#!/usr/bin/env python3.6
+"""
+Benchmarks for PyCanvasGrader
+
+Every scenario runs offline, against synthetic submissions and the mock Canvas server
+in lib/canvas_api/mock_canvas.py, and is seeded so that runs are comparable.
+Results are printed as JSON; save them and pass them to --compare on a later run.
+
+Usage:
+    python bench_grader.py [--scenario=<name> ...] [--quick] [--compare=<old results>]
+
+Scenarios:
+    run_and_match  - AssignmentTest.run_and_match on large string and numeric outputs
+    many_tests     - TestSkeleton.run_tests with many tiny tests
+    state          - save_state/load_state with a large .temp tree
+    session        - a full download, grade and submit session against the mock Canvas
+"""
+# built-ins
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from typing import Callable, Dict, List
+
+# package-specific
+from lib.canvas_api import PyCanvasGrader, TestSkeleton, User
+from lib.canvas_api.mock_canvas import SYNTHETIC_SKELETON, MockCanvas, generate_course
+from lib.canvas_api.testing import AssignmentTest
+from lib.core.checkpoint import Checkpoint
+
+import pycanvasgrader
+
+# Submissions that never hang, so that session timings measure the grader, not timeouts
+BENCH_KINDS = {"correct": 0.8, "wrong": 0.1, "crash": 0.1}
+
+
+def timed(function: Callable, repeat: int) -> List[float]:
+    """
+    :return: The wall time of each of repeat calls to function
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    return {
+        "median_s": round(statistics.median(times), 6),
+        "min_s": round(min(times), 6),
+        "max_s": round(max(times), 6),
+        "runs": len(times),
+    }
+
+
+def bench_user(user_id: int = 1) -> User:
+    return User(user_id, user_id, f"Bench {user_id}", None, None, True, 1)
+
+
+def run_and_match(work_dir: str, quick: bool, repeat: int) -> dict:
+    output_mb = 2 if quick else 16
+    numbers = 20000 if quick else 200000
+    size = output_mb * 1024 * 1024
+    results = {}
+
+    string_test = AssignmentTest(
+        command="python3",
+        args=["-c", f"import sys; sys.stdout.write('x' * {size} + '\\nDONE\\n')"],
+        output_match="DONE",
+        print_output=False,
+    )
+    times = timed(
+        lambda: string_test.run_and_match(bench_user(), work_dir, False), repeat
+    )
+    results["string_match"] = {
+        **summarize(times),
+        "output_mb": output_mb,
+        "mb_per_s": round(output_mb / statistics.median(times), 2),
+    }
+
+    # Every other number printed is expected, half of them as tolerance ranges
+    expected = [
+        i if i % 4 else f"{i} +- 0.5" for i in range(0, min(numbers, 2000), 2)
+    ]
+    numeric_test = AssignmentTest(
+        command="python3",
+        args=["-c", f"print(' '.join(str(i) for i in range({numbers})))"],
+        numeric_match=expected,
+        print_output=False,
+    )
+    matched = []
+    times = timed(
+        lambda: matched.append(
+            numeric_test.run_and_match(bench_user(), work_dir, False)
+        ),
+        repeat,
+    )
+    results["numeric_match"] = {
+        **summarize(times),
+        "numbers": numbers,
+        "expected_values": len(expected),
+        "numbers_per_s": round(numbers / statistics.median(times)),
+        "matched": all(matched),
+    }
+    return results
+
+
+def many_tests(work_dir: str, quick: bool, repeat: int) -> dict:
+    count = 50 if quick else 300
+    skeleton = TestSkeleton(
+        "many tests",
+        [
+            AssignmentTest(
+                command="echo",
+                args=[str(i)],
+                output_match=str(i),
+                point_val=1,
+                name=f"test {i}",
+            )
+            for i in range(count)
+        ],
+    )
+    os.makedirs(os.path.join(work_dir, "1"), exist_ok=True)
+    scores = []
+    times = timed(
+        lambda: scores.append(skeleton.run_tests(bench_user(), False, work_dir)), repeat
+    )
+    return {
+        **summarize(times),
+        "tests": count,
+        "tests_per_s": round(count / statistics.median(times), 1),
+        "score": scores[-1],
+    }
+
+
+def synthetic_skeleton() -> TestSkeleton:
+    """
+    The skeleton that grades mock Canvas submissions
+    """
+    return TestSkeleton.from_json(
+        {
+            "descriptor": SYNTHETIC_SKELETON["descriptor"],
+            "disarm": False,
+            "file_path": "",
+            "tests": [
+                {**SYNTHETIC_SKELETON["default"], **test, "name": name}
+                for name, test in SYNTHETIC_SKELETON["tests"].items()
+            ],
+        }
+    )
+
+
+def make_grader(api_url: str = "http://127.0.0.1:9/api/v1") -> PyCanvasGrader:
+    os.environ.setdefault("CANVAS_ACCESS_TOKEN", "bench")
+    return PyCanvasGrader(api_url=api_url)
+
+
+def state(work_dir: str, quick: bool, repeat: int) -> dict:
+    user_count = 100 if quick else 1000
+    files_per_user = 5
+    file_kb = 16
+    grader = make_grader()
+    grader.course_id, grader.assignment_id = 1, 1
+
+    users = []
+    payload = os.urandom(file_kb * 1024)
+    for user_id in range(1, user_count + 1):
+        user_dir = os.path.join(grader.temp_dir, str(user_id))
+        os.makedirs(user_dir, exist_ok=True)
+        for n in range(files_per_user):
+            with open(os.path.join(user_dir, f"file{n}.py"), "wb") as f:
+                f.write(payload)
+        user = bench_user(user_id)
+        user.grade = user_id % 11
+        user.log.write("--Running test 1--\n" + "output line\n" * 300)
+        user.test_times = {"compile": 0.5, "run": 1.25}
+        users.append(user)
+    skeleton = synthetic_skeleton()
+    tree_mb = user_count * files_per_user * file_kb / 1024
+
+    save_times = timed(
+        lambda: pycanvasgrader.save_state(grader, skeleton, users), repeat
+    )
+    load_times = timed(lambda: pycanvasgrader.load_state(1, 1), repeat)
+    os.chdir(os.environ["INSTALL_DIR"])
+
+    # What autosave costs after a few users are graded
+    checkpoint = Checkpoint(grader.cache_file, grader, skeleton, users)
+    checkpoint.snapshot()
+
+    def grade_five():
+        for user in users[:5]:
+            user.grade = (user.grade + 1) % 11
+        checkpoint.save()
+
+    checkpoint_times = timed(grade_five, repeat)
+    return {
+        "users": user_count,
+        "tree_mb": round(tree_mb, 1),
+        "save": {
+            **summarize(save_times),
+            "mb_per_s": round(tree_mb / statistics.median(save_times), 1),
+        },
+        "load": {
+            **summarize(load_times),
+            "mb_per_s": round(tree_mb / statistics.median(load_times), 1),
+        },
+        "checkpoint_5_users": summarize(checkpoint_times),
+    }
+
+
+def session(work_dir: str, quick: bool, repeat: int) -> dict:
+    students = 100 if quick else 1000
+    workers = 4
+    course = generate_course(students=students, seed=2018, graded=0, kinds=BENCH_KINDS)
+    canvas = MockCanvas([course])
+    api_url = canvas.serve()
+    skeleton = synthetic_skeleton()
+    runs = []
+    try:
+        for _ in range(repeat):
+            shutil.rmtree(os.path.join(os.environ["INSTALL_DIR"], ".temp"), True)
+            grader = make_grader(api_url)
+            grader.course_id = course.course["id"]
+            grader.assignment_id = course.assignments[0]["id"]
+            tracemalloc.start()
+            try:
+                started = time.perf_counter()
+                users, _, failed = pycanvasgrader.download_submissions(
+                    grader, False, workers * 2
+                )
+                downloaded = time.perf_counter()
+                pycanvasgrader.grade_all_submissions(
+                    skeleton, users, workers=workers, interactive=False
+                )
+                graded = time.perf_counter()
+                pycanvasgrader.submit_all_grades(grader, users)
+                submitted = time.perf_counter()
+                memory, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            grader.close()
+
+            downloaded_bytes = sum(
+                attachment["size"]
+                for submission in course.submissions[grader.assignment_id].values()
+                if submission["attachments"]
+                for attachment in submission["attachments"]
+            )
+            runs.append(
+                {
+                    "users": len(users),
+                    "failed_downloads": failed,
+                    "download_s": downloaded - started,
+                    "download_mb_per_s": downloaded_bytes
+                    / 1024 ** 2
+                    / (downloaded - started),
+                    "grade_s": graded - downloaded,
+                    "grades_per_s": len(users) / (graded - downloaded),
+                    "submit_s": submitted - graded,
+                    "total_s": submitted - started,
+                    "memory_kb_per_user": memory / 1024 / max(len(users), 1),
+                    "peak_memory_mb": peak / 1024 ** 2,
+                }
+            )
+    finally:
+        canvas.stop()
+
+    def median(key: str) -> float:
+        return round(statistics.median(run[key] for run in runs), 3)
+
+    return {
+        "students": students,
+        "workers": workers,
+        "runs": len(runs),
+        "api_requests": canvas.requests,
+        **{key: median(key) for key in runs[0] if key not in ("users",)},
+        "users": runs[-1]["users"],
+    }
+
+
+SCENARIOS = {
+    "run_and_match": run_and_match,
+    "many_tests": many_tests,
+    "state": state,
+    "session": session,
+}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            encoding="UTF-8",
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def flatten(results: dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old: dict, new: dict) -> str:
+    """
+    :return: A table of every metric in both runs, with the change from old to new
+    """
+    old_flat = flatten(old["scenarios"])
+    new_flat = flatten(new["scenarios"])
+    lines = [f"{'metric':<48}{'old':>14}{'new':>14}{'change':>9}"]
+    for key in sorted(set(old_flat) & set(new_flat)):
+        before, after = old_flat[key], new_flat[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "-"
+        lines.append(f"{key:<48}{before:>14}{after:>14}{change:>9}")
+    return "\n".join(lines)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark PyCanvasGrader")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="A scenario to run; repeat to run several (default: all)",
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="Use smaller inputs, for a fast smoke test"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="How many times to run each measurement"
+    )
+    parser.add_argument(
+        "--output", metavar="FILE", help="Write the results to FILE instead of stdout"
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="FILE",
+        help="Print how these results differ from earlier results in FILE",
+    )
+    args = parser.parse_args(argv)
+
+    results = {
+        "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "quick": args.quick,
+        "scenarios": {},
+    }
+
+    original_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="pycanvasgrader-bench-")
+    os.environ["INSTALL_DIR"] = work_dir
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            os.chdir(work_dir)
+            print(f"Running {name}...", file=sys.stderr)
+            # The grader's progress output goes to stderr, keeping stdout for results
+            with redirect_stdout(sys.stderr):
+                results["scenarios"][name] = SCENARIOS[name](
+                    work_dir, args.quick, max(args.repeat, 1)
+                )
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    encoded = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    else:
+        print(encoded)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
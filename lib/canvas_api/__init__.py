@@ -1,2 +1,3 @@
+from .async_canvas_api import AsyncPyCanvasGrader
 from .canvas_api import Enrollment, PyCanvasGrader, User
 from .testing import TestSkeleton
@@ -0,0 +1,239 @@
+"""
+Extraction of .zip and .tar submissions, right after they are downloaded.
+
+Members are streamed from the archive on disk to their files in fixed-size chunks, so an
+archive is never held in memory. Members that would land outside the submission's
+directory (absolute paths, "..", drive letters), links and device files are refused, and
+extraction stops once an archive has unpacked more than MAX_BYTES or MAX_FILES.
+
+The archive itself is moved out of the submission's directory into .archives/<user id>,
+along with a manifest of each archive's SHA-256 and what it unpacked to. When the same
+archive is downloaded again, the files unpacked last time are reused instead.
+"""
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tarfile
+import zipfile
+from typing import Dict, IO, List, Optional
+
+# The most an archive may unpack to, in bytes and in files
+MAX_BYTES = 256 * 1024 * 1024
+MAX_FILES = 10000
+CHUNK_SIZE = 1024 * 1024
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz")
+MANIFEST_FILE = "manifest.json"
+# Metadata that archivers add, which no test wants
+IGNORED = ("__MACOSX", ".DS_Store")
+
+
+class ArchiveError(ValueError):
+    """
+    An archive that cannot be, or must not be, extracted
+    """
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def archive_store(user_dir: str) -> str:
+    """
+    :return: The directory that keeps a submission's archives and their manifest
+    """
+    parent, user = os.path.split(os.path.abspath(user_dir))
+    return os.path.join(parent, ".archives", user)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def member_path(destination: str, name: str) -> Optional[str]:
+    """
+    :return: Where a member named name is extracted to, or None if it is skipped
+    :raises ArchiveError: If the member would be extracted outside destination
+    """
+    parts = name.replace("\\", "/").split("/")
+    if (
+        name.startswith(("/", "\\"))
+        or ".." in parts
+        or (parts[0][1:2] == ":" and parts[0][:1].isalpha())
+    ):
+        raise ArchiveError(f'Unsafe path "{name}"')
+    parts = [part for part in parts if part not in ("", ".")]
+    if not parts or parts[0] in IGNORED or parts[-1] in IGNORED:
+        return None
+    path = os.path.join(destination, *parts)
+    if not os.path.abspath(path).startswith(os.path.abspath(destination) + os.sep):
+        raise ArchiveError(f'Unsafe path "{name}"')
+    return path
+
+
+class _Budget:
+    """
+    Counts what an archive has unpacked, and stops it at MAX_BYTES or MAX_FILES
+    """
+
+    def __init__(self, max_bytes: int, max_files: int):
+        self.bytes_left = max_bytes
+        self.files_left = max_files
+
+    def copy(self, source: IO[bytes], path: str):
+        self.files_left -= 1
+        if self.files_left < 0:
+            raise ArchiveError("Too many files")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as target:
+            # Sizes recorded in the archive can lie, so the bytes written are counted
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                self.bytes_left -= len(chunk)
+                if self.bytes_left < 0:
+                    raise ArchiveError("Unpacks to too much data")
+                target.write(chunk)
+
+
+def extract(
+    archive: str,
+    destination: str,
+    max_bytes: int = MAX_BYTES,
+    max_files: int = MAX_FILES,
+):
+    """
+    Extract an archive's regular files and directories into destination
+    :raises ArchiveError: If the archive is invalid, unsafe or too large. Some members
+    may have been extracted already
+    """
+    budget = _Budget(max_bytes, max_files)
+    os.makedirs(destination, exist_ok=True)
+    try:
+        if archive.lower().endswith(".zip"):
+            with zipfile.ZipFile(archive) as zip_file:
+                for member in zip_file.infolist():
+                    path = member_path(destination, member.filename)
+                    mode = member.external_attr >> 16
+                    if path is None or stat.S_ISLNK(mode):
+                        continue
+                    if member.is_dir():
+                        os.makedirs(path, exist_ok=True)
+                        continue
+                    with zip_file.open(member) as source:
+                        budget.copy(source, path)
+        else:
+            # "r|*" reads the archive front to back, without seeking
+            with tarfile.open(archive, "r|*") as tar_file:
+                for member in tar_file:
+                    path = member_path(destination, member.name)
+                    if path is None:
+                        continue
+                    if member.isdir():
+                        os.makedirs(path, exist_ok=True)
+                    elif member.isfile():
+                        budget.copy(tar_file.extractfile(member), path)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        raise ArchiveError(f"Unreadable archive: {e}") from e
+
+
+def _read_manifest(store: str) -> Dict[str, dict]:
+    try:
+        with open(os.path.join(store, MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def unpack_download(user_dir: str) -> List[str]:
+    """
+    Extract the archives in a finished download (user_dir/.new), before it replaces
+    user_dir (see utils.promote_download).
+    An archive whose SHA-256 matches the manifest reuses the files in user_dir that it
+    unpacked to last time. If an archive contains a single directory, that directory's
+    contents are used. An archive that cannot be extracted is left as it is
+    :return: A message for each archive that could not be extracted
+    """
+    new_dir = os.path.join(user_dir, ".new")
+    store = archive_store(user_dir)
+    old_manifest = _read_manifest(store)
+    manifest = {}
+    problems = []
+
+    for filename in sorted(os.listdir(new_dir)):
+        archive = os.path.join(new_dir, filename)
+        if not is_archive(filename) or not os.path.isfile(archive):
+            continue
+        digest = file_digest(archive)
+        previous = old_manifest.get(filename)
+        if (
+            previous is not None
+            and previous["sha256"] == digest
+            and _reuse(previous["entries"], user_dir, new_dir)
+        ):
+            entries = previous["entries"]
+        else:
+            try:
+                entries = _unpack(archive, new_dir)
+            except ArchiveError as e:
+                problems.append(f"Could not extract {filename}: {e}")
+                continue
+
+        os.makedirs(store, exist_ok=True)
+        os.replace(archive, os.path.join(store, filename))
+        manifest[filename] = {"sha256": digest, "entries": entries}
+
+    if manifest or old_manifest:
+        os.makedirs(store, exist_ok=True)
+        for filename in set(old_manifest) - set(manifest):
+            try:
+                os.remove(os.path.join(store, filename))
+            except OSError:
+                pass
+        with open(os.path.join(store, MANIFEST_FILE), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+    return problems
+
+
+def _reuse(entries: List[str], user_dir: str, new_dir: str) -> bool:
+    """
+    Move the files an archive unpacked to last time into the new download
+    :return: Whether they were all still there
+    """
+    if not all(os.path.exists(os.path.join(user_dir, entry)) for entry in entries):
+        return False
+    if any(os.path.exists(os.path.join(new_dir, entry)) for entry in entries):
+        return False
+    for entry in entries:
+        os.replace(os.path.join(user_dir, entry), os.path.join(new_dir, entry))
+    return True
+
+
+def _unpack(archive: str, new_dir: str) -> List[str]:
+    """
+    Extract an archive beside it, without replacing any file already in new_dir
+    :return: The top-level files and directories it unpacked to
+    """
+    staging = os.path.join(new_dir, ".extracting")
+    shutil.rmtree(staging, ignore_errors=True)
+    try:
+        extract(archive, staging)
+        root = staging
+        top_level = os.listdir(staging)
+        if len(top_level) == 1 and os.path.isdir(os.path.join(staging, top_level[0])):
+            root = os.path.join(staging, top_level[0])
+            top_level = os.listdir(root)
+        clashes = [
+            entry for entry in top_level if os.path.exists(os.path.join(new_dir, entry))
+        ]
+        if clashes:
+            raise ArchiveError("It would replace " + ", ".join(sorted(clashes)))
+        for entry in top_level:
+            os.replace(os.path.join(root, entry), os.path.join(new_dir, entry))
+        return sorted(top_level)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
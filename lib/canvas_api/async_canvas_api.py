@@ -0,0 +1,378 @@
+import asyncio
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import aiohttp
+import attr
+
+from lib.core import instrument
+
+from . import archives, utils
+from .canvas_api import (
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_RETRIES,
+    CanvasSession,
+    DownloadError,
+    Enrollment,
+    PyCanvasGrader,
+    default_api_url,
+)
+
+# Python 3.6 has no get_running_loop; there, get_event_loop returns the running loop
+_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class AsyncPyCanvasGrader:
+    """
+    An asyncio counterpart to PyCanvasGrader; exposes the same methods as coroutines.
+
+    All requests share one pooled aiohttp session. At most max_connections sockets are
+    open at once, and at most max_in_flight requests are outstanding, so callers can
+    fan out with asyncio.gather without overwhelming Canvas.
+
+    :param max_connections: The size of the connection pool
+    :param max_in_flight: The maximum number of concurrent requests
+    :param workspace: Where submissions are downloaded to. Default: INSTALL_DIR/.temp
+    :param api_url: The base URL of the Canvas API
+    :param extract_archives: Whether to unpack .zip and .tar attachments after downloading them
+    """
+
+    course_id: int = -1
+    assignment_id: int = -1
+    max_connections: int = 64
+    max_in_flight: int = 256
+    workspace: Optional[str] = attr.ib(default=None, repr=False)
+    api_url: str = attr.ib(default=attr.Factory(default_api_url), repr=False)
+    extract_archives: bool = attr.ib(default=True, repr=False)
+
+    token: str = attr.ib(init=False, repr=False)
+    session: Optional[aiohttp.ClientSession] = attr.ib(
+        default=None, init=False, repr=False
+    )
+    semaphore: Optional[asyncio.Semaphore] = attr.ib(
+        default=None, init=False, repr=False
+    )
+
+    def __attrs_post_init__(self):
+        self.token = PyCanvasGrader.authenticate()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _session(self) -> aiohttp.ClientSession:
+        # aiohttp sessions must be created inside a running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Authorization": "Bearer " + self.token},
+            )
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self.session
+
+    @property
+    def temp_dir(self) -> str:
+        """
+        The directory that holds one subdirectory of files per downloaded submission
+        """
+        return self.workspace or os.path.join(os.environ["INSTALL_DIR"], ".temp")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    @staticmethod
+    async def _send(
+        session: aiohttp.ClientSession, method: str, url: str, **kwargs
+    ) -> aiohttp.ClientResponse:
+        """
+        Send a request, and back off and retry like CanvasSession while Canvas reports
+        that it is throttling the token. Waiting with the semaphore held slows every
+        request down, which is what the throttling asks for
+        :return: The response, which the caller must release
+        """
+        for attempt in range(CanvasSession.throttle_retries + 1):
+            response = await session.request(method, url, **kwargs)
+            if (
+                response.status != 403
+                or "Rate Limit Exceeded" not in await response.text()
+            ):
+                break
+            response.release()
+            instrument.event(
+                "api_throttled", url=url, attempt=attempt + 1, wait=2 ** attempt
+            )
+            await asyncio.sleep(2 ** attempt)
+        return response
+
+    async def _request_json(self, method: str, url: str, **kwargs):
+        """
+        Perform a request and decode the JSON body
+        :return: (The decoded body, the URL of the next page or None)
+        """
+        session = self._session()
+        async with self.semaphore:
+            async with await self._send(session, method, url, **kwargs) as response:
+                body = await response.json(content_type=None)
+                next_link = response.links.get("next")
+                return body, str(next_link["url"]) if next_link else None
+
+    async def _listing(self, url: str) -> list:
+        """
+        Follow the pagination links of a listing
+        :param url: The URL of the first page
+        :return: Every item of every page
+        """
+        items = []
+        while url:
+            body, url = await self._request_json("GET", url)
+            items.extend(body)
+        return items
+
+    async def courses(self, enrollment_type: Enrollment = None) -> list:
+        """
+        :param enrollment_type: (Optional) teacher, student, ta, observer, designer
+        :return: A list of the user's courses as dictionaries, optionally filtered by enrollment_type
+        """
+        url = f"{self.api_url}/courses?per_page=100"
+        if enrollment_type is not None:
+            url += "&enrollment_type=" + enrollment_type.name.lower()
+
+        return await self._listing(url)
+
+    async def assignments(self, ungraded: bool = True) -> list:
+        """
+        :param ungraded: Whether to filter assignments by only those that have ungraded work. Default: True
+        :return: A list of the course's assignments
+        """
+        url = f"{self.api_url}/courses/{self.course_id}/assignments?per_page=100"
+        if ungraded:
+            url += "&bucket=ungraded"
+
+        return await self._listing(url)
+
+    async def submissions(self) -> list:
+        """
+        :return: A list of the assignment's submissions
+        """
+        url = (
+            f"{self.api_url}/courses/{self.course_id}"
+            f"/assignments/{self.assignment_id}/submissions?per_page=100"
+        )
+
+        return await self._listing(url)
+
+    async def submission(self, user_id: int) -> dict:
+        """
+        Get information about a single submission
+        :param user_id: The user ID of the user whose submission is to be requested
+        :return: A dictionary which represents the submission object
+        """
+        url = (
+            f"{self.api_url}/courses/"
+            f"{self.course_id}/assignments/{self.assignment_id}/submissions/{user_id}"
+        )
+
+        body, _ = await self._request_json("GET", url)
+        return body
+
+    async def user(self, user_id: int) -> dict:
+        """
+        :param user_id: The ID of the user
+        :return: A dictionary with the user's information
+        """
+        url = f"{self.api_url}/courses/{self.course_id}/users/{user_id}"
+
+        body, _ = await self._request_json("GET", url)
+        return body
+
+    async def users(self, user_ids: Iterable[int]) -> List[dict]:
+        """
+        Fetch several users concurrently
+        :param user_ids: The IDs of the users
+        :return: The users' information, in the same order as user_ids
+        """
+        return await asyncio.gather(*(self.user(user_id) for user_id in user_ids))
+
+    async def _download_attachment(
+        self, url: str, path: str, size: Optional[int], details: dict
+    ) -> int:
+        """
+        The asyncio counterpart to PyCanvasGrader._download_attachment: partial files
+        and interrupted transfers are resumed with HTTP Range requests, up to
+        DOWNLOAD_RETRIES times
+        :param size: The attachment's size according to Canvas
+        :param details: The download's span details; resumed_from and retries are added
+        :return: How many bytes were fetched, not counting any resumed from
+        :raises DownloadError: If the attachment could not be downloaded in full
+        """
+        session = self._session()
+        fetched = 0
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            details["retries"] = attempt
+            if attempt:
+                await asyncio.sleep(min(0.5 * 2 ** (attempt - 1), 8))
+            have = 0
+            if size is not None and os.path.exists(path):
+                have = os.path.getsize(path)
+                if have == size:
+                    return fetched
+                if have > size:
+                    have = 0
+
+            headers = {"Range": f"bytes={have}-"} if have else {}
+            received = 0
+            try:
+                async with self.semaphore:
+                    async with await self._send(
+                        session, "GET", url, headers=headers
+                    ) as response:
+                        if response.status == 206:
+                            if not response.headers.get("Content-Range", "").startswith(
+                                f"bytes {have}-"
+                            ):
+                                # Not the range asked for; start over without one
+                                if os.path.exists(path):
+                                    os.remove(path)
+                                continue
+                            mode = "ab"
+                            details.setdefault("resumed_from", have)
+                        elif response.status == 200:
+                            mode = "wb"
+                        else:
+                            raise DownloadError(
+                                f"Downloading {url} failed with status {response.status}"
+                            )
+                        with open(path, mode, buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                            async for chunk in response.content.iter_chunked(
+                                DOWNLOAD_CHUNK_SIZE
+                            ):
+                                f.write(chunk)
+                                received += len(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # Resumed from whatever was written
+                fetched += received
+                continue
+            fetched += received
+            if size is None or os.path.getsize(path) == size:
+                return fetched
+        raise DownloadError(
+            f"Could not download {url} in full after {DOWNLOAD_RETRIES} retries"
+        )
+
+    async def download_submission(self, submission: dict) -> bool:
+        """
+        Attempts to download the attachments for a given submission, the same way as
+        PyCanvasGrader.download_submission.
+        Attachments of one submission are downloaded concurrently.
+        :param submission: The submission dictionary
+        :return: True if the request succeeded, False otherwise
+        """
+        try:
+            user_id = submission["user_id"]
+            files = [
+                (a["id"], a["url"], a["filename"], a.get("size"))
+                for a in submission["attachments"]
+            ]
+        except (KeyError, TypeError):
+            return False
+
+        user_dir = os.path.join(self.temp_dir, str(user_id))
+        new_dir = os.path.join(user_dir, ".new")
+        try:
+            os.makedirs(new_dir, exist_ok=True)
+            sizes = await asyncio.gather(
+                *(
+                    self._download_file(user_id, new_dir, *attachment)
+                    for attachment in files
+                )
+            )
+            for leftover in os.listdir(new_dir):
+                if leftover.endswith(".part"):
+                    os.remove(os.path.join(new_dir, leftover))
+
+            if self.extract_archives:
+                # Extraction is disk-bound, so it runs off the event loop
+                problems = await _running_loop().run_in_executor(
+                    None, archives.unpack_download, user_dir
+                )
+                for problem in problems:
+                    print(f"User {user_id}: {problem}")
+            utils.promote_download(user_dir)
+            instrument.event(
+                "submission_downloaded",
+                user_id=user_id,
+                attachments=len(files),
+                bytes=sum(sizes),
+            )
+        except DownloadError as e:
+            print(f"User {user_id}: {e}")
+            return False
+        except OSError:
+            return False
+        return True
+
+    async def _download_file(
+        self,
+        user_id: int,
+        new_dir: str,
+        attachment_id: int,
+        url: str,
+        filename: str,
+        size: Optional[int],
+    ) -> int:
+        """
+        Download one attachment into new_dir through a .part file
+        :return: How many bytes were fetched
+        """
+        part = os.path.join(new_dir, f".{attachment_id}-{filename}.part")
+        with instrument.span("download", f"{user_id}/{filename}") as details:
+            started = time.perf_counter()
+            fetched = await self._download_attachment(url, part, size, details)
+            seconds = time.perf_counter() - started
+            details["bytes"] = fetched
+        os.replace(part, os.path.join(new_dir, filename))
+        instrument.event(
+            "attachment_downloaded",
+            user_id=user_id,
+            filename=filename,
+            bytes=fetched,
+            seconds=round(seconds, 6),
+            resumed_from=details.get("resumed_from", 0),
+            retries=details.get("retries", 0),
+        )
+        return fetched
+
+    async def download_submissions(self, submissions: Iterable[dict]) -> List[bool]:
+        """
+        Download the attachments for many submissions concurrently
+        :return: Whether each download succeeded, in the same order as submissions
+        """
+        return await asyncio.gather(
+            *(self.download_submission(submission) for submission in submissions)
+        )
+
+    async def grade_submissions(
+        self, user_ids_and_grades: List[Tuple[int, int, str]]
+    ) -> bool:
+        url = (
+            f"{self.api_url}/courses/"
+            f"{self.course_id}/assignments/{self.assignment_id}/submissions/update_grades"
+        )
+
+        status, _ = await self._request_json(
+            "POST", url, data=PyCanvasGrader.grade_data(user_ids_and_grades)
+        )
+        status_url = f'{self.api_url}/progress/{status["id"]}'
+        while status["workflow_state"] != "completed":
+            if status["workflow_state"] == "failed":
+                return False
+            await asyncio.sleep(0.25)
+            status, _ = await self._request_json("GET", status_url)
+
+        return True
@@ -1,18 +1,42 @@
+import copy
 import os
+import threading
 import time
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
-from io import StringIO
 from numbers import Real
-from typing import List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 import requests
 import attr
 
+from lib.core import instrument
+
+from . import archives, utils
+from .http_cache import MetadataCache
+from .log_store import UserLog
 from .testing import TestSkeleton
 
 
 CANVAS_API_URL = "https://sit.instructure.com/api/v1"
+# Bytes read from the network and written to disk at a time when downloading attachments
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# How many times an interrupted or truncated attachment download is resumed
+DOWNLOAD_RETRIES = 4
+
+
+def default_api_url() -> str:
+    """
+    The Canvas API to talk to: $CANVAS_API_URL if it is set, else CANVAS_API_URL
+    """
+    return os.environ.get("CANVAS_API_URL", CANVAS_API_URL).rstrip("/")
+
+
+class DownloadError(IOError):
+    """
+    An attachment that could not be downloaded in full
+    """
 
 
 class Enrollment(Enum):
@@ -31,6 +55,52 @@ class Enrollment(Enum):
         return self.name
 
 
+class CanvasSession(requests.Session):
+    """
+    A requests session that spaces out its requests to stay under a rate limit,
+    and backs off and retries when Canvas reports that it is throttling the token.
+    One session can be shared by every thread and every grader of a run.
+
+    :param max_per_second: The most requests to start per second. 0 disables the limit
+    """
+
+    throttle_retries = 5
+
+    def __init__(self, max_per_second: float = 0):
+        super().__init__()
+        self.max_per_second = max_per_second
+        self._slot_lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def _wait_for_slot(self):
+        if self.max_per_second <= 0:
+            return
+        with self._slot_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.max_per_second
+        if slot > now:
+            time.sleep(slot - now)
+
+    def request(self, method, url, *args, **kwargs):
+        with instrument.span("api", f"{method} {urlsplit(url).path}") as details:
+            for attempt in range(self.throttle_retries + 1):
+                self._wait_for_slot()
+                response = super().request(method, url, *args, **kwargs)
+                if (
+                    response.status_code != 403
+                    or "Rate Limit Exceeded" not in response.text
+                ):
+                    break
+                instrument.event(
+                    "api_throttled", url=url, attempt=attempt + 1, wait=2 ** attempt
+                )
+                time.sleep(2 ** attempt)
+            details["status"] = response.status_code
+            details["retries"] = attempt
+        return response
+
+
 @attr.s(cmp=False, auto_attribs=True)
 class PyCanvasGrader:
     """
@@ -39,11 +109,21 @@ class PyCanvasGrader:
 
     course_id: int = -1
     assignment_id: int = -1
+    # Canvas timestamp of the last time submissions were listed; see iter_changed_submissions
+    last_sync: Optional[str] = None
+    # Where submissions are downloaded to. Default: INSTALL_DIR/.temp
+    workspace: Optional[str] = attr.ib(default=None, repr=False)
+    # The base URL of the Canvas API, such as a local mock server for benchmarks
+    api_url: str = attr.ib(default=attr.Factory(default_api_url), repr=False)
+    # Whether to unpack .zip and .tar attachments after downloading them; see archives.py
+    extract_archives: bool = attr.ib(default=True, repr=False)
 
     token: str = attr.ib(init=False, repr=False)
-    session: requests.Session = attr.ib(
-        attr.Factory(requests.Session), init=False, repr=False
+    session: CanvasSession = attr.ib(
+        attr.Factory(CanvasSession), init=False, repr=False
     )
+    # Optional on-disk cache for metadata listings; see enable_http_cache
+    http_cache: Optional[MetadataCache] = attr.ib(default=None, init=False, repr=False)
 
     def __attrs_post_init__(self):
         self.token = self.authenticate()
@@ -76,46 +156,146 @@ class PyCanvasGrader:
     def close(self):
         self.session.close()
 
-    def courses(self, enrollment_type: Enrollment = None) -> list:
+    def for_assignment(
+        self, course_id: int, assignment_id: int, workspace: str = None
+    ) -> "PyCanvasGrader":
+        """
+        Create a grader for another assignment which shares this grader's
+        session, rate limit and HTTP cache.
+        :param workspace: Where the new grader downloads submissions to
+        """
+        grader = copy.copy(self)
+        grader.course_id = course_id
+        grader.assignment_id = assignment_id
+        grader.workspace = workspace
+        grader.last_sync = None
+        return grader
+
+    @property
+    def temp_dir(self) -> str:
+        """
+        The directory that holds one subdirectory of files per downloaded submission
+        """
+        return self.workspace or os.path.join(os.environ["INSTALL_DIR"], ".temp")
+
+    @property
+    def log_dir(self) -> str:
+        """
+        The directory that holds the users' test logs, which is saved with the workspace
+        """
+        return os.path.join(self.temp_dir, ".logs")
+
+    def enable_http_cache(self, max_age: float = 0):
+        """
+        Cache course, assignment, submission and user metadata on disk between sessions
+        :param max_age: Seconds for which cached metadata is used without revalidating it
+        """
+        directory = os.path.join(os.environ["INSTALL_DIR"], ".cache", "http")
+        self.http_cache = MetadataCache(directory, self.token, max_age)
+
+    def _get_json(self, url: str, cached: bool = True) -> Tuple[Any, Optional[str]]:
+        """
+        GET a JSON resource, through the HTTP cache if it is enabled
+        :param cached: Whether the HTTP cache may be used for this request
+        :return: (The decoded body, the URL of the next page or None)
+        """
+        if cached and self.http_cache is not None:
+            return self.http_cache.get(self.session, url)
+
+        response = self.session.get(url)
+        next_link = response.links.get("next")
+        return response.json(), next_link["url"] if next_link else None
+
+    def _paginate(self, url: str, cached: bool = True) -> Iterator[dict]:
+        """
+        Yield every item of a paginated listing as its page arrives.
+        The next page is requested in the background while the current one is consumed.
+        :param url: The URL of the first page
+        :param cached: Whether the HTTP cache may be used for this listing
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self._get_json, url, cached)
+            while pending is not None:
+                page, next_url = pending.result()
+                pending = (
+                    executor.submit(self._get_json, next_url, cached)
+                    if next_url
+                    else None
+                )
+                yield from page
+
+    def iter_courses(self, enrollment_type: Enrollment = None) -> Iterator[dict]:
         """
         :param enrollment_type: (Optional) teacher, student, ta, observer, designer
-        :return: A list of the user's courses as dictionaries, optionally filtered by enrollment_type
+        :return: An iterator over the user's courses, optionally filtered by enrollment_type
         """
-        url = f"{CANVAS_API_URL}/courses?per_page=100"
+        url = f"{self.api_url}/courses?per_page=100"
         if enrollment_type is not None:
             url += "&enrollment_type=" + enrollment_type.name.lower()
 
-        response = self.session.get(url)
-        return response.json()
+        return self._paginate(url)
 
-    def assignments(self, ungraded: bool = True) -> list:
+    def courses(self, enrollment_type: Enrollment = None) -> list:
+        """
+        :param enrollment_type: (Optional) teacher, student, ta, observer, designer
+        :return: A list of the user's courses as dictionaries, optionally filtered by enrollment_type
+        """
+        return list(self.iter_courses(enrollment_type))
+
+    def iter_assignments(self, ungraded: bool = True) -> Iterator[dict]:
         """
         :param ungraded: Whether to filter assignments by only those that have ungraded work. Default: True
-        :return: A list of the course's assignments
+        :return: An iterator over the course's assignments
         """
-        url = f"{CANVAS_API_URL}/courses/{self.course_id}/assignments?per_page=100"
+        url = f"{self.api_url}/courses/{self.course_id}/assignments?per_page=100"
         if ungraded:
             url += "&bucket=ungraded"
 
-        response = self.session.get(url)
-        return response.json()
+        return self._paginate(url)
 
-    def submissions(self) -> list:
+    def assignments(self, ungraded: bool = True) -> list:
         """
-        :return: A list of the assignment's submissions
+        :param ungraded: Whether to filter assignments by only those that have ungraded work. Default: True
+        :return: A list of the course's assignments
+        """
+        return list(self.iter_assignments(ungraded))
+
+    def iter_submissions(self) -> Iterator[dict]:
+        """
+        :return: An iterator over the assignment's submissions
         """
         url = (
-            f"{CANVAS_API_URL}/courses/{self.course_id}"
+            f"{self.api_url}/courses/{self.course_id}"
             f"/assignments/{self.assignment_id}/submissions?per_page=100"
         )
 
-        response = self.session.get(url)
-        final_response = response.json()
-        while response.links.get("next"):
-            response = self.session.get(response.links["next"]["url"])
-            final_response.extend(response.json())
+        return self._paginate(url)
+
+    def submissions(self) -> list:
+        """
+        :return: A list of the assignment's submissions
+        """
+        return list(self.iter_submissions())
+
+    def iter_changed_submissions(self, since: Optional[str]) -> Iterator[dict]:
+        """
+        :param since: A Canvas timestamp; if None, every submission is returned
+        :return: An iterator over the assignment's submissions that were submitted or graded after since
+        """
+        url = (
+            f"{self.api_url}/courses/{self.course_id}/students/submissions"
+            f"?student_ids[]=all&assignment_ids[]={self.assignment_id}&per_page=100"
+        )
+        if since is None:
+            yield from self._paginate(url, cached=False)
+            return
 
-        return final_response
+        seen = set()
+        for since_filter in ("submitted_since", "graded_since"):
+            for submission in self._paginate(f"{url}&{since_filter}={since}", False):
+                if submission["id"] not in seen:
+                    seen.add(submission["id"])
+                    yield submission
 
     def submission(self, user_id: int) -> dict:
         """
@@ -124,7 +304,7 @@ class PyCanvasGrader:
         :return: A dictionary which represents the submission object
         """
         url = (
-            f"{CANVAS_API_URL}/courses/"
+            f"{self.api_url}/courses/"
             f"{self.course_id}/assignments/{self.assignment_id}/submissions/{user_id}"
         )
 
@@ -148,11 +328,14 @@ class PyCanvasGrader:
         # then clear .temp/user_id,
         # then move from .new to .temp/user_id.
         # This ensures that the download is complete before overwriting.
+        # Paths are absolute so that several downloads can run at once.
+        # An interrupted download leaves .new behind, and the next one resumes from it.
+        user_dir = os.path.join(self.temp_dir, str(user_id))
+        new_dir = os.path.join(user_dir, ".new")
         try:
-            os.chdir(os.environ["INSTALL_DIR"])
-            os.makedirs(os.path.join(".temp", str(user_id), ".new"), exist_ok=True)
-            os.chdir(os.path.join(".temp", str(user_id), ".new"))
+            os.makedirs(new_dir, exist_ok=True)
 
+            downloaded = 0
             for attachment in attachments:
                 try:
                     url = attachment["url"]
@@ -160,22 +343,51 @@ class PyCanvasGrader:
                 except (KeyError, TypeError):
                     return False
 
-                r = self.session.get(url, stream=True)
-                with open(filename, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:
-                            f.write(chunk)
-
-            os.chdir("..")
-            for cur_file in os.listdir("."):
-                if os.path.isfile(cur_file):
-                    os.remove(cur_file)
-
-            os.chdir(".new")
-            for cur_file in os.listdir("."):
-                shutil.move(cur_file, "..")
-            os.chdir("..")
-            os.rmdir(".new")
+                path = os.path.join(new_dir, filename)
+                # Partial files are named after the attachment, so that a partial file
+                # left by an earlier attempt's attachment is never resumed
+                part = os.path.join(
+                    new_dir, ".{}-{}.part".format(attachment.get("id"), filename)
+                )
+                with instrument.span("download", f"{user_id}/{filename}") as details:
+                    started = time.perf_counter()
+                    size = self._download_attachment(
+                        url, part, attachment.get("size"), details
+                    )
+                    seconds = time.perf_counter() - started
+                    details["bytes"] = size
+                    if seconds > 0:
+                        details["bytes_per_second"] = round(size / seconds)
+                os.replace(part, path)
+                instrument.event(
+                    "attachment_downloaded",
+                    user_id=user_id,
+                    filename=filename,
+                    bytes=size,
+                    seconds=round(seconds, 6),
+                    resumed_from=details.get("resumed_from", 0),
+                    retries=details.get("retries", 0),
+                )
+                downloaded += size
+
+            for leftover in os.listdir(new_dir):
+                if leftover.endswith(".part"):
+                    os.remove(os.path.join(new_dir, leftover))
+
+            if self.extract_archives:
+                with instrument.span("download", f"{user_id}/extract"):
+                    for problem in archives.unpack_download(user_dir):
+                        print(f"User {user_id}: {problem}")
+            utils.promote_download(user_dir)
+            instrument.event(
+                "submission_downloaded",
+                user_id=user_id,
+                attachments=len(attachments),
+                bytes=downloaded,
+            )
+        except DownloadError as e:
+            print(f"User {user_id}: {e}")
+            return False
         except:
             print("Unable work with files in the installation directory")
             print("The program will likely not work as intended.")
@@ -185,48 +397,113 @@ class PyCanvasGrader:
             return False
         return True
 
+    def _download_attachment(
+        self, url: str, path: str, size: Optional[int], details: dict
+    ) -> int:
+        """
+        Stream an attachment to path in DOWNLOAD_CHUNK_SIZE pieces.
+        A partial file already at path is resumed with an HTTP Range request, and a
+        transfer that is interrupted or ends short of size is resumed the same way, up
+        to DOWNLOAD_RETRIES times
+        :param size: The attachment's size according to Canvas. Without it, partial
+        files cannot be recognised, so every attempt starts over
+        :param details: The download's span details; resumed_from and retries are added
+        :return: How many bytes were fetched, not counting any resumed from
+        :raises DownloadError: If the attachment could not be downloaded in full
+        """
+        fetched = 0
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            details["retries"] = attempt
+            if attempt:
+                time.sleep(min(0.5 * 2 ** (attempt - 1), 8))
+            have = 0
+            if size is not None and os.path.exists(path):
+                have = os.path.getsize(path)
+                if have == size:
+                    return fetched
+                if have > size:
+                    have = 0
+
+            headers = {"Range": f"bytes={have}-"} if have else {}
+            try:
+                response = self.session.get(url, stream=True, headers=headers)
+                if response.status_code == 206:
+                    if not response.headers.get("Content-Range", "").startswith(
+                        f"bytes {have}-"
+                    ):
+                        # Not the range asked for; start over without one
+                        response.close()
+                        if os.path.exists(path):
+                            os.remove(path)
+                        continue
+                    mode = "ab"
+                    details.setdefault("resumed_from", have)
+                elif response.status_code == 200:
+                    mode = "wb"
+                else:
+                    raise DownloadError(
+                        f"Downloading {url} failed with status {response.status_code}"
+                    )
+                # A dropped connection would otherwise discard the chunk being read,
+                # so short transfers are let through and caught by the length check
+                response.raw.enforce_content_length = False
+                received = 0
+                with open(path, mode, buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        received += len(chunk)
+                fetched += received
+            except requests.RequestException:
+                # Resumed from whatever was written
+                continue
+            expected = response.headers.get("Content-Length")
+            if (
+                expected is not None
+                and "Content-Encoding" not in response.headers
+                and received != int(expected)
+            ):
+                continue
+            if size is None or os.path.getsize(path) == size:
+                return fetched
+        raise DownloadError(
+            f"Could not download {url} in full after {DOWNLOAD_RETRIES} retries"
+        )
+
     def user(self, user_id: int) -> dict:
         """
         :param user_id: The ID of the user
         :return: A dictionary with the user's information
         """
-        url = f"{CANVAS_API_URL}/courses/{self.course_id}/users/{user_id}"
+        url = f"{self.api_url}/courses/{self.course_id}/users/{user_id}"
 
-        response = self.session.get(url)
-        return response.json()
+        user, _ = self._get_json(url)
+        return user
 
     def grade_submission(self, user_id: int, grade: Real):
         if grade is None:
             grade = "NaN"
         url = (
-            f"{CANVAS_API_URL}/courses/{self.course_id}/assignments/{self.assignment_id}/"
+            f"{self.api_url}/courses/{self.course_id}/assignments/{self.assignment_id}/"
             f"submissions/{user_id}/?submission[posted_grade]={grade}"
         )
 
         response = self.session.put(url)
+        if response.ok:
+            instrument.event("grade_posted", user_id=user_id, grade=grade)
         return response.json()
 
     def grade_submissions(
         self, user_ids_and_grades: List[Tuple[int, int, str]]
     ) -> bool:
         url = (
-            f"{CANVAS_API_URL}/courses/"
+            f"{self.api_url}/courses/"
             f"{self.course_id}/assignments/{self.assignment_id}/submissions/update_grades"
         )
 
-        data = {}
-        for user_id, grade, comment in user_ids_and_grades:
-            grade = grade if grade is not None else "NaN"
-
-            data[f"grade_data[{user_id}][posted_grade]"] = str(grade)
-
-            if comment != "":
-                data[f"grade_data[{user_id}][text_comment]"] = comment
-
-        response = self.session.post(url, data=data)
+        response = self.session.post(url, data=self.grade_data(user_ids_and_grades))
 
         status = response.json()
-        status_url = f'{CANVAS_API_URL}/progress/{status["id"]}'
+        status_url = f'{self.api_url}/progress/{status["id"]}'
         while status["workflow_state"] != "completed":
             if status["workflow_state"] == "failed":
                 return False
@@ -234,11 +511,30 @@ class PyCanvasGrader:
             response = self.session.get(status_url)
             status = response.json()
 
+        for user_id, grade, _ in user_ids_and_grades:
+            instrument.event("grade_posted", user_id=user_id, grade=grade)
         return True
 
+    @staticmethod
+    def grade_data(user_ids_and_grades: List[Tuple[int, int, str]]) -> dict:
+        """
+        Build the form data for a batch grade update
+        :param user_ids_and_grades: (user_id, grade, comment) for each submission to grade
+        :return: A dictionary of form fields for the update_grades endpoint
+        """
+        data = {}
+        for user_id, grade, comment in user_ids_and_grades:
+            grade = grade if grade is not None else "NaN"
+
+            data[f"grade_data[{user_id}][posted_grade]"] = str(grade)
+
+            if comment != "":
+                data[f"grade_data[{user_id}][text_comment]"] = comment
+        return data
+
     def comment_on_submission(self, user_id: int, comment: str):
         url = (
-            f"{CANVAS_API_URL}/courses/{self.course_id}/assignments/{self.assignment_id}"
+            f"{self.api_url}/courses/{self.course_id}/assignments/{self.assignment_id}"
             f"/submissions/{user_id}/?comment[text_comment]={comment}"
         )
 
@@ -246,7 +542,7 @@ class PyCanvasGrader:
         return response.json()
 
     def message_user(self, recipient_id: int, body: str, subject: str = None):
-        url = f"{CANVAS_API_URL}/conversations/"
+        url = f"{self.api_url}/conversations/"
 
         data = {"recipients[]": recipient_id, "body": body, "subject": subject}
         response = self.session.post(url, data=data)
@@ -277,9 +573,12 @@ class User:
     attempt: int
     grade: Optional[Real] = None
     comment: str = ""
-    # Used like a StringBuilder in Java to more efficiently build large strings.
-    # But also fulfills the file protocol in Python so is writable like a file.
-    log: StringIO = attr.ib(default=attr.Factory(StringIO), init=False, repr=False)
+    # Set when a newer attempt has been downloaded since this user was last graded
+    needs_regrade: bool = False
+    # Wall time in seconds of each test's most recent run, keyed by TestSkeleton.test_key
+    test_times: Dict[str, float] = attr.Factory(dict)
+    # The output of the user's tests. Writable like a file; see UserLog
+    log: UserLog = attr.ib(default=attr.Factory(UserLog), init=False, repr=False)
 
     def __attrs_post_init__(self):
         if self.grade is None:
@@ -288,7 +587,7 @@ class User:
     def __str__(self):
         grade = "ungraded" if self.grade is None else self.grade
         submit_status = "posted" if self.submitted else "not posted"
-        if not self.grade_matches_submission:
+        if self.needs_regrade or not self.grade_matches_submission:
             submit_status += " - needs re-grading (new submission)"
         email = f"({self.email})" if self.email else ""
         return "{} {}: {} [{}]".format(self.name, email, grade, submit_status)
@@ -297,11 +596,19 @@ class User:
     def submitted(self):
         return self.grade == self.last_posted_grade
 
-    def grade_self(self, test_skeleton: "TestSkeleton"):
-        grade = test_skeleton.run_tests(self)
+    def grade_self(
+        self,
+        test_skeleton: "TestSkeleton",
+        interactive: bool = True,
+        temp_dir: str = None,
+    ):
+        grade = test_skeleton.run_tests(self, interactive, temp_dir)
+        # Graded users' logs are rarely read again, so they need not stay in memory
+        self.log.flush()
         if grade is None:
             return
         else:
+            self.needs_regrade = False
             if grade != self.grade:
                 self.grade = grade
 
@@ -311,8 +618,13 @@ class User:
         self.last_posted_grade = self.grade
 
     def update(self, grader: PyCanvasGrader) -> bool:
+        return self.apply_submission(grader, grader.submission(self.user_id))
 
-        new_submission = grader.submission(self.user_id)
+    def apply_submission(self, grader: PyCanvasGrader, new_submission: dict) -> bool:
+        """
+        Download new_submission if it is a newer attempt than this user's current one
+        :return: True if a newer attempt was downloaded
+        """
         if new_submission["attempt"] > self.attempt:
             if grader.download_submission(new_submission):
                 # noinspection PyArgumentList
@@ -322,21 +634,59 @@ class User:
                     "grade_matches_current_submission"
                 ]
                 self.attempt = new_submission["attempt"]
+                self.needs_regrade = True
                 return True
         return False
 
+    def store_log(self, log_dir: str, clear: bool = False):
+        """
+        Keep this user's log in log_dir instead of in memory
+        :param clear: Whether to delete what is already stored there, instead of keeping it
+        """
+        stored = UserLog(os.path.join(log_dir, f"{self.user_id}.log"))
+        if clear:
+            stored.clear()
+        stored.write(self.log.getvalue())
+        self.log = stored
+
+    @classmethod
+    def from_submission(
+        cls, submission: dict, user_data: dict, log_dir: str = None
+    ) -> "User":
+        """
+        Create a User object from a submission and the submitting user's information
+        :param log_dir: The directory to store the user's log in. Default: keep it in memory
+        """
+        user = cls(
+            submission["user_id"],
+            submission["id"],
+            user_data["name"],
+            user_data.get("email"),
+            submission["score"],
+            submission["grade_matches_current_submission"],
+            submission["attempt"],
+        )
+        if log_dir is not None:
+            user.store_log(log_dir, clear=True)
+        return user
+
     def to_json(self):
         """
-        Cache the user as a JSON-compatible dictionary
+        Cache the user as a JSON-compatible dictionary.
+        A stored log is left out, as it is already on disk
         """
-        attributes = attr.asdict(self)
-        attributes["log"] = self.log.getvalue()
+        attributes = attr.asdict(
+            self, filter=lambda attribute, _: attribute.name != "log"
+        )
+        self.log.flush()
+        attributes["log"] = None if self.log.path else self.log.getvalue()
         return attributes
 
     @classmethod
-    def from_json(cls, jsonobj):
+    def from_json(cls, jsonobj, log_dir: str = None):
         """
         Create a User object from a dictionary
+        :param log_dir: The directory the user's log is stored in. Default: keep it in memory
         """
         try:
             log = jsonobj.pop("log")
@@ -344,5 +694,9 @@ class User:
         except KeyError as e:
             raise ValueError('Invalid dictionary for caching type "User"') from e
         else:
-            user.log.write(log)
+            if log:
+                user.log.write(log)
+            if log_dir is not None:
+                # Caches from before the log store held the log inline; that replaces it
+                user.store_log(log_dir, clear=bool(log))
             return user
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Optional, Tuple
+
+import attr
+import requests
+
+
+@attr.s(auto_attribs=True)
+class MetadataCache:
+    """
+    A persistent cache of JSON GET responses from the Canvas API.
+
+    Cached responses are revalidated with If-None-Match/If-Modified-Since, so an
+    unchanged listing costs one 304 round trip instead of a full download.
+
+    :param directory: The directory to store cached responses in
+    :param token: The access token the responses were fetched with; responses are never shared between tokens
+    :param max_age: Seconds for which a cached response is served without contacting Canvas at all.
+    Cached responses are also served, regardless of age, when Canvas cannot be reached.
+    """
+
+    directory: str
+    token: str = attr.ib(default="", repr=False)
+    max_age: float = 0
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha1((self.token + " " + url).encode("UTF-8")).hexdigest()
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, url: str) -> Optional[dict]:
+        """
+        :return: The cache entry for url, or None if there is no valid entry
+        """
+        try:
+            with open(self._path(url)) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def store(self, url: str, entry: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(url)
+        try:
+            with open(path + ".new", "w") as entry_file:
+                json.dump({**entry, "url": url}, entry_file)
+            os.replace(path + ".new", path)
+        except OSError:
+            pass
+
+    def get(self, session: requests.Session, url: str) -> Tuple[Any, Optional[str]]:
+        """
+        Fetch a JSON resource through the cache
+        :param session: The session to make requests with
+        :param url: The URL to GET
+        :return: (The decoded body, the URL of the next page or None)
+        """
+        entry = self.load(url)
+        if entry is not None and time.time() - entry["fetched_at"] < self.max_age:
+            return entry["body"], entry["next"]
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            response = session.get(url, headers=headers)
+        except requests.ConnectionError:
+            if entry is None:
+                raise
+            return entry["body"], entry["next"]
+
+        if response.status_code == 304 and entry is not None:
+            entry["fetched_at"] = time.time()
+            self.store(url, entry)
+            return entry["body"], entry["next"]
+
+        body = response.json()
+        next_link = response.links.get("next")
+        next_url = next_link["url"] if next_link else None
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.ok and (etag or last_modified or self.max_age > 0):
+            self.store(
+                url,
+                {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "fetched_at": time.time(),
+                    "body": body,
+                    "next": next_url,
+                },
+            )
+        return body, next_url
@@ -0,0 +1,171 @@
+import glob
+import gzip
+import io
+import os
+import shutil
+import threading
+from typing import Iterator, List, Optional
+
+import attr
+
+# Bytes of log text kept in memory before they are appended to the log file
+MEMORY_LIMIT = 16 * 1024
+# Size at which a log file is compressed and a new one is started
+SEGMENT_BYTES = 1024 * 1024
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class UserLog:
+    """
+    A user's test log. Writable like a file, so it can be printed to.
+
+    Without a path, the log lives in memory like a StringIO. With one, at most
+    memory_limit bytes are held in memory; the rest is appended to the file at path,
+    and every segment_bytes the file is gzipped to path.<n>.gz and a new one started.
+    Nothing is written to disk until the log is flushed or outgrows memory_limit.
+
+    :param path: The file to keep the log in, or None to keep it in memory
+    :param memory_limit: How much text to buffer before it is appended to the file
+    :param segment_bytes: How large the file grows before it is compressed
+    """
+
+    path: Optional[str] = None
+    memory_limit: int = MEMORY_LIMIT
+    segment_bytes: int = SEGMENT_BYTES
+    _buffer: List[str] = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    _buffered: int = attr.ib(default=0, init=False, repr=False)
+    _lock: threading.RLock = attr.ib(
+        default=attr.Factory(threading.RLock), init=False, repr=False
+    )
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            self._buffer.append(text)
+            self._buffered += len(text)
+            if self.path is not None and self._buffered > self.memory_limit:
+                self.flush()
+        return len(text)
+
+    def flush(self):
+        """
+        Append the buffered text to the log file
+        """
+        with self._lock:
+            if self.path is None or not self._buffer:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="UTF-8", newline="") as log_file:
+                log_file.write("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+            if os.path.getsize(self.path) >= self.segment_bytes:
+                self._compress()
+
+    def _segments(self) -> List[str]:
+        """
+        :return: The compressed segments of the log, oldest first
+        """
+        segments = glob.glob(glob.escape(self.path) + ".*.gz")
+        return sorted(segments, key=lambda segment: int(segment.split(".")[-2]))
+
+    def _compress(self):
+        segment = "{}.{}.gz".format(self.path, len(self._segments()) + 1)
+        with open(self.path, "rb") as log_file, gzip.open(segment, "wb") as gz_file:
+            shutil.copyfileobj(log_file, gz_file)
+        os.remove(self.path)
+
+    def files(self) -> List[str]:
+        """
+        Flush the log
+        :return: The files the log is kept in, oldest first
+        """
+        with self._lock:
+            if self.path is None:
+                return []
+            self.flush()
+            files = self._segments()
+            if os.path.exists(self.path):
+                files.append(self.path)
+            return files
+
+    def chunks(self) -> Iterator[str]:
+        """
+        Read the log from the start without loading all of it at once
+        :return: The log's text, one segment at a time
+        """
+        with self._lock:
+            if self.path is None:
+                text = "".join(self._buffer)
+            else:
+                self.flush()
+                segments = self._segments()
+        if self.path is None:
+            yield text
+            return
+        for segment in segments:
+            with gzip.open(segment, "rt", encoding="UTF-8", newline="") as gz_file:
+                yield gz_file.read()
+        if os.path.exists(self.path):
+            with open(self.path, encoding="UTF-8", newline="") as log_file:
+                yield log_file.read()
+
+    def lines(self) -> Iterator[str]:
+        """
+        Read the log from the start one line at a time, without loading it all at once
+        """
+        partial = ""
+        for line in self._lines():
+            # A line can be split between the end of one segment and the next
+            if not line.endswith(("\n", "\r")):
+                partial += line
+                continue
+            yield partial + line
+            partial = ""
+        if partial:
+            yield partial
+
+    def _lines(self) -> Iterator[str]:
+        with self._lock:
+            if self.path is None:
+                text = "".join(self._buffer)
+            else:
+                self.flush()
+                segments = self._segments()
+        if self.path is None:
+            yield from io.StringIO(text, newline="")
+            return
+        for segment in segments:
+            with gzip.open(segment, "rt", encoding="UTF-8", newline="") as gz_file:
+                yield from gz_file
+        if os.path.exists(self.path):
+            with open(self.path, encoding="UTF-8", newline="") as log_file:
+                yield from log_file
+
+    def getvalue(self) -> str:
+        """
+        :return: The whole log, like StringIO.getvalue
+        """
+        return "".join(self.chunks())
+
+    @property
+    def empty(self) -> bool:
+        with self._lock:
+            if self._buffered:
+                return False
+            if self.path is None:
+                return True
+            return not os.path.exists(self.path) and not self._segments()
+
+    def clear(self):
+        """
+        Delete everything in the log
+        """
+        with self._lock:
+            self._buffer = []
+            self._buffered = 0
+            if self.path is not None:
+                for log_file in self._segments() + [self.path]:
+                    try:
+                        os.remove(log_file)
+                    except FileNotFoundError:
+                        pass
@@ -0,0 +1,616 @@
+"""
+A local stand-in for the parts of the Canvas API that PyCanvasGrader uses, and a generator
+of synthetic courses to serve from it, so throughput can be measured without a real course.
+
+    python -m lib.canvas_api.mock_canvas --students=2000 --port=8799 --latency=0.05
+
+Then point the grader at it with CANVAS_API_URL=http://127.0.0.1:8799/api/v1 (or --api-url)
+and any access token.
+
+Served endpoints: courses, assignments, paginated submissions (per assignment and
+students/submissions with submitted_since/graded_since), single submissions, users,
+attachment downloads, grade and comment updates, update_grades and its progress, and
+conversations. Listings carry ETags and answer If-None-Match with 304, like Canvas.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import attr
+
+from . import utils
+
+# The expected output of every synthetic submission; see SYNTHETIC_SKELETON
+EXPECTED_OUTPUT = "5050"
+
+NOT_FOUND = 404, {"errors": [{"message": "The specified resource does not exist."}]}
+
+# How synthetic submissions behave, and how often
+SUBMISSION_KINDS = {
+    "correct": 0.70,
+    "wrong": 0.15,
+    "crash": 0.08,
+    "slow": 0.05,
+    "hang": 0.02,
+}
+
+# A skeleton that grades synthetic submissions
+SYNTHETIC_SKELETON = {
+    "descriptor": "Synthetic benchmark assignment",
+    "disarm": True,
+    "default": {"command": "python3", "target_file": "main.py", "timeout": 5},
+    "tests": {
+        "compile": {
+            "command": "python3 -m py_compile",
+            "args": ["%s"],
+            "test_must_pass": True,
+            "point_val": 2,
+            "fail_comment": "main.py does not compile",
+        },
+        "sum": {
+            "args": ["%s"],
+            "output_match": EXPECTED_OUTPUT,
+            "point_val": 8,
+            "fail_comment": "Wrong sum",
+        },
+    },
+}
+
+_PROGRAMS = {
+    "correct": "print(sum(range(1, 101)))\n",
+    "wrong": "print(sum(range(1, 101)) + 1)\n",
+    "crash": "print(total)\n",
+    "slow": "import time\ntime.sleep(0.5)\nprint(sum(range(1, 101)))\n",
+    "hang": "while True:\n    pass\n",
+}
+
+
+@attr.s(auto_attribs=True)
+class SyntheticCourse:
+    """
+    Everything a mock Canvas serves for one course.
+
+    :param course: The course, as Canvas lists it
+    :param assignments: The course's assignments
+    :param users: Every student, by user id
+    :param submissions: Every submission, by assignment id, then user id. Attachments
+    hold only a file id, filename and size; their URLs are filled in when served
+    :param files: The contents of every attachment, by file id
+    """
+
+    course: dict
+    assignments: List[dict]
+    users: Dict[int, dict]
+    submissions: Dict[int, Dict[int, dict]]
+    files: Dict[int, bytes]
+
+
+def _program(kind: str, rng: random.Random) -> bytes:
+    # Pad with comments so attachments have realistic, varied sizes (about 0.2 to 40 KB)
+    padding = int(min(rng.lognormvariate(7, 1), 40000))
+    comment = "".join(
+        "# " + "".join(rng.choice("abcdefghij ") for _ in range(70)) + "\n"
+        for _ in range(padding // 73)
+    )
+    return (comment + _PROGRAMS[kind]).encode("UTF-8")
+
+
+def generate_course(
+    students: int = 1000,
+    assignments: int = 1,
+    course_id: int = 1,
+    seed: int = 0,
+    submitted: float = 0.95,
+    graded: float = 0.2,
+    helpers: float = 0.2,
+    kinds: Dict[str, float] = None,
+) -> SyntheticCourse:
+    """
+    Generate a course with the same submissions every time for the same arguments
+    :param students: How many students are enrolled
+    :param assignments: How many assignments the course has
+    :param submitted: The fraction of students who submitted each assignment
+    :param graded: The fraction of submissions that already have an up to date grade
+    :param helpers: The fraction of submissions that include a second file besides main.py
+    :param kinds: How often submissions behave each way. Default: SUBMISSION_KINDS
+    """
+    rng = random.Random(seed)
+    start = datetime(2018, 8, 27)
+    course = {
+        "id": course_id,
+        "name": f"Synthetic Course {course_id}",
+        "course_code": f"SYN{course_id}",
+        "start_at": utils.canvas_timestamp(start),
+        "enrollments": [{"type": "teacher"}],
+    }
+    users = {
+        user_id: {
+            "id": user_id,
+            "name": f"Student {user_id}",
+            "sortable_name": f"{user_id}, Student",
+            "email": f"student{user_id}@example.edu",
+        }
+        for user_id in range(1, students + 1)
+    }
+
+    kinds = kinds or SUBMISSION_KINDS
+    kind_names = list(kinds)
+    weights = list(kinds.values())
+    assignment_list = []
+    submissions = {}
+    files = {}
+    for number in range(1, assignments + 1):
+        assignment_id = course_id * 1000 + number
+        due = start + timedelta(weeks=number)
+        by_user = {}
+        for user_id in users:
+            submission = {
+                "id": assignment_id * 100000 + user_id,
+                "user_id": user_id,
+                "assignment_id": assignment_id,
+                "attempt": None,
+                "score": None,
+                "grade": None,
+                "grade_matches_current_submission": True,
+                "workflow_state": "unsubmitted",
+                "submitted_at": None,
+                "graded_at": None,
+                "attachments": None,
+            }
+            if rng.random() < submitted:
+                kind = rng.choices(kind_names, weights)[0]
+                attachments = []
+                names = ["main.py"] + (["helper.py"] if rng.random() < helpers else [])
+                for filename in names:
+                    file_id = len(files) + 1
+                    if filename == "main.py":
+                        files[file_id] = _program(kind, rng)
+                    else:
+                        files[file_id] = _program("correct", rng).replace(
+                            b"print(", b"def helper():\n    return ("
+                        )
+                    attachments.append(
+                        {
+                            "id": file_id,
+                            "filename": filename,
+                            "display_name": filename,
+                            "size": len(files[file_id]),
+                        }
+                    )
+                submitted_at = due - timedelta(minutes=rng.randint(0, 7 * 24 * 60))
+                submission.update(
+                    attempt=rng.choice((1, 1, 1, 2, 3)),
+                    workflow_state="submitted",
+                    submitted_at=utils.canvas_timestamp(submitted_at),
+                    attachments=attachments,
+                )
+                if rng.random() < graded:
+                    score = 10.0 if kind in ("correct", "slow") else 2.0
+                    submission.update(
+                        score=score,
+                        grade=str(score),
+                        workflow_state="graded",
+                        graded_at=utils.canvas_timestamp(due + timedelta(days=1)),
+                    )
+            by_user[user_id] = submission
+        submissions[assignment_id] = by_user
+        assignment_list.append(
+            {
+                "id": assignment_id,
+                "course_id": course_id,
+                "name": f"Homework {number}",
+                "due_at": utils.canvas_timestamp(due),
+                "points_possible": 10,
+                "needs_grading_count": sum(
+                    1 for s in by_user.values() if s["workflow_state"] == "submitted"
+                ),
+            }
+        )
+
+    return SyntheticCourse(course, assignment_list, users, submissions, files)
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class MockCanvas:
+    """
+    Serves synthetic courses over HTTP the way Canvas would.
+
+    :param courses: The courses to serve
+    :param latency: Seconds added to every response
+    :param rate_limit: The most requests per second before answering 403 Rate Limit Exceeded.
+    0 disables the limit
+    :param burst: How many requests may arrive at once before the rate limit applies
+    :param bandwidth: The most bytes per second to send each attachment at. 0 disables the limit
+    :param interrupt_after: Drop the connection after sending this many bytes of an attachment,
+    to exercise resumed downloads. 0 sends attachments in full
+    """
+
+    courses: List[SyntheticCourse]
+    latency: float = 0.0
+    rate_limit: float = 0.0
+    burst: int = 10
+    bandwidth: float = 0.0
+    interrupt_after: int = 0
+
+    requests: int = attr.ib(default=0, init=False)
+    throttled: int = attr.ib(default=0, init=False)
+    _lock: threading.Lock = attr.ib(
+        default=attr.Factory(threading.Lock), init=False, repr=False
+    )
+    _tokens: float = attr.ib(default=0.0, init=False, repr=False)
+    _refilled: float = attr.ib(
+        default=attr.Factory(time.monotonic), init=False, repr=False
+    )
+    _progress: Dict[int, int] = attr.ib(
+        default=attr.Factory(dict), init=False, repr=False
+    )
+    _server: Optional[HTTPServer] = attr.ib(default=None, init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._tokens = self.burst
+
+    def _admit(self) -> bool:
+        """
+        Count a request against the rate limit
+        :return: False if the request should be throttled
+        """
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit <= 0:
+                return True
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._refilled) * self.rate_limit
+            )
+            self._refilled = now
+            if self._tokens < 1:
+                self.throttled += 1
+                return False
+            self._tokens -= 1
+            return True
+
+    def _course(self, course_id: int) -> Optional[SyntheticCourse]:
+        for course in self.courses:
+            if course.course["id"] == course_id:
+                return course
+        return None
+
+    def _submission_json(self, base: str, submission: dict) -> dict:
+        served = dict(submission)
+        if submission["attachments"] is not None:
+            served["attachments"] = [
+                {**attachment, "url": f"{base}/files/{attachment['id']}/download"}
+                for attachment in submission["attachments"]
+            ]
+        return served
+
+    def handle(
+        self,
+        method: str,
+        path: str,
+        query: Dict[str, List[str]],
+        form: Dict[str, List[str]],
+        base: str,
+    ) -> Tuple[int, object]:
+        """
+        Answer one API request
+        :param base: The URL of this server, to build attachment links with
+        :return: (The status code, the JSON-compatible body)
+        """
+        match = re.fullmatch
+        if method == "GET" and path == "/api/v1/courses":
+            return 200, [course.course for course in self.courses]
+
+        if method == "POST" and path.rstrip("/") == "/api/v1/conversations":
+            subject = (form.get("subject") or [""])[0]
+            return 201, [{"id": self.requests, "subject": subject}]
+
+        m = match(r"/api/v1/progress/(\d+)", path)
+        if m:
+            polls = self._progress.get(int(m.group(1)))
+            if polls is None:
+                return NOT_FOUND
+            # Report completion on the second poll, like a short background job
+            self._progress[int(m.group(1))] = polls + 1
+            state = "completed" if polls >= 1 else "running"
+            return 200, {"id": int(m.group(1)), "workflow_state": state}
+
+        m = match(r"/api/v1/courses/(\d+)/(.*?)/?", path)
+        course = self._course(int(m.group(1))) if m else None
+        if course is None:
+            return NOT_FOUND
+        rest = m.group(2)
+
+        if method == "GET" and rest == "assignments":
+            if query.get("bucket") == ["ungraded"]:
+                return 200, [a for a in course.assignments if a["needs_grading_count"]]
+            return 200, course.assignments
+
+        m = match(r"users/(\d+)", rest)
+        if method == "GET" and m:
+            user = course.users.get(int(m.group(1)))
+            return (200, user) if user else NOT_FOUND
+
+        if method == "GET" and rest == "students/submissions":
+            assignment_ids = [int(a) for a in query.get("assignment_ids[]", [])]
+            since = {
+                key: query[key][0]
+                for key in ("submitted_since", "graded_since")
+                if key in query
+            }
+            listing = []
+            for assignment_id in assignment_ids:
+                for submission in course.submissions.get(assignment_id, {}).values():
+                    if any(
+                        (submission[key.replace("_since", "_at")] or "") <= value
+                        for key, value in since.items()
+                    ):
+                        continue
+                    listing.append(self._submission_json(base, submission))
+            return 200, listing
+
+        m = match(r"assignments/(\d+)/submissions(?:/(\d+|update_grades))?", rest)
+        if m:
+            by_user = course.submissions.get(int(m.group(1)))
+            if by_user is None:
+                return NOT_FOUND
+            target = m.group(2)
+            if target is None and method == "GET":
+                return 200, [self._submission_json(base, s) for s in by_user.values()]
+            if target == "update_grades" and method == "POST":
+                with self._lock:
+                    for key, values in form.items():
+                        g = match(r"grade_data\[(\d+)\]\[posted_grade\]", key)
+                        if g and int(g.group(1)) in by_user:
+                            self._grade(by_user[int(g.group(1))], values[0])
+                    progress_id = len(self._progress) + 1
+                    self._progress[progress_id] = 0
+                return 200, {"id": progress_id, "workflow_state": "queued"}
+            submission = None
+            if target and target.isdigit():
+                submission = by_user.get(int(target))
+            if submission is None:
+                return NOT_FOUND
+            if method == "PUT":
+                with self._lock:
+                    if "submission[posted_grade]" in query:
+                        self._grade(submission, query["submission[posted_grade]"][0])
+                    if "comment[text_comment]" in query:
+                        submission.setdefault("comments", []).append(
+                            query["comment[text_comment]"][0]
+                        )
+            return 200, self._submission_json(base, submission)
+
+        return NOT_FOUND
+
+    @staticmethod
+    def _grade(submission: dict, posted_grade: str):
+        try:
+            score = float(posted_grade)
+        except ValueError:
+            score = None
+        if score != score:  # NaN clears the grade
+            score = None
+        submission.update(
+            score=score,
+            grade=None if score is None else str(score),
+            grade_matches_current_submission=True,
+            workflow_state="submitted" if score is None else "graded",
+            graded_at=utils.canvas_timestamp(),
+        )
+
+    def file(self, file_id: int) -> Optional[bytes]:
+        for course in self.courses:
+            if file_id in course.files:
+                return course.files[file_id]
+        return None
+
+    def serve(self, address: Tuple[str, int] = ("127.0.0.1", 0)) -> str:
+        """
+        Serve from a background thread until stop is called
+        :param address: The (host, port) to listen on. Port 0 picks a free port
+        :return: The API base URL, for CANVAS_API_URL
+        """
+        self._server = _ThreadingHTTPServer(address, _handler_for(self))
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler_for(canvas: MockCanvas):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, status: int, body: bytes, headers: Dict[str, str] = None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _dispatch(self, method: str):
+            if canvas.latency:
+                time.sleep(canvas.latency)
+            if not canvas._admit():
+                self._respond(403, b"403 Forbidden (Rate Limit Exceeded)")
+                return
+
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            host = self.headers.get("Host") or "%s:%d" % self.server.server_address[:2]
+            base = f"http://{host}"
+
+            m = re.fullmatch(r"/files/(\d+)/download", url.path)
+            if m:
+                self._send_file(canvas.file(int(m.group(1))), self.headers.get("Range"))
+                return
+
+            form = {}
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                form = parse_qs(self.rfile.read(length).decode("UTF-8"))
+
+            status, body = canvas.handle(method, url.path, query, form, base)
+            headers = {"Content-Type": "application/json; charset=utf-8"}
+
+            if isinstance(body, list) and method == "GET":
+                per_page = min(int(query.get("per_page", ["10"])[0]), 100)
+                page = int(query.get("page", ["1"])[0])
+                if page * per_page < len(body):
+                    next_query = {**query, "page": [str(page + 1)]}
+                    next_url = (
+                        base
+                        + url.path
+                        + "?"
+                        + "&".join(
+                            f"{key}={value}"
+                            for key, values in next_query.items()
+                            for value in values
+                        )
+                    )
+                    headers["Link"] = f'<{next_url}>; rel="next"'
+                body = body[(page - 1) * per_page : page * per_page]
+
+            encoded = json.dumps(body).encode("UTF-8")
+            if method == "GET" and status == 200:
+                etag = '"%s"' % hashlib.sha1(encoded).hexdigest()
+                headers["ETag"] = etag
+                if self.headers.get("If-None-Match") == etag:
+                    self._respond(304, b"", {"ETag": etag})
+                    return
+            self._respond(status, encoded, headers)
+
+        def _send_file(self, data: Optional[bytes], byte_range: Optional[str]):
+            if data is None:
+                self._respond(404, b"")
+                return
+            start = 0
+            m = re.fullmatch(r"bytes=(\d+)-", byte_range or "")
+            if m and int(m.group(1)) < len(data):
+                start = int(m.group(1))
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data) - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            data = data[start:]
+            if canvas.interrupt_after and len(data) > canvas.interrupt_after:
+                self.wfile.write(data[: canvas.interrupt_after])
+                self.close_connection = True
+                return
+            if not canvas.bandwidth:
+                self.wfile.write(data)
+                return
+            chunk = max(int(canvas.bandwidth / 20), 1)
+            for offset in range(0, len(data), chunk):
+                self.wfile.write(data[offset : offset + chunk])
+                time.sleep(chunk / canvas.bandwidth)
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_PUT(self):
+            self._dispatch("PUT")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+    return Handler
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description="Serve synthetic courses the way the Canvas API would"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--courses", type=int, default=1)
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--assignments", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every response"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help="Requests per second before throttling",
+    )
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument(
+        "--bandwidth", type=float, default=0.0, help="Bytes per second per attachment"
+    )
+    parser.add_argument(
+        "--interrupt-after",
+        type=int,
+        default=0,
+        help="Drop attachment downloads after this many bytes, so they must be resumed",
+    )
+    parser.add_argument(
+        "--skeleton",
+        metavar="FILE",
+        help="Also write a skeleton for the synthetic assignments to FILE",
+    )
+    args = parser.parse_args(argv)
+
+    courses = [
+        generate_course(
+            args.students, args.assignments, course_id, args.seed + course_id
+        )
+        for course_id in range(1, args.courses + 1)
+    ]
+    if args.skeleton:
+        with open(args.skeleton, "w") as skeleton_file:
+            json.dump(SYNTHETIC_SKELETON, skeleton_file, indent=4)
+
+    canvas = MockCanvas(
+        courses,
+        args.latency,
+        args.rate_limit,
+        args.burst,
+        args.bandwidth,
+        args.interrupt_after,
+    )
+    api_url = canvas.serve((args.host, args.port))
+    for course in courses:
+        assignment_ids = ", ".join(str(a["id"]) for a in course.assignments)
+        print(f"Serving course {course.course['id']} (assignments {assignment_ids})")
+    print(f"CANVAS_API_URL={api_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        canvas.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import attr
+
+from lib.canvas_api.testing import TestSkeleton
+
+# Bump when the format of cached test plans changes, to discard older caches
+CACHE_VERSION = 3
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class SkeletonCache:
+    """
+    A persistent cache of parsed skeleton files.
+
+    An index records each file's modification time, size, SHA-1 and descriptor, and each
+    test plan (see TestSkeleton.read_plan) is kept in its own file, named by the SHA-1 of
+    the skeleton it came from. A file whose time and size are unchanged is not opened at
+    all, and one that was only touched is read and hashed but not parsed, so listing a
+    large skeleton library costs one stat per file and reads no test plans.
+    Whether the input and expected output files that tests name exist is not cached,
+    but checked every time.
+
+    :param directory: The directory to keep the cache in
+    """
+
+    directory: str
+    _entries: Dict[str, dict] = attr.ib(default=None, init=False, repr=False)
+    _dirty: bool = attr.ib(default=False, init=False, repr=False)
+
+    def _load(self) -> Dict[str, dict]:
+        if self._entries is None:
+            try:
+                with open(self._index_path) as cache_file:
+                    cache = json.load(cache_file)
+                if cache.get("version") != CACHE_VERSION:
+                    raise ValueError("Outdated skeleton cache")
+                self._entries = cache["skeletons"]
+            except (OSError, ValueError, KeyError, AttributeError):
+                self._entries = {}
+        return self._entries
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def _plan_path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest + ".json")
+
+    def save(self):
+        """
+        Write the cache back to disk, if it has changed
+        """
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._index_path + ".new", "w") as cache_file:
+                json.dump(
+                    {"version": CACHE_VERSION, "skeletons": self._entries}, cache_file
+                )
+            os.replace(self._index_path + ".new", self._index_path)
+            self._dirty = False
+        except OSError:
+            pass
+
+    def entry(self, file_path: str) -> Optional[dict]:
+        """
+        The cache entry of a skeleton file, refreshed if the file has changed
+        :return: A dictionary with the file's "sha1", its "descriptor" (None if it is not a
+        valid skeleton) and the "error" that made it invalid, or None if it cannot be read
+        """
+        entry = self._cached_entry(file_path)
+        if entry is None:
+            return None
+        for option, path in entry.get("fixtures", []):
+            if not os.path.isfile(path):
+                return {
+                    **entry,
+                    "descriptor": None,
+                    "error": f'The {option} "{path}" does not exist',
+                }
+        return entry
+
+    def _cached_entry(self, file_path: str) -> Optional[dict]:
+        entries = self._load()
+        key = os.path.abspath(file_path)
+        try:
+            stat = os.stat(key)
+        except OSError:
+            if entries.pop(key, None) is not None:
+                self._dirty = True
+            return None
+
+        entry = entries.get(key)
+        if (
+            entry is not None
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return entry
+
+        try:
+            with open(key, "rb") as skeleton_file:
+                data = skeleton_file.read()
+        except OSError:
+            return None
+        digest = hashlib.sha1(data).hexdigest()
+
+        if (
+            entry is None
+            or entry["sha1"] != digest
+            or (entry["descriptor"] and not os.path.exists(self._plan_path(digest)))
+        ):
+            entry = {"sha1": digest, "descriptor": None, "error": None, "fixtures": []}
+            try:
+                plan = TestSkeleton.read_plan(key, data.decode("UTF-8"))
+                if plan is not None:
+                    # Build the skeleton once, so that invalid tests are caught now.
+                    # Fixture files can come and go without the skeleton changing, so
+                    # entry() checks them instead
+                    skeleton = TestSkeleton.from_plan(plan, key, check_fixtures=False)
+                    entry["fixtures"] = [
+                        (option, getattr(test, option))
+                        for test in skeleton.tests
+                        for option in ("input_file", "expected_file")
+                        if getattr(test, option) is not None
+                    ]
+                    self._store_plan(digest, plan)
+                    entry["descriptor"] = plan["descriptor"]
+            except (ValueError, TypeError) as e:
+                entry["error"] = str(e)
+
+        entry.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        entries[key] = entry
+        self._dirty = True
+        return entry
+
+    def _store_plan(self, digest: str, plan: dict):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._plan_path(digest) + ".new", "w") as plan_file:
+                json.dump(plan, plan_file)
+            os.replace(self._plan_path(digest) + ".new", self._plan_path(digest))
+        except OSError:
+            pass
+
+    def _load_plan(self, digest: str) -> Optional[dict]:
+        try:
+            with open(self._plan_path(digest)) as plan_file:
+                return json.load(plan_file)
+        except (OSError, ValueError):
+            return None
+
+    def descriptors(self, directory: str) -> List[Tuple[str, str]]:
+        """
+        List the valid skeletons in a directory, without building them.
+        Reports invalid skeleton files like TestSkeleton.parse_skeletons does
+        :return: (The skeleton's file path, its descriptor) of each valid skeleton
+        """
+        listed = []
+        for skeleton_file in os.listdir(directory):
+            file_path = os.path.abspath(os.path.join(directory, skeleton_file))
+            entry = self.entry(file_path)
+            if entry is None:
+                continue
+            if entry["error"] is not None:
+                _report(file_path, entry["error"])
+            elif entry["descriptor"] is not None:
+                listed.append((file_path, entry["descriptor"]))
+
+        # Forget files that were removed from the directory
+        directory = os.path.abspath(directory)
+        for key, entry in list(self._entries.items()):
+            if os.path.dirname(key) == directory and not os.path.exists(key):
+                del self._entries[key]
+                self._dirty = True
+                if not any(e["sha1"] == entry["sha1"] for e in self._entries.values()):
+                    try:
+                        os.remove(self._plan_path(entry["sha1"]))
+                    except OSError:
+                        pass
+
+        self.save()
+        return listed
+
+    def skeleton(self, file_path: str) -> Optional[TestSkeleton]:
+        """
+        Load a skeleton through the cache
+        :return: The skeleton, or None if the file is not a valid skeleton
+        """
+        entry = self.entry(file_path)
+        self.save()
+        if entry is None or entry["descriptor"] is None:
+            if entry is not None and entry["error"] is not None:
+                _report(file_path, entry["error"])
+            return None
+        plan = self._load_plan(entry["sha1"])
+        if plan is None:
+            return TestSkeleton.from_file(file_path)
+        try:
+            return TestSkeleton.from_plan(plan, file_path)
+        except ValueError as e:
+            # Such as a fixture file that has been removed since the skeleton was cached
+            _report(file_path, str(e))
+            return None
+
+
+def _report(file_path: str, error: str):
+    print(
+        "There is an error in the",
+        file_path,
+        "skeleton file. This skeleton will not be available",
+    )
+    print("Error:", error)
@@ -1,11 +1,16 @@
+import hashlib
+import mmap
 import re
 import os
 import pathlib
+import shlex
 import subprocess
 import signal
 import json
+import time
+from heapq import heappop, heappush
 from numbers import Real
-from typing import List, Optional, Pattern
+from typing import Callable, List, Optional, Pattern, Sequence, Tuple
 
 import attr
 import toml
@@ -13,6 +18,7 @@ import toml
 # from lib.canvas_api import User
 from lib.canvas_api import utils
 
+from lib.core import instrument
 from lib.core.choices import choose, choose_float
 
 
@@ -27,8 +33,10 @@ class AssignmentTest:
     :param args: List of arguments to pass to the command. Use %s to denote a file name
     :param test_must_pass: If this is true, then no subsequent tests will run if this one fails.
     :param input_str: String to send to stdin
+    :param input_file: A file to stream to stdin instead of input_str
     :param target_file: The file to replace %s with
     :param output_match: An exact string that the output should match. If this and output_regex are None, then this Command always 'matches'
+    :param expected_file: A file whose contents are used as output_match, without loading it into memory
     :param output_regex: A regular expression that the string should match. Combines with output_match.
     If this and output_match are None, then this Command always 'matches'
     :param numeric_match: Enables numeric matching. This overrides string and regex matching
@@ -42,6 +50,7 @@ class AssignmentTest:
     :param print_output: Whether to visibly print the output
     :param negate_match: Whether to negate the result of checking output_match and output_regex
     :param exact_match: Whether the naive string match (output_match) should be an exact check or a substring check
+    :param numeric_ordered: Whether numeric_match's numbers must be found in the order they are listed
     """
 
     command: str
@@ -50,6 +59,8 @@ class AssignmentTest:
     target_file: Optional[str] = None
     output_match: Optional[str] = None
     output_regex: Optional[Pattern] = None
+    input_file: Optional[str] = None
+    expected_file: Optional[str] = None
     numeric_match: Optional[List] = None
     timeout: Optional[int] = None
     fail_comment: Optional[str] = None
@@ -64,27 +75,70 @@ class AssignmentTest:
     negate_match: bool = False
     exact_match: bool = False
     prompt_for_score: bool = False
+    numeric_ordered: bool = False
 
     # The name of the test case
     name: Optional[str] = None
 
+    # numeric_match as (low, high) intervals, in order, and sorted by their low ends
+    _intervals: List[Tuple[float, float]] = attr.ib(
+        default=attr.Factory(list), init=False, repr=False, cmp=False
+    )
+    _sorted_intervals: List[Tuple[float, float]] = attr.ib(
+        default=attr.Factory(list), init=False, repr=False, cmp=False
+    )
+    # ((mtime_ns, size), SHA-256) of expected_file, rehashed when the file changes
+    _expected_digest: Optional[Tuple[Tuple[int, int], bytes]] = attr.ib(
+        default=None, init=False, repr=False, cmp=False
+    )
+
     def __attrs_post_init__(self):
         if self.output_regex is not None:
             self.output_regex = re.compile(re.escape(self.output_regex))
+        if self.numeric_match is not None:
+            self._intervals = [self.parse_interval(spec) for spec in self.numeric_match]
+            self._sorted_intervals = sorted(self._intervals)
+
+    @staticmethod
+    def parse_interval(spec) -> Tuple[float, float]:
+        """
+        Parse one numeric_match value: a number, a [low, high] range,
+        or a "center, difference" string
+        :return: The (low, high) interval of numbers that match it
+        :raises ValueError: If spec is none of these
+        """
+        if isinstance(spec, Real) and not isinstance(spec, bool):
+            return float(spec), float(spec)
+        if isinstance(spec, (list, tuple)) and len(spec) == 2:
+            try:
+                low, high = sorted(float(bound) for bound in spec)
+            except (TypeError, ValueError):
+                pass
+            else:
+                return low, high
+        if isinstance(spec, str):
+            numbers = [float(number) for number in utils.NUM_REGEX.findall(spec)]
+            if len(numbers) == 1:
+                return numbers[0], numbers[0]
+            if len(numbers) == 2:
+                center, diff = numbers[0], abs(numbers[1])
+                return center - diff, center + diff
+        raise ValueError(f"Invalid numeric_match value: {spec!r}")
 
     @classmethod
     def from_json_dict(cls, json_dict: dict):
         if "command" not in json_dict:
             return None
 
-        json_dict["input_str"] = json_dict.pop("input", None)
+        # Skeleton files call it "input"; cached tests (to_json) call it "input_str"
+        json_dict["input_str"] = json_dict.pop("input", json_dict.get("input_str"))
         json_dict["fail_comment"] = json_dict.pop("fail_comment", None)
 
         return AssignmentTest(**json_dict)
 
     @classmethod
-    def target_prompt(cls, command: str):
-        path = pathlib.Path.cwd()
+    def target_prompt(cls, command: str, cwd: str = None):
+        path = pathlib.Path(cwd) if cwd else pathlib.Path.cwd()
         files = [file for file in path.iterdir() if file.is_file()]
 
         if not files:
@@ -96,57 +150,81 @@ class AssignmentTest:
         choice = choose(files, 'Select a file for the "%s" command:' % command)
         return choice.name
 
-    def run(self, user: "User") -> dict:
+    def run(self, user: "User", cwd: str = None, interactive: bool = True) -> dict:
         """
         Runs the Command
+        :param cwd: The directory to run the command in. Default: the current directory
+        :param interactive: Whether the grader can be prompted for input
         :return: A dictionary containing the command's return code, stdout, timeout
         """
+        cwd = cwd or os.getcwd()
         command = self.command
         args = self.args
         filename = self.target_file
-        files = os.listdir(os.getcwd())
+        files = os.listdir(cwd)
 
         if filename is None:
             if (self.single_file and files) or len(files) == 1:
                 filename = files[0]
-            elif self.ask_for_target:
-                filename = AssignmentTest.target_prompt(self.command)
+            elif self.ask_for_target and interactive:
+                filename = AssignmentTest.target_prompt(self.command, cwd)
 
         if not self.include_filetype and filename is not None:
             filename = os.path.splitext(filename)[0]
         if filename is not None:
             if self.print_file:
                 print("--FILE--", file=user.log)
-                with open(filename, "r") as f:
+                with open(os.path.join(cwd, filename), "r") as f:
                     print(f.read(), file=user.log)
                 print("--END FILE--", file=user.log)
             command = self.command.replace("%s", filename)
             args = [arg.replace("%s", filename) for arg in args]
 
-        command_to_send = [command] + args if args else command
-
+        if os.name == "nt":
+            command_to_send = [command] + args if args else command
+        else:
+            # With shell=True, POSIX passes extra list items to the shell, not to the command
+            command_to_send = " ".join([command] + [shlex.quote(arg) for arg in args])
+
+        # Headless runs must never let a submission block on the grader's stdin
+        no_input = None if interactive else subprocess.DEVNULL
+
+        span_name = self.name or self.command
+        input_str = self.input_str
+        stdin = no_input if input_str is None else subprocess.PIPE
+        if self.input_file is not None:
+            # The OS streams the file to the command; it is never read into memory
+            input_str = None
+            stdin = open(self.input_file, "rb")
         try:
             if os.name == "nt":
-                proc = subprocess.run(
-                    command_to_send,
-                    input=self.input_str,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    timeout=self.timeout,
-                    shell=True,
-                    encoding="UTF-8",
-                )
+                with instrument.span("execute", span_name, user_id=user.user_id):
+                    proc = subprocess.run(
+                        command_to_send,
+                        input=input_str,
+                        stdin=stdin if input_str is None else None,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        timeout=self.timeout,
+                        shell=True,
+                        cwd=cwd,
+                        encoding="UTF-8",
+                    )
                 stdout = proc.stdout
             else:
-                proc = subprocess.Popen(
-                    command_to_send,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    shell=True,
-                    preexec_fn=os.setsid,
-                    encoding="UTF-8",
-                )
-                stdout, _ = proc.communicate(input=self.input_str, timeout=self.timeout)
+                with instrument.span("spawn", span_name, user_id=user.user_id):
+                    proc = subprocess.Popen(
+                        command_to_send,
+                        stdin=stdin,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        shell=True,
+                        cwd=cwd,
+                        preexec_fn=os.setsid,
+                        encoding="UTF-8",
+                    )
+                with instrument.span("execute", span_name, user_id=user.user_id):
+                    stdout, _ = proc.communicate(input=input_str, timeout=self.timeout)
 
         except subprocess.TimeoutExpired:
             if os.name == "nt":
@@ -154,53 +232,52 @@ class AssignmentTest:
             else:
                 os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
             return {"timeout": True}
+        finally:
+            if self.input_file is not None:
+                stdin.close()
 
         return {"returncode": proc.returncode, "stdout": stdout, "timeout": False}
 
-    def run_and_match(self, user: "User") -> bool:
+    def run_and_match(
+        self, user: "User", cwd: str = None, interactive: bool = True
+    ) -> bool:
         """
         Runs the command and matches the output to the output_match/regex. If
         neither are defined then this always returns true
 
+        :param cwd: The directory to run the command in. Default: the current directory
+        :param interactive: Whether the grader can be prompted for input
         :return: Whether the output matched or not
         """
-        result = self.run(user)
+        result = self.run(user, cwd, interactive)
 
         if result.get("timeout"):
             return False
 
+        with instrument.span("match", self.name or self.command, user_id=user.user_id):
+            return self._match(user, result)
+
+    def _match(self, user: "User", result: dict) -> bool:
+        """
+        Check the result of run against output_match/output_regex/numeric_match
+        """
         if self.print_output:
             print("\t--OUTPUT--", file=user.log)
             print(result["stdout"], file=user.log)
             print("\n\t--END OUTPUT--", file=user.log)
-        if not any((self.output_match, self.output_regex, self.numeric_match)):
+        if not any(
+            (self.output_match, self.expected_file, self.output_regex, self.numeric_match)
+        ):
             return True
 
         if self.numeric_match is not None:
-            numeric_match = self.numeric_match.copy()
-            extracted_nums = map(float, re.findall(utils.NUM_REGEX, result["stdout"]))
-
-            for number in extracted_nums:
-                for num in numeric_match:
-                    if isinstance(num, str):
-                        numeric_match.remove(num)
-                        try:
-                            center, diff = (
-                                float(x) for x in re.findall(utils.NUM_REGEX, num)
-                            )
-                        except:
-                            continue
-                        num = [center - diff, center + diff]
-                        numeric_match.append(num)
-                    if isinstance(num, list):
-                        low, high = num
-                        if low <= number <= high:
-                            numeric_match.remove(num)
-                    elif isinstance(num, Real):
-                        if number == num:
-                            numeric_match.remove(num)
-
-            return len(numeric_match) == 0
+            if self.numeric_ordered:
+                matched = self._match_numbers_in_order(result["stdout"])
+            else:
+                matched = self._match_numbers(result["stdout"])
+            if matched:
+                print("--Matched numeric comparison--", file=user.log)
+            return matched != self.negate_match
 
         if self.output_regex:
             if self.output_regex.match(result["stdout"]):
@@ -209,8 +286,10 @@ class AssignmentTest:
                     return False
                 return True
 
-        if self.output_match:
-            if self.exact_match:
+        if self.output_match or self.expected_file:
+            if self.expected_file:
+                condition = self._match_expected_file(result["stdout"])
+            elif self.exact_match:
                 condition = self.output_match == result["stdout"]
             else:
                 condition = self.output_match in result["stdout"]
@@ -223,11 +302,80 @@ class AssignmentTest:
 
         return self.negate_match
 
+    def _match_expected_file(self, output: str) -> bool:
+        """
+        Compare output, encoded as UTF-8, with expected_file without reading the file into
+        memory: by size and SHA-256 for exact_match, otherwise by searching the output for
+        the memory-mapped file
+        """
+        data = output.encode("UTF-8")
+        stat = os.stat(self.expected_file)
+        if self.exact_match:
+            if len(data) != stat.st_size:
+                return False
+            return hashlib.sha256(data).digest() == self._expected_file_digest(stat)
+
+        if stat.st_size == 0:
+            return True
+        with open(self.expected_file, "rb") as expected_file:
+            with mmap.mmap(
+                expected_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as expected:
+                return data.find(expected) != -1
+
+    def _expected_file_digest(self, stat: os.stat_result) -> bytes:
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self._expected_digest is None or self._expected_digest[0] != key:
+            digest = hashlib.sha256()
+            with open(self.expected_file, "rb") as expected_file:
+                for chunk in iter(lambda: expected_file.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            self._expected_digest = (key, digest.digest())
+        return self._expected_digest[1]
+
+    def _match_numbers(self, output: str) -> bool:
+        """
+        Whether every interval can be matched by a different number in output, in any order.
+        Sweeps the numbers in ascending order, giving each one to the interval it falls in
+        that ends soonest; an interval that ends before the current number can never match
+        """
+        intervals = self._sorted_intervals
+        numbers = sorted(float(number) for number in utils.NUM_REGEX.findall(output))
+        # The high ends of the intervals that have started but are not matched yet
+        open_ends = []
+        started = matched = 0
+        for number in numbers:
+            while started < len(intervals) and intervals[started][0] <= number:
+                heappush(open_ends, intervals[started][1])
+                started += 1
+            if open_ends and open_ends[0] < number:
+                return False
+            if open_ends:
+                heappop(open_ends)
+                matched += 1
+                if matched == len(intervals):
+                    return True
+        return matched == len(intervals)
+
+    def _match_numbers_in_order(self, output: str) -> bool:
+        """
+        Whether the intervals are matched by numbers in output in the order they are listed.
+        Other numbers may come between them
+        """
+        remaining = iter(self._intervals)
+        low, high = next(remaining, (None, None))
+        for found in utils.NUM_REGEX.finditer(output):
+            if low is None:
+                break
+            if low <= float(found.group()) <= high:
+                low, high = next(remaining, (None, None))
+        return low is None
+
     def to_json(self):
         """
         Encode an AssignmentTest object as a JSON-compatible dictionary.
         """
-        attributes = attr.asdict(self)
+        attributes = attr.asdict(self, filter=lambda attribute, _: attribute.init)
         if self.output_regex:
             attributes["output_regex"] = self.output_regex.pattern
         return attributes
@@ -243,6 +391,9 @@ class TestSkeleton:
     tests: List[AssignmentTest]  # Tests to run in the order that they are added.
     disarm: bool = False  # Whether to actually submit grades/send messages
     file_path: str = ""
+    # Whether tests after the last test_must_pass test may run concurrently for one user.
+    # They share the submission's directory, so skeletons must opt in
+    split_tests: bool = False
 
     @classmethod
     def parse_skeleton(cls, filepath) -> "TestSkeleton":
@@ -273,39 +424,77 @@ class TestSkeleton:
     def from_file(cls, file_path) -> Optional["TestSkeleton"]:
         try:
             with open(file_path) as skeleton_file:
-                try:
-                    if file_path.endswith(".json"):
-                        data = json.load(skeleton_file)
-                    elif file_path.endswith(".toml"):
-                        data = toml.load(skeleton_file)
-                    else:
-                        return None
-                except (json.JSONDecodeError, toml.TomlDecodeError) as e:
-                    print(
-                        "There is an error in the",
-                        file_path,
-                        "skeleton file. This skeleton will not be available",
-                    )
-                    print("Error:", e)
-                    return None
-                try:
-                    descriptor = data["descriptor"]
-                    tests = data["tests"]
-                except KeyError:
-                    return None
-                else:
-                    disarm = data.get("disarm", False)
-                    defaults = data.get("default", {})
-                    test_list = []
-                    for name, json_dict in tests.items():
-                        args = {**defaults, **json_dict, "name": name}
-                        test = AssignmentTest.from_json_dict(args)
-                        if test is not None:
-                            test_list.append(test)
-
-                    return TestSkeleton(descriptor, test_list, disarm, file_path)
+                plan = cls.read_plan(file_path, skeleton_file.read())
+            return None if plan is None else cls.from_plan(plan, file_path)
         except (FileNotFoundError, IOError):
             return None
+        except ValueError as e:
+            print(
+                "There is an error in the",
+                file_path,
+                "skeleton file. This skeleton will not be available",
+            )
+            print("Error:", e)
+            return None
+
+    @classmethod
+    def read_plan(cls, file_path: str, text: str) -> Optional[dict]:
+        """
+        Parse the text of a skeleton file into its test plan: the skeleton's settings,
+        and the arguments of each test with the defaults merged in
+        :param file_path: The skeleton file's path, whose extension picks JSON or TOML
+        :return: The JSON-compatible plan, or None if the file is not a skeleton
+        :raises ValueError: If the file is not valid JSON or TOML
+        """
+        if file_path.endswith(".json"):
+            data = json.loads(text)
+        elif file_path.endswith(".toml"):
+            data = toml.loads(text)
+        else:
+            return None
+        try:
+            descriptor = data["descriptor"]
+            tests = data["tests"]
+        except KeyError:
+            return None
+        defaults = data.get("default", {})
+        return {
+            "descriptor": descriptor,
+            "disarm": data.get("disarm", False),
+            "split_tests": data.get("split_tests", False),
+            "tests": [
+                {**defaults, **json_dict, "name": name}
+                for name, json_dict in tests.items()
+            ],
+        }
+
+    @classmethod
+    def from_plan(
+        cls, plan: dict, file_path: str, check_fixtures: bool = True
+    ) -> "TestSkeleton":
+        """
+        Build a skeleton from a test plan made by read_plan
+        :param check_fixtures: Whether the tests' input_file and expected_file must exist
+        :raises ValueError: If a test's arguments are invalid
+        """
+        test_list = []
+        for args in plan["tests"]:
+            args = dict(args)
+            # Fixture files are found relative to the skeleton file
+            for option in ("input_file", "expected_file"):
+                if args.get(option) is None:
+                    continue
+                args[option] = os.path.join(
+                    os.path.dirname(os.path.abspath(file_path)), args[option]
+                )
+                if check_fixtures and not os.path.isfile(args[option]):
+                    raise ValueError(f'The {option} "{args[option]}" does not exist')
+            test = AssignmentTest.from_json_dict(args)
+            if test is not None:
+                test_list.append(test)
+        return TestSkeleton(
+            plan["descriptor"], test_list, plan["disarm"], file_path, plan["split_tests"]
+        )
 
     @classmethod
     def from_json(cls, jsonobj):
@@ -319,6 +508,7 @@ class TestSkeleton:
                 tests=[AssignmentTest.from_json_dict(test) for test in tests],
                 disarm=jsonobj["disarm"],
                 file_path=jsonobj["file_path"],
+                split_tests=jsonobj.get("split_tests", False),
             )
         except KeyError as e:
             raise ValueError(
@@ -339,33 +529,105 @@ class TestSkeleton:
         self.tests = new_skeleton.tests
         self.disarm = new_skeleton.disarm
         self.file_path = new_skeleton.file_path
+        self.split_tests = new_skeleton.split_tests
         return True
 
-    def run_tests(self, user: "User") -> Optional[Real]:
+    @property
+    def interactive(self) -> bool:
+        """
+        Whether running this skeleton can prompt the grader for input
+        """
+        return any(test.prompt_for_score or test.ask_for_target for test in self.tests)
+
+    def test_key(self, index: int) -> str:
+        """
+        The key a test's run times are recorded under: its name, or its position if it has none
+        """
+        return self.tests[index].name or str(index + 1)
+
+    @property
+    def independent_from(self) -> int:
+        """
+        The index of the first test after the last test_must_pass test.
+        Tests from here on never stop the run, so they can be run in any order
+        """
+        for index in reversed(range(len(self.tests))):
+            if self.tests[index].test_must_pass:
+                return index + 1
+        return 0
+
+    def run_tests(
+        self, user: "User", interactive: bool = True, temp_dir: str = None
+    ) -> Optional[Real]:
+        """
+        Run every test against a user's submission.
+        Does not change the working directory, so users can be graded concurrently.
+        :param interactive: Whether the grader can be prompted for scores and files
+        :param temp_dir: The directory submissions were downloaded to. Default: INSTALL_DIR/.temp
+        :return: The user's total score, or None if the submission could not be accessed
+        """
+        score, _ = self.run_selected(
+            user, range(len(self.tests)), interactive, temp_dir
+        )
+        return score
+
+    def run_selected(
+        self,
+        user: "User",
+        indices: Sequence[int],
+        interactive: bool = True,
+        temp_dir: str = None,
+        should_stop: Callable[[], bool] = None,
+    ) -> Tuple[Optional[Real], bool]:
+        """
+        Run some of the tests against a user's submission, in the given order.
+        The wall time of each test is recorded in user.test_times.
+        :param indices: The indices of the tests to run
+        :param interactive: Whether the grader can be prompted for scores and files
+        :param temp_dir: The directory submissions were downloaded to. Default: INSTALL_DIR/.temp
+        :param should_stop: Checked before each test; the remaining tests are skipped once it returns True
+        :return: (The score of the tests that ran, or None if the submission could not be accessed;
+        False if a test_must_pass test failed or should_stop stopped the run)
+        """
         total_score = 0.0
 
-        try:
-            os.chdir(
-                os.path.join(os.environ["INSTALL_DIR"], ".temp", str(user.user_id))
-            )
-        except (WindowsError, OSError):
+        temp_dir = temp_dir or os.path.join(os.environ["INSTALL_DIR"], ".temp")
+        user_dir = os.path.join(temp_dir, str(user.user_id))
+        if not os.path.isdir(user_dir):
             print(
                 'Could not access files for user "%i". Skipping' % user.user_id,
                 file=user.log,
             )
-            return None
+            return None, False
 
-        for count, test in enumerate(self.tests, 1):
-            print("\n--Running test %i--" % count, file=user.log)
+        for index in indices:
+            if should_stop is not None and should_stop():
+                return total_score, False
+            test = self.tests[index]
+            print("\n--Running test %i--" % (index + 1), file=user.log)
 
-            if test.prompt_for_score:
+            if test.prompt_for_score and interactive:
                 print("\nUser:", user.name)
-            if test.run_and_match(user):
-                if test.prompt_for_score:
+            key = self.test_key(index)
+            instrument.event("test_started", user_id=user.user_id, test=key)
+            started = time.perf_counter()
+            matched = test.run_and_match(user, user_dir, interactive)
+            user.test_times[key] = round(time.perf_counter() - started, 3)
+            instrument.event(
+                "test_finished",
+                user_id=user.user_id,
+                test=key,
+                seconds=user.test_times[key],
+                passed=matched,
+            )
+            if matched:
+                if test.prompt_for_score and interactive:
                     print("Enter the score for this test:")
                     total_score += choose_float(
                         1000, allow_negative=True, allow_zero=True
                     )
+                elif test.prompt_for_score:
+                    print("--Score must be entered by hand--", file=user.log)
                 if test.point_val > 0:
                     print("--Adding %i points--" % test.point_val, file=user.log)
                 elif test.point_val == 0:
@@ -380,11 +642,11 @@ class TestSkeleton:
                 if test.fail_comment:
                     user.comment += test.fail_comment + "\n"
                 if test.test_must_pass:
-                    break
+                    return total_score, False
 
             print("--Current score: %i--" % total_score, file=user.log)
 
-        return total_score
+        return total_score, True
 
     def to_json(self):
         """
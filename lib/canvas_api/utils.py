@@ -26,6 +26,31 @@ def init_tempdir():
         exit(1)
 
 
+def promote_download(user_dir: str):
+    """
+    Replace the files in user_dir with the finished download in user_dir/.new
+    """
+    for cur_file in os.listdir(user_dir):
+        path = os.path.join(user_dir, cur_file)
+        if os.path.isdir(path) and cur_file != ".new":
+            # Such as a directory unpacked from an archive
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+    new_dir = os.path.join(user_dir, ".new")
+    for cur_file in os.listdir(new_dir):
+        shutil.move(os.path.join(new_dir, cur_file), user_dir)
+    os.rmdir(new_dir)
+
+
+def canvas_timestamp(dt: datetime = None) -> str:
+    """
+    Format a UTC datetime (default: now) the way Canvas formats timestamps
+    """
+    return (dt or datetime.utcnow()).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
 def month_year(time_string: str) -> str:
     dt = datetime.strptime(time_string, "%Y-%m-%dT%H:%M:%SZ")
     return dt.strftime("%b %Y")
@@ -0,0 +1,181 @@
+"""
+Suggests test timeouts by timing a skeleton against a reference solution.
+
+A submission that loops forever costs the full timeout of every test it runs, so
+timeouts should be as short as a correct solution allows. calibrate runs every test
+against a known-good solution several times, and suggested_timeout turns the slowest
+run into a timeout with room to spare for slower (but correct) submissions.
+"""
+import json
+import math
+import os
+import re
+import shutil
+import time
+from typing import Dict, List, Optional
+
+import attr
+import toml
+
+from lib.canvas_api import TestSkeleton, User
+
+# A TOML table header such as [tests.compile], and a test's timeout key
+_TOML_TABLE = re.compile(r"\s*\[([^\[\]]+)\]\s*(#.*)?$")
+_TOML_TIMEOUT = re.compile(r"(\s*timeout\s*=\s*)[^\s#]+(.*)$", re.DOTALL)
+
+
+@attr.s(auto_attribs=True)
+class TestTiming:
+    """
+    The calibration runs of one test.
+
+    :param name: The test's key in the skeleton
+    :param timeout: The test's current timeout
+    :param samples: The wall time of each passing run, in seconds
+    :param failures: How many runs failed or timed out
+    """
+
+    name: str
+    timeout: Optional[float]
+    samples: List[float] = attr.Factory(list)
+    failures: int = 0
+
+
+def calibrate(
+    test_skeleton: TestSkeleton, reference_dir: str, work_dir: str, runs: int = 5
+) -> List[TestTiming]:
+    """
+    Run every test against a reference solution several times.
+    Each run starts from a fresh copy of reference_dir, so files the tests create do not carry over.
+    :param reference_dir: A directory laid out like a downloaded submission
+    :param work_dir: A scratch directory to copy the reference solution into
+    :param runs: How many times to run the skeleton
+    """
+    timings = [
+        TestTiming(test_skeleton.test_key(index), test.timeout)
+        for index, test in enumerate(test_skeleton.tests)
+    ]
+    reference = User(0, 0, "reference", None, None, True, 0)
+
+    for _ in range(runs):
+        run_dir = os.path.join(work_dir, "calibration")
+        shutil.rmtree(run_dir, ignore_errors=True)
+        shutil.copytree(reference_dir, run_dir)
+        try:
+            for test, timing in zip(test_skeleton.tests, timings):
+                started = time.perf_counter()
+                passed = test.run_and_match(reference, run_dir, interactive=False)
+                if passed:
+                    timing.samples.append(time.perf_counter() - started)
+                else:
+                    timing.failures += 1
+                    if test.test_must_pass:
+                        break
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    return timings
+
+
+def suggested_timeout(
+    timing: TestTiming, factor: float = 3.0, minimum: int = 1
+) -> Optional[int]:
+    """
+    :param factor: How many times longer than the slowest reference run a submission may take
+    :param minimum: The shortest timeout to suggest, in seconds
+    :return: A timeout in whole seconds, or None if the test never passed
+    """
+    if not timing.samples:
+        return None
+    return max(minimum, math.ceil(max(timing.samples) * factor))
+
+
+def write_timeouts(file_path: str, timeouts: Dict[str, int]):
+    """
+    Set the timeout of tests in a JSON or TOML skeleton file.
+    TOML files are edited in place, so their comments and formatting are kept
+    :param timeouts: The new timeout of each test, by name
+    :raises ValueError: If a TOML test cannot be edited in place, such as one written
+    as an inline table
+    """
+    with open(file_path) as skeleton_file:
+        text = skeleton_file.read()
+    if file_path.endswith(".toml"):
+        data = toml.loads(text)
+    else:
+        data = json.loads(text)
+
+    timeouts = {
+        name: timeout for name, timeout in timeouts.items() if name in data["tests"]
+    }
+    for name, timeout in timeouts.items():
+        data["tests"][name]["timeout"] = timeout
+
+    if file_path.endswith(".toml"):
+        text = _set_toml_timeouts(text, timeouts)
+        if toml.loads(text) != data:
+            raise ValueError(f"{file_path} cannot be edited in place")
+    else:
+        text = json.dumps(data, indent=4)
+
+    with open(file_path + ".new", "w") as skeleton_file:
+        skeleton_file.write(text)
+    os.replace(file_path + ".new", file_path)
+
+
+def _set_toml_timeouts(text: str, timeouts: Dict[str, int]) -> str:
+    """
+    Rewrite the timeout line of each test's [tests.<name>] table, or add one at the end
+    of the table. Every other line is left as it is
+    :raises ValueError: If a test has no table of its own
+    """
+    lines = text.splitlines(keepends=True)
+    # The index of each test's last key, and of its timeout key if it has one
+    last_key: Dict[str, int] = {}
+    timeout_key: Dict[str, int] = {}
+    test = None
+    for index, line in enumerate(lines):
+        header = _TOML_TABLE.match(line)
+        if header:
+            path = _table_path(header.group(1))
+            test = path[1] if len(path) == 2 and path[0] == "tests" else None
+            if test is not None:
+                last_key[test] = index
+            continue
+        if test is None or not line.strip() or line.lstrip().startswith("#"):
+            continue
+        last_key[test] = index
+        if _TOML_TIMEOUT.match(line):
+            timeout_key[test] = index
+
+    missing = [name for name in timeouts if name not in last_key]
+    if missing:
+        raise ValueError(f"no [tests.<name>] table for {', '.join(missing)}")
+
+    # From the bottom up, so that added lines do not move the ones still to edit
+    for name in sorted(timeouts, key=lambda name: last_key[name], reverse=True):
+        if name in timeout_key:
+            index = timeout_key[name]
+            lines[index] = _TOML_TIMEOUT.sub(
+                lambda match: f"{match.group(1)}{timeouts[name]}{match.group(2)}",
+                lines[index],
+            )
+        else:
+            index = last_key[name]
+            if not lines[index].endswith("\n"):
+                lines[index] += "\n"
+            lines.insert(index + 1, f"timeout = {timeouts[name]}\n")
+    return "".join(lines)
+
+
+def _table_path(header: str) -> List[str]:
+    """
+    Split a TOML table header into its keys, unquoting them
+    :param header: The header without its brackets, such as tests."two words"
+    """
+    path = []
+    table = toml.loads(f"[{header}]\n")
+    while table:
+        key, table = next(iter(table.items()))
+        path.append(key)
+    return path
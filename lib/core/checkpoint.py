@@ -0,0 +1,363 @@
+"""
+Crash-safe saving of a grading session's state (its .cachefile).
+
+A checkpoint is a full snapshot of the skeleton and every user, plus a delta of the users
+that changed since the snapshot. A Checkpoint writes the delta in the background, either
+every interval seconds or once max_changes users have been graded, so saving costs one
+write of the changed users rather than a write of the whole session. Once the delta
+covers enough of the users, the next save writes a new snapshot instead.
+
+Every file is written to a temporary file, synced to disk and renamed over the old one,
+so a crash at any point leaves the previous checkpoint intact. Snapshots, deltas and
+logs are compressed (see lib/core/storage.py), and a snapshot can also save the
+grader's workspace as one compressed tar file.
+"""
+import json
+import lzma
+import os
+import shutil
+import threading
+import uuid
+from typing import Dict, List, Optional
+
+import attr
+
+from lib.canvas_api import PyCanvasGrader, TestSkeleton, User
+from lib.core import instrument, storage
+
+SNAPSHOT_FILE = ".cachefile"
+DELTA_FILE = ".cachefile.delta"
+# The saved workspace, without its logs
+WORKSPACE_FILE = "workspace.tar"
+# The saved logs
+LOGS_DIR = ".logs"
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Replace a file's contents so that, even after a crash, it holds either the old
+    contents or the new ones
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+    storage.sync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def copy_atomic(source: str, path: str):
+    """
+    Copy a file over path the way write_atomic writes one, keeping its modification time
+    """
+    temp_path = path + ".tmp"
+    shutil.copy2(source, temp_path)
+    with open(temp_path, "r+b") as temp_file:
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+    storage.sync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def read_state(directory: str) -> dict:
+    """
+    Read the session state saved in a directory, with the latest delta applied
+    :return: The state's "skeleton", "users" and "last_sync"
+    :raises OSError: If there is no saved state
+    :raises ValueError: If the saved state is invalid
+    """
+    state = _read_json(os.path.join(directory, SNAPSHOT_FILE))
+    try:
+        delta = _read_json(os.path.join(directory, DELTA_FILE))
+    except (OSError, ValueError, EOFError):
+        return state
+
+    # A delta left over from before the latest snapshot is already part of it
+    if delta.get("snapshot") is None or delta["snapshot"] != state.get("snapshot"):
+        return state
+    changed = delta["users"]
+    users = [changed.pop(str(user["user_id"]), user) for user in state["users"]]
+    return {
+        **state,
+        "skeleton": delta["skeleton"],
+        "users": users + list(changed.values()),
+        "last_sync": delta["last_sync"],
+    }
+
+
+def _read_json(path: str):
+    with open(path, "rb") as json_file:
+        try:
+            return json.loads(storage.decompress(json_file.read()).decode("UTF-8"))
+        except lzma.LZMAError as e:
+            raise ValueError(f"{path} is corrupt") from e
+
+
+def restore_workspace(directory: str, temp_dir: str):
+    """
+    Unpack the workspace and logs saved in directory into temp_dir
+    """
+    workspace = os.path.join(directory, WORKSPACE_FILE)
+    if os.path.exists(workspace):
+        storage.extract(workspace, temp_dir)
+    else:
+        # Saved by an older version, as a plain copy
+        shutil.copytree(os.path.join(directory, ".temp"), temp_dir)
+
+    saved_logs = os.path.join(directory, LOGS_DIR)
+    if not os.path.isdir(saved_logs):
+        return
+    log_dir = os.path.join(temp_dir, ".logs")
+    os.makedirs(log_dir, exist_ok=True)
+    for name in os.listdir(saved_logs):
+        if name.endswith(".tmp"):
+            continue
+        with open(os.path.join(saved_logs, name), "rb") as saved:
+            data = saved.read()
+        with open(os.path.join(log_dir, name), "wb") as log_file:
+            # Log segments are gzip files already
+            log_file.write(data if name.endswith(".gz") else storage.decompress(data))
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class Checkpoint:
+    """
+    Saves a session's state to a directory, writing only the users that changed.
+
+    Changes are found by comparing each user's JSON with what was last written, so
+    nothing has to report them; changed() only makes the next save happen sooner.
+
+    :param directory: The directory to save the state in, such as .cache/<course>/<assignment>
+    :param grader: The session's grader, for its workspace and last sync time
+    :param test_skeleton: The session's skeleton
+    :param users: The session's users. Users appended later are saved too
+    :param interval: Seconds between background saves
+    :param max_changes: How many calls to changed() trigger a background save early
+    :param compression: The codec to save with (see storage.CODECS)
+    """
+
+    directory: str
+    grader: PyCanvasGrader
+    test_skeleton: TestSkeleton
+    users: List[User]
+    interval: float = 30.0
+    max_changes: int = 20
+    compression: str = "zlib"
+    # Each user's JSON as it was last written, by user id
+    _written: Dict[int, str] = attr.ib(default=attr.Factory(dict), init=False)
+    # The users in the current delta file, by user id
+    _delta: Dict[str, dict] = attr.ib(default=attr.Factory(dict), init=False)
+    _snapshot_id: Optional[str] = attr.ib(default=None, init=False)
+    _changes: int = attr.ib(default=0, init=False)
+    _lock: threading.Lock = attr.ib(default=attr.Factory(threading.Lock), init=False)
+    _wake: threading.Condition = attr.ib(
+        default=attr.Factory(threading.Condition), init=False
+    )
+    _thread: Optional[threading.Thread] = attr.ib(default=None, init=False)
+    _stopped: bool = attr.ib(default=False, init=False)
+
+    def start(self) -> "Checkpoint":
+        """
+        Start saving in the background
+        """
+        self._stopped = False
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop saving in the background, after one last save
+        """
+        with self._wake:
+            self._stopped = True
+            self._wake.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def changed(self, count: int = 1):
+        """
+        Note that users have changed, saving in the background after max_changes of them
+        """
+        with self._wake:
+            self._changes += count
+            if self._changes >= self.max_changes:
+                self._wake.notify_all()
+
+    def _run(self):
+        while True:
+            with self._wake:
+                self._wake.wait_for(
+                    lambda: self._stopped or self._changes >= self.max_changes,
+                    self.interval,
+                )
+                self._changes = 0
+                stopped = self._stopped
+            self.save()
+            if stopped:
+                return
+
+    def snapshot(self, workspace: bool = False):
+        """
+        Write every user, replacing the delta
+        :param workspace: Whether to also save the grader's workspace (the submissions
+        and logs)
+        """
+        with self._lock:
+            if workspace:
+                with instrument.span("state", "save workspace"):
+                    self._copy_workspace()
+            with instrument.span("state", "save cachefile", users=len(self.users)):
+                self._write_snapshot()
+
+    def _copy_workspace(self):
+        os.makedirs(self.grader.temp_dir, exist_ok=True)
+        os.makedirs(self.directory, exist_ok=True)
+        storage.archive(
+            self.grader.temp_dir,
+            os.path.join(self.directory, WORKSPACE_FILE),
+            self.compression,
+            exclude=".logs",
+        )
+        for user in list(self.users):
+            self._copy_log(user)
+        # Plain copies saved by older versions
+        for legacy in (".temp", ".temp.new", ".temp.old"):
+            shutil.rmtree(os.path.join(self.directory, legacy), ignore_errors=True)
+
+    def save(self, timeout: float = -1) -> bool:
+        """
+        Write the users that changed since they were last written
+        :param timeout: Seconds to wait for a save that is already being written.
+        Default: as long as it takes
+        :return: Whether the state was saved before the timeout
+        """
+        if not self._lock.acquire(timeout=timeout):
+            return False
+        try:
+            self._write_delta()
+        finally:
+            self._lock.release()
+        return True
+
+    def _serialized(self) -> Dict[int, str]:
+        serialized = {}
+        for user in list(self.users):
+            serialized[user.user_id] = self._written.get(user.user_id)
+            # A user being graded can change while it is read, which is retried
+            for _ in range(3):
+                try:
+                    user_json = json.dumps(user.to_json(), sort_keys=True)
+                except RuntimeError:
+                    continue
+                serialized[user.user_id] = user_json
+                break
+        return serialized
+
+    def _write_snapshot(self):
+        serialized = self._serialized()
+        snapshot_id = uuid.uuid4().hex
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomic(
+            os.path.join(self.directory, SNAPSHOT_FILE),
+            self._encode(
+                {
+                    "skeleton": self.test_skeleton.to_json(),
+                    "users": [
+                        json.loads(user_json)
+                        for user_json in serialized.values()
+                        if user_json is not None
+                    ],
+                    "last_sync": self.grader.last_sync,
+                    "snapshot": snapshot_id,
+                }
+            ),
+        )
+        try:
+            os.remove(os.path.join(self.directory, DELTA_FILE))
+        except FileNotFoundError:
+            pass
+        self._written = serialized
+        self._delta = {}
+        self._snapshot_id = snapshot_id
+        storage.touch(self.directory)
+
+    def _encode(self, state: dict) -> bytes:
+        return storage.compress(json.dumps(state).encode("UTF-8"), self.compression)
+
+    def _write_delta(self):
+        serialized = self._serialized()
+        dirty = [
+            user
+            for user in list(self.users)
+            if serialized[user.user_id] != self._written.get(user.user_id)
+        ]
+        if not dirty:
+            return
+
+        # Without a snapshot of our own, or once the delta is large, write everything
+        if self._snapshot_id is None or len(self._delta) + len(dirty) > max(
+            len(self.users) // 2, self.max_changes
+        ):
+            self._write_snapshot()
+            for user in dirty:
+                self._copy_log(user)
+            return
+
+        for user in dirty:
+            self._delta[str(user.user_id)] = json.loads(serialized[user.user_id])
+            self._copy_log(user)
+        write_atomic(
+            os.path.join(self.directory, DELTA_FILE),
+            self._encode(
+                {
+                    "skeleton": self.test_skeleton.to_json(),
+                    "users": self._delta,
+                    "last_sync": self.grader.last_sync,
+                    "snapshot": self._snapshot_id,
+                }
+            ),
+        )
+        for user in dirty:
+            self._written[user.user_id] = serialized[user.user_id]
+        storage.touch(self.directory)
+
+    def _copy_log(self, user: User):
+        """
+        Save a user's stored log, so that it matches the user's saved grade.
+        Compressed segments are copied as they are; the rest of the log is compressed
+        """
+        if user.log.path is None:
+            return
+        saved_dir = os.path.join(self.directory, LOGS_DIR)
+        os.makedirs(saved_dir, exist_ok=True)
+        log_files = {os.path.basename(path): path for path in user.log.files()}
+        name = os.path.basename(user.log.path)
+        for saved in os.listdir(saved_dir):
+            if saved.startswith(name) and saved not in log_files:
+                os.remove(os.path.join(saved_dir, saved))
+        for log_name, path in log_files.items():
+            saved = os.path.join(saved_dir, log_name)
+            if log_name.endswith(".gz"):
+                # Segments only change if the log is cleared and grows again
+                if not _same_file(path, saved):
+                    copy_atomic(path, saved)
+                continue
+            with open(path, "rb") as log_file:
+                write_atomic(saved, storage.compress(log_file.read(), self.compression))
+
+
+def _same_file(path: str, copy: str) -> bool:
+    """
+    :return: Whether copy has the size and modification time of the file at path
+    """
+    try:
+        original, copied = os.stat(path), os.stat(copy)
+    except OSError:
+        return False
+    return (original.st_size, original.st_mtime_ns) == (
+        copied.st_size,
+        copied.st_mtime_ns,
+    )
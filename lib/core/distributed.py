@@ -0,0 +1,364 @@
+"""
+Grading across several machines.
+
+A Coordinator owns the grading session and serves grading units over a socket:
+the user to grade, the files of their submission, and the skeleton to grade them with,
+along with the skeleton's input and expected output files.
+Any number of workers (run_worker) connect to it, run the tests in a scratch
+directory, and send back the score, the comment and the test log.
+
+Connections are authenticated with a shared key. Workers run whatever commands
+the coordinator's skeletons contain, so the key must be kept secret.
+
+A unit that fails on a worker is reported back as a failed result. A unit whose worker
+disconnects is handed to another worker, up to MAX_ATTEMPTS times in all.
+"""
+import os
+import queue
+import shutil
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Callable, Dict, List, Optional, Tuple
+
+import attr
+
+from lib.canvas_api import TestSkeleton, User
+
+Address = Tuple[str, int]
+
+# How many workers may disconnect while grading a unit before it is given up on
+MAX_ATTEMPTS = 3
+# The test options that name a fixture file on the coordinator
+FIXTURE_OPTIONS = ("input_file", "expected_file")
+
+
+def parse_address(address: str) -> Address:
+    """
+    Parse an address of the form HOST:PORT
+    """
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def read_submission(user_dir: str) -> Dict[str, bytes]:
+    """
+    :return: Every file in user_dir, keyed by its path relative to user_dir
+    """
+    files = {}
+    for root, dirs, filenames in os.walk(user_dir):
+        dirs[:] = [d for d in dirs if d != ".new"]
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, user_dir)] = f.read()
+    return files
+
+
+def write_submission(user_dir: str, files: Dict[str, bytes]):
+    for relpath, data in files.items():
+        path = os.path.join(user_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def read_fixtures(test_skeleton: TestSkeleton) -> Dict[str, bytes]:
+    """
+    :return: Every fixture file that the skeleton's tests use, keyed by its path
+    """
+    fixtures = {}
+    for test in test_skeleton.tests:
+        for option in FIXTURE_OPTIONS:
+            path = getattr(test, option)
+            if path is not None and path not in fixtures:
+                with open(path, "rb") as f:
+                    fixtures[path] = f.read()
+    return fixtures
+
+
+def write_fixtures(
+    test_skeleton: TestSkeleton, fixtures: Dict[str, bytes], fixture_dir: str
+):
+    """
+    Write a skeleton's fixture files into fixture_dir, and point its tests at them
+    :param fixtures: The fixture files, keyed by their path on the coordinator
+    """
+    os.makedirs(fixture_dir, exist_ok=True)
+    local_paths = {}
+    for index, (path, data) in enumerate(fixtures.items()):
+        # Numbered, as fixtures from different directories can share a name
+        name = f"{index}-{os.path.basename(path)}"
+        local_paths[path] = os.path.join(fixture_dir, name)
+        with open(local_paths[path], "wb") as f:
+            f.write(data)
+    for test in test_skeleton.tests:
+        for option in FIXTURE_OPTIONS:
+            path = getattr(test, option)
+            if path is not None:
+                setattr(test, option, local_paths[path])
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class _Unit:
+    user: User
+    test_skeleton: TestSkeleton
+    temp_dir: Optional[str]
+    on_result: Optional[Callable[[User], None]]
+    # How many workers have disconnected while grading this unit
+    attempts: int = 0
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class Coordinator:
+    """
+    Hands out grading units to remote workers and applies their results.
+
+    :param address: The (host, port) to listen on. Port 0 picks a free port
+    :param authkey: The key that workers must present
+    """
+
+    address: Address
+    authkey: bytes = attr.ib(repr=False)
+
+    _listener: Optional[Listener] = attr.ib(default=None, init=False, repr=False)
+    _units: "queue.Queue[_Unit]" = attr.ib(
+        default=attr.Factory(queue.Queue), init=False, repr=False
+    )
+    _outstanding: int = attr.ib(default=0, init=False, repr=False)
+    _changed: threading.Condition = attr.ib(
+        default=attr.Factory(threading.Condition), init=False, repr=False
+    )
+    _closed: bool = attr.ib(default=False, init=False, repr=False)
+
+    def start(self):
+        """
+        Start accepting workers in the background
+        """
+        self._listener = Listener(self.address, authkey=self.authkey)
+        self.address = self._listener.address
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        """
+        Stop accepting workers; connected workers are told to stop when they ask for more work
+        """
+        self._closed = True
+        if self._listener is not None:
+            self._listener.close()
+
+    def submit(
+        self,
+        user: User,
+        test_skeleton: TestSkeleton,
+        temp_dir: str = None,
+        on_result: Callable[[User], None] = None,
+    ):
+        """
+        Queue a user to be graded by the next free worker
+        :param temp_dir: The directory the user's submission was downloaded to. Default: INSTALL_DIR/.temp
+        :param on_result: Called with the user once their result has been applied
+        """
+        with self._changed:
+            self._outstanding += 1
+        self._units.put(_Unit(user, test_skeleton, temp_dir, on_result))
+
+    def grade(self, users: List[User], test_skeleton: TestSkeleton, temp_dir: str = None):
+        """
+        Grade users on the connected workers and wait until every result is in
+        """
+        for user in users:
+            self.submit(user, test_skeleton, temp_dir)
+        self.join()
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Wait until every submitted user has been graded
+        :return: False if the timeout expired first
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self._outstanding == 0, timeout)
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (AuthenticationError, EOFError, OSError, ValueError):
+                # Closed, or a client that failed authentication or broke off the
+                # handshake; other workers can still connect
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _next_unit(self) -> Optional[_Unit]:
+        while not self._closed:
+            try:
+                return self._units.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def _serve(self, conn: Connection):
+        # Skeletons this worker already has, by id
+        sent_skeletons = set()
+        unit = None
+        try:
+            conn.recv()  # ready
+            while True:
+                unit = self._next_unit()
+                if unit is None:
+                    conn.send({"type": "stop"})
+                    return
+
+                skeleton_id = id(unit.test_skeleton)
+                if skeleton_id not in sent_skeletons:
+                    conn.send(
+                        {
+                            "type": "skeleton",
+                            "id": skeleton_id,
+                            "skeleton": unit.test_skeleton.to_json(),
+                            "fixtures": read_fixtures(unit.test_skeleton),
+                        }
+                    )
+                    sent_skeletons.add(skeleton_id)
+
+                temp_dir = unit.temp_dir or os.path.join(
+                    os.environ["INSTALL_DIR"], ".temp"
+                )
+                user = unit.user
+                conn.send(
+                    {
+                        "type": "unit",
+                        "skeleton": skeleton_id,
+                        # The worker starts a fresh log; it is appended to ours afterwards
+                        "user": {**user.to_json(), "log": ""},
+                        "files": read_submission(
+                            os.path.join(temp_dir, str(user.user_id))
+                        ),
+                    }
+                )
+                result = conn.recv()
+                self._apply(unit, result)
+                unit = None
+        except (EOFError, OSError):
+            # The worker went away; give its unit to someone else
+            if unit is not None:
+                self._retry(unit)
+        finally:
+            conn.close()
+
+    def _retry(self, unit: _Unit):
+        unit.attempts += 1
+        if unit.attempts < MAX_ATTEMPTS:
+            self._units.put(unit)
+            return
+        self._apply(
+            unit,
+            failed_result(
+                unit.user.user_id,
+                unit.user.comment,
+                f"{unit.attempts} workers disconnected while grading",
+            ),
+        )
+
+    def _apply(self, unit: _Unit, result: dict):
+        user = unit.user
+        user.log.write(result["log"])
+        user.log.flush()
+        user.comment = result["comment"]
+        if result["grade"] is not None:
+            user.grade = result["grade"]
+            user.needs_regrade = False
+        user.test_times.update(result.get("test_times", {}))
+        if unit.on_result is not None:
+            unit.on_result(user)
+        with self._changed:
+            self._outstanding -= 1
+            self._changed.notify_all()
+
+
+def run_worker(address: Address, authkey: bytes, work_dir: str) -> int:
+    """
+    Grade units from a coordinator until it has no more work
+    :param work_dir: A scratch directory for submissions and fixture files
+    :return: The number of users graded
+    """
+    conn = Client(address, authkey=authkey)
+    conn.send({"type": "ready", "pid": os.getpid()})
+    skeletons = {}
+    graded = 0
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+
+            if message["type"] == "stop":
+                break
+            elif message["type"] == "skeleton":
+                test_skeleton = TestSkeleton.from_json(message["skeleton"])
+                write_fixtures(
+                    test_skeleton,
+                    message["fixtures"],
+                    os.path.join(work_dir, ".fixtures", str(message["id"])),
+                )
+                skeletons[message["id"]] = test_skeleton
+            elif message["type"] == "unit":
+                try:
+                    result = grade_unit(
+                        message, skeletons[message["skeleton"]], work_dir
+                    )
+                except Exception as e:
+                    # Reported, so that the coordinator does not hand the unit out again
+                    result = failed_result(
+                        message["user"]["user_id"], message["user"]["comment"], str(e)
+                    )
+                else:
+                    graded += 1
+                conn.send(result)
+    finally:
+        conn.close()
+        shutil.rmtree(os.path.join(work_dir, ".fixtures"), ignore_errors=True)
+    return graded
+
+
+def grade_unit(unit: dict, test_skeleton: TestSkeleton, work_dir: str) -> dict:
+    """
+    Grade one unit in work_dir, then remove its files
+    :return: The result message for the coordinator
+    """
+    user = User.from_json(unit["user"])
+    user_dir = os.path.join(work_dir, str(user.user_id))
+    write_submission(user_dir, unit["files"])
+
+    started = time.time()
+    try:
+        grade = test_skeleton.run_tests(user, interactive=False, temp_dir=work_dir)
+    finally:
+        shutil.rmtree(user_dir, ignore_errors=True)
+
+    return {
+        "user_id": user.user_id,
+        "grade": grade,
+        "comment": user.comment,
+        "log": user.log.getvalue(),
+        "test_times": user.test_times,
+        "seconds": time.time() - started,
+    }
+
+
+def failed_result(user_id: int, comment: str, error: str) -> dict:
+    """
+    :param comment: The user's comment before grading, which is left as it was
+    :return: The result message for a unit that could not be graded. The user's grade
+    is left as it was
+    """
+    return {
+        "user_id": user_id,
+        "grade": None,
+        "comment": comment,
+        "log": "--Grading failed: %s--\n" % error,
+        "test_times": {},
+        "seconds": 0.0,
+    }
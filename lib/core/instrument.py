@@ -0,0 +1,213 @@
+"""
+Opt-in timing of what a grading session spends its time on.
+
+Code that does something worth timing wraps it in span(phase, name), and code that does
+something worth counting calls event(name, ...). Nothing is recorded until a listener is
+added, so an uninstrumented run pays for one empty-list check per span or event.
+Profiler is a span listener that keeps every span, and exports them as Chrome trace events
+(open the file in chrome://tracing or https://ui.perfetto.dev) or as a summary table.
+lib.core.monitoring has the event log and metrics listeners.
+
+Phases:
+    api      - a Canvas API request, including rate-limit waits and retries
+    download - streaming one attachment to disk
+    spawn    - starting a test's subprocess
+    execute  - waiting for a test's subprocess to finish
+    match    - checking a test's output
+    state    - saving or loading the session cache
+
+Events:
+    submission_downloaded - user_id, attachments, bytes
+    attachment_downloaded - user_id, filename, bytes, seconds, resumed_from (bytes already
+                            on disk from an interrupted download), retries
+    test_started          - user_id, test
+    test_finished         - user_id, test, seconds, passed
+    user_graded           - user_id, grade, queued (users still waiting to be graded)
+    grade_posted          - user_id, grade
+    api_throttled         - url, attempt, wait (seconds before the retry)
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+import attr
+
+
+@attr.s(auto_attribs=True)
+class Span:
+    """
+    One timed operation.
+
+    :param phase: What kind of operation this was (see the module docstring)
+    :param name: Which operation this was, such as the API path or the test name
+    :param start: When the operation started, in seconds on the time.perf_counter clock
+    :param duration: How long the operation took, in seconds
+    :param thread: The identifier of the thread that ran the operation
+    :param args: Extra details about the operation
+    """
+
+    phase: str
+    name: str
+    start: float
+    duration: float
+    thread: int
+    args: Dict = attr.Factory(dict)
+
+
+@attr.s(auto_attribs=True)
+class Event:
+    """
+    Something that happened.
+
+    :param name: What happened (see the module docstring)
+    :param time: When it happened, in seconds since the epoch
+    :param fields: Details of what happened
+    """
+
+    name: str
+    time: float
+    fields: Dict = attr.Factory(dict)
+
+
+_listeners: List[Callable[[Span], None]] = []
+_event_listeners: List[Callable[[Event], None]] = []
+
+
+def add_listener(listener: Callable[[Span], None]):
+    """
+    Call listener with every span that finishes from now on, from the thread that ran it
+    """
+    _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[Span], None]):
+    _listeners.remove(listener)
+
+
+def add_event_listener(listener: Callable[[Event], None]):
+    """
+    Call listener with every event from now on, from the thread that caused it
+    """
+    _event_listeners.append(listener)
+
+
+def remove_event_listener(listener: Callable[[Event], None]):
+    _event_listeners.remove(listener)
+
+
+def enabled() -> bool:
+    return bool(_listeners)
+
+
+def event(name: str, **fields):
+    """
+    Report that something happened
+    :param fields: Details of what happened; must be JSON-compatible
+    """
+    if not _event_listeners:
+        return
+    happened = Event(name, time.time(), fields)
+    for listener in list(_event_listeners):
+        listener(happened)
+
+
+@contextmanager
+def span(phase: str, name: str, **args) -> Iterator[Dict]:
+    """
+    Time the body of a with statement.
+    :param args: Extra details to record with the span
+    :return: The span's args, so the body can add details it learns along the way
+    """
+    if not _listeners:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        finished = Span(
+            phase,
+            name,
+            start,
+            time.perf_counter() - start,
+            threading.get_ident(),
+            args,
+        )
+        for listener in list(_listeners):
+            listener(finished)
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class Profiler:
+    """
+    Keeps every span recorded while it is listening.
+    """
+
+    spans: List[Span] = attr.Factory(list)
+    _lock: threading.Lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+    _origin: float = attr.ib(default=attr.Factory(time.perf_counter), repr=False)
+
+    def __call__(self, finished: Span):
+        with self._lock:
+            self.spans.append(finished)
+
+    def start(self) -> "Profiler":
+        add_listener(self)
+        return self
+
+    def stop(self):
+        if self in _listeners:
+            remove_listener(self)
+
+    def chrome_trace(self) -> dict:
+        """
+        :return: The spans in the Chrome trace event format, as a JSON-compatible dictionary
+        """
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": s.name,
+                    "cat": s.phase,
+                    "ph": "X",
+                    "ts": round((s.start - self._origin) * 1e6),
+                    "dur": round(s.duration * 1e6),
+                    "pid": pid,
+                    "tid": s.thread,
+                    "args": s.args,
+                }
+                for s in spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def summary(self, top: int = 10) -> str:
+        """
+        :param top: How many of the slowest operations to list for each phase
+        :return: A table of the time spent in each phase, and the slowest operations in each
+        """
+        with self._lock:
+            spans = list(self.spans)
+        by_phase = {}
+        for s in spans:
+            by_phase.setdefault(s.phase, []).append(s)
+
+        lines = [f"{'phase':<10}{'count':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+        for phase, phase_spans in sorted(
+            by_phase.items(), key=lambda item: -sum(s.duration for s in item[1])
+        ):
+            total = sum(s.duration for s in phase_spans)
+            lines.append(
+                f"{phase:<10}{len(phase_spans):>8}{total:>10.3f}"
+                f"{total / len(phase_spans) * 1000:>10.1f}"
+                f"{max(s.duration for s in phase_spans) * 1000:>10.1f}"
+            )
+        for phase, phase_spans in sorted(by_phase.items()):
+            lines.append(f"\nSlowest {phase}:")
+            for s in sorted(phase_spans, key=lambda s: -s.duration)[:top]:
+                lines.append(f"{s.duration * 1000:>10.1f} ms  {s.name}")
+        return "\n".join(lines)
@@ -0,0 +1,253 @@
+"""
+Outside visibility into long-running grading: a JSON-lines event log and Prometheus metrics.
+
+Both are listeners on lib.core.instrument, so they see exactly the spans and events
+that the profiler sees, and cost nothing unless they are started.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Optional, TextIO, Tuple
+
+import attr
+
+from lib.core import instrument
+
+# Upper bounds, in seconds, of the buckets of every histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class EventLog:
+    """
+    Writes every event to a file as one JSON object per line:
+    {"time": ..., "event": ..., <the event's fields>}
+
+    :param path: The file to append to
+    """
+
+    path: str
+    _file: Optional[TextIO] = attr.ib(default=None, init=False, repr=False)
+    _lock: threading.Lock = attr.ib(
+        default=attr.Factory(threading.Lock), init=False, repr=False
+    )
+
+    def __call__(self, happened: instrument.Event):
+        line = json.dumps(
+            {"time": round(happened.time, 3), "event": happened.name, **happened.fields},
+            default=str,
+        )
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def start(self) -> "EventLog":
+        self._file = open(self.path, "a", buffering=1)
+        instrument.add_event_listener(self)
+        return self
+
+    def stop(self):
+        instrument.remove_event_listener(self)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in labels
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class _Histogram:
+    counts: List[int] = attr.Factory(lambda: [0] * len(BUCKETS))
+    total: float = 0.0
+    count: int = 0
+
+    def observe(self, seconds: float):
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class Metrics:
+    """
+    Counters, gauges and histograms of a grading run, in the Prometheus text format.
+    """
+
+    _counters: Dict[Tuple[str, tuple], float] = attr.ib(
+        default=attr.Factory(dict), init=False, repr=False
+    )
+    _gauges: Dict[Tuple[str, tuple], float] = attr.ib(
+        default=attr.Factory(dict), init=False, repr=False
+    )
+    _histograms: Dict[Tuple[str, tuple], _Histogram] = attr.ib(
+        default=attr.Factory(dict), init=False, repr=False
+    )
+    _lock: threading.Lock = attr.ib(
+        default=attr.Factory(threading.Lock), init=False, repr=False
+    )
+    _server: Optional[HTTPServer] = attr.ib(default=None, init=False, repr=False)
+
+    # Help text of every metric, which also fixes the order they are rendered in
+    HELP = {
+        "pycanvasgrader_submissions_downloaded_total": "Submissions downloaded",
+        "pycanvasgrader_downloaded_bytes_total": "Bytes of attachments downloaded",
+        "pycanvasgrader_attachment_download_seconds": "Wall time of each attachment download",
+        "pycanvasgrader_download_retries_total": "Attachment downloads resumed after an interruption",
+        "pycanvasgrader_download_resumed_bytes_total": "Bytes of attachments not downloaded again thanks to resuming",
+        "pycanvasgrader_users_graded_total": "Users whose tests have all run",
+        "pycanvasgrader_grading_queue_depth": "Users waiting to be graded",
+        "pycanvasgrader_tests_total": "Tests run, by test and whether they passed",
+        "pycanvasgrader_test_duration_seconds": "Wall time of each test",
+        "pycanvasgrader_grades_posted_total": "Grades posted to Canvas",
+        "pycanvasgrader_api_requests_total": "Canvas API requests, by method and status",
+        "pycanvasgrader_api_errors_total": "Canvas API requests that failed or returned an error status",
+        "pycanvasgrader_api_request_duration_seconds": "Wall time of Canvas API requests, including retries",
+        "pycanvasgrader_api_throttled_total": "Canvas API requests rejected by the rate limit",
+    }
+
+    def _count(self, name: str, labels: tuple = (), amount: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def _observe(self, name: str, labels: tuple, seconds: float):
+        self._histograms.setdefault((name, labels), _Histogram()).observe(seconds)
+
+    def on_span(self, finished: instrument.Span):
+        if finished.phase != "api":
+            return
+        method = finished.name.split(" ", 1)[0]
+        status = str(finished.args.get("status", "error"))
+        with self._lock:
+            self._count(
+                "pycanvasgrader_api_requests_total",
+                (("method", method), ("status", status)),
+            )
+            if status == "error" or int(status) >= 400:
+                self._count("pycanvasgrader_api_errors_total", (("method", method),))
+            self._observe(
+                "pycanvasgrader_api_request_duration_seconds",
+                (("method", method),),
+                finished.duration,
+            )
+
+    def on_event(self, happened: instrument.Event):
+        fields = happened.fields
+        with self._lock:
+            if happened.name == "submission_downloaded":
+                self._count("pycanvasgrader_submissions_downloaded_total")
+                self._count("pycanvasgrader_downloaded_bytes_total", (), fields["bytes"])
+            elif happened.name == "attachment_downloaded":
+                self._observe(
+                    "pycanvasgrader_attachment_download_seconds", (), fields["seconds"]
+                )
+                self._count(
+                    "pycanvasgrader_download_retries_total", (), fields["retries"]
+                )
+                self._count(
+                    "pycanvasgrader_download_resumed_bytes_total",
+                    (),
+                    fields["resumed_from"],
+                )
+            elif happened.name == "test_finished":
+                test = (("test", fields["test"]),)
+                self._count(
+                    "pycanvasgrader_tests_total",
+                    test + (("passed", str(fields["passed"]).lower()),),
+                )
+                self._observe(
+                    "pycanvasgrader_test_duration_seconds", test, fields["seconds"]
+                )
+            elif happened.name == "user_graded":
+                self._count("pycanvasgrader_users_graded_total")
+                self._gauges[("pycanvasgrader_grading_queue_depth", ())] = fields[
+                    "queued"
+                ]
+            elif happened.name == "grade_posted":
+                self._count("pycanvasgrader_grades_posted_total")
+            elif happened.name == "api_throttled":
+                self._count("pycanvasgrader_api_throttled_total")
+
+    def start(self) -> "Metrics":
+        instrument.add_listener(self.on_span)
+        instrument.add_event_listener(self.on_event)
+        return self
+
+    def stop(self):
+        instrument.remove_listener(self.on_span)
+        instrument.remove_event_listener(self.on_event)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def render(self) -> str:
+        """
+        :return: Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name, help_text in self.HELP.items():
+                if name.endswith("_seconds"):
+                    series = [(k, v) for k, v in self._histograms.items() if k[0] == name]
+                    kind = "histogram"
+                elif name.endswith("_depth"):
+                    series = [(k, v) for k, v in self._gauges.items() if k[0] == name]
+                    kind = "gauge"
+                else:
+                    series = [(k, v) for k, v in self._counters.items() if k[0] == name]
+                    kind = "counter"
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (_, labels), value in sorted(series, key=lambda item: item[0][1]):
+                    if kind != "histogram":
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                        continue
+                    buckets = list(zip(BUCKETS, value.counts)) + [("+Inf", value.count)]
+                    for bound, count in buckets:
+                        bucket_labels = _labels(labels, 'le="{}"'.format(bound))
+                        lines.append(f"{name}_bucket{bucket_labels} {count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {value.total}")
+                    lines.append(f"{name}_count{_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, address: Tuple[str, int]) -> Tuple[str, int]:
+        """
+        Serve the metrics at http://<address>/metrics from a background thread
+        :param address: The (host, port) to listen on. Port 0 picks a free port
+        :return: The address actually listened on
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(address, Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[:2]
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
@@ -0,0 +1,112 @@
+"""
+A terminal pager for long text, such as a user's test log.
+
+Text is read through a function that returns a fresh iterator over its lines, and only
+one screen of lines is held at a time. Moving to an earlier page reads the lines again
+from the start instead of keeping the ones already shown.
+"""
+import re
+import shutil
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from lib.canvas_api import utils
+
+# The line that starts each test's section of a log (see TestSkeleton.run_selected)
+SECTION_REGEX = re.compile(r"--Running test (\d+)--")
+
+HELP = "[Enter] next  b back  g top  G end  t<N> test N  /<text> search  q quit"
+
+
+def index_sections(lines: Iterable[str]) -> Tuple[int, Dict[int, int]]:
+    """
+    Count the lines of a log and find where each test's section starts
+    :return: (The number of lines, the index of the line that starts the latest run of
+    each test, by test number)
+    """
+    count = 0
+    sections = {}
+    for count, line in enumerate(lines, 1):
+        found = SECTION_REGEX.search(line)
+        if found:
+            sections[int(found.group(1))] = count - 1
+    return count, sections
+
+
+def find(lines: Iterable[str], text: str, start: int = 0) -> Optional[int]:
+    """
+    Find the first line at or after start that contains text, ignoring case
+    :return: The line's index, or None if no line from start on contains text
+    """
+    text = text.lower()
+    for index, line in enumerate(islice(lines, start, None), start):
+        if text in line.lower():
+            return index
+    return None
+
+
+def window(lines: Iterable[str], start: int, height: int) -> List[str]:
+    """
+    :return: The lines from index start, at most height of them
+    """
+    return list(islice(lines, start, start + height))
+
+
+def view(
+    open_lines: Callable[[], Iterator[str]], title: str = "", height: int = None
+):
+    """
+    Page through text until the reader quits
+    :param open_lines: Returns a new iterator over the text's lines each time it is called
+    :param title: Shown above every page
+    :param height: Lines per page. Default: fit the terminal
+    """
+    height = height or max(shutil.get_terminal_size().lines - 4, 5)
+    total, sections = index_sections(open_lines())
+    last_page = max(total - 1, 0) // height * height
+    position = 0
+    message = ""
+    last_search = None
+
+    while True:
+        utils.clear_screen()
+        if title:
+            print(title)
+        for line in window(open_lines(), position, height):
+            print(line, end="" if line.endswith("\n") else "\n")
+        shown_to = min(position + height, total)
+        print(f"-- lines {min(position + 1, total)}-{shown_to} of {total} --", message)
+        print(HELP)
+        message = ""
+
+        command = input().strip()
+        if command == "":
+            if shown_to >= total:
+                return
+            position += height
+        elif command == "q":
+            return
+        elif command == "b":
+            position = max(position - height, 0)
+        elif command == "g":
+            position = 0
+        elif command == "G":
+            position = last_page
+        elif command.startswith("t"):
+            try:
+                position = sections[int(command[1:])]
+            except (KeyError, ValueError):
+                tests = ", ".join(str(test) for test in sorted(sections)) or "none"
+                message = f"(no such test; tests in this log: {tests})"
+        elif command.startswith("/"):
+            last_search = command[1:] or last_search
+            if not last_search:
+                continue
+            # Search from the line after the top one, so repeating a search moves on
+            found = find(open_lines(), last_search, position + 1)
+            if found is None:
+                found = find(open_lines(), last_search)
+            if found is None:
+                message = f'("{last_search}" not found)'
+            else:
+                position = found
@@ -21,6 +21,7 @@ def load(fp: typing.TextIO) -> dict:
     return {
         "session": preferences.get("session", {}),
         "quickstart": preferences.get("quickstart", {}),
+        "watch": preferences.get("watch", {}),
     }
 
 
@@ -0,0 +1,148 @@
+"""
+A paged, filterable view of the users being graded, for the main menu.
+"""
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import attr
+
+from lib.canvas_api import User
+
+# Whether a user has each grade status
+STATUSES: Dict[str, Callable[[User], bool]] = {
+    "ungraded": lambda user: user.grade is None,
+    "unposted": lambda user: not user.submitted,
+    "posted": lambda user: user.submitted and user.grade is not None,
+    "regrade": lambda user: user.needs_regrade or not user.grade_matches_submission,
+}
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class Roster:
+    """
+    The users, one page at a time, optionally filtered by name or email and grade status.
+
+    Name and email words are kept in a sorted index, so a search is a binary search per
+    word of the query. The filtered users are worked out when the filters or the users
+    change (call refresh after grading, syncing or editing users), so drawing a page only
+    formats that page's users.
+
+    :param users: The users to show. Users appended to this list later are picked up
+    by refresh
+    :param page_size: How many users to show on a page
+    """
+
+    users: List[User]
+    page_size: int = 20
+    query: str = ""
+    status: Optional[str] = None
+    page: int = 0
+    # (a lowercase word from a user's name or email, the user's index), sorted
+    _words: List[Tuple[str, int]] = attr.ib(
+        default=attr.Factory(list), init=False, repr=False
+    )
+    _indexed: int = attr.ib(default=0, init=False, repr=False)
+    _matches: List[int] = attr.ib(default=attr.Factory(list), init=False, repr=False)
+
+    HELP = (
+        "n/p: next/previous page   /<text>: find by name or email   "
+        "s <status>: show only {} users   c: clear filters".format("/".join(STATUSES))
+    )
+
+    def __attrs_post_init__(self):
+        self.refresh()
+
+    def refresh(self):
+        """
+        Index users added since the last refresh, and reapply the filters to every user
+        """
+        if self._indexed != len(self.users):
+            self._words = sorted(
+                (word, index)
+                for index, user in enumerate(self.users)
+                for word in "{} {}".format(user.name, user.email or "").lower().split()
+            )
+            self._indexed = len(self.users)
+
+        candidates = range(len(self.users))
+        if self.query:
+            found = None
+            for word in self.query.lower().split():
+                found = self._find(word) if found is None else found & self._find(word)
+            candidates = sorted(found)
+        if self.status is not None:
+            has_status = STATUSES[self.status]
+            candidates = [i for i in candidates if has_status(self.users[i])]
+        self._matches = list(candidates)
+        self.page = min(self.page, self.pages - 1)
+
+    def _find(self, prefix: str) -> Set[int]:
+        """
+        :return: The indices of the users with a name or email word that starts with prefix
+        """
+        found = set()
+        position = bisect_left(self._words, (prefix, -1))
+        while position < len(self._words):
+            word, index = self._words[position]
+            if not word.startswith(prefix):
+                break
+            found.add(index)
+            position += 1
+        return found
+
+    @property
+    def pages(self) -> int:
+        return max((len(self._matches) - 1) // self.page_size + 1, 1)
+
+    @property
+    def shown(self) -> List[User]:
+        """
+        The users on the current page
+        """
+        start = self.page * self.page_size
+        return [self.users[i] for i in self._matches[start : start + self.page_size]]
+
+    def header(self) -> str:
+        """
+        :return: A summary of the page, the filters and the number of matching users
+        """
+        start = self.page * self.page_size
+        summary = "Showing {}-{} of {} users".format(
+            min(start + 1, len(self._matches)),
+            min(start + self.page_size, len(self._matches)),
+            len(self._matches),
+        )
+        filters = []
+        if self.query:
+            filters.append(f'matching "{self.query}"')
+        if self.status is not None:
+            filters.append(self.status)
+        if filters:
+            summary += " ({}, of {})".format(", ".join(filters), len(self.users))
+        if self.pages > 1:
+            summary += f" | page {self.page + 1}/{self.pages}"
+        return summary
+
+    def command(self, command: str) -> bool:
+        """
+        Carry out a paging or filtering command (see Roster.HELP)
+        :return: Whether command was one
+        """
+        if command == "n":
+            self.page = min(self.page + 1, self.pages - 1)
+        elif command == "p":
+            self.page = max(self.page - 1, 0)
+        elif command.startswith("/"):
+            self.query = command[1:].strip()
+            self.page = 0
+            self.refresh()
+        elif command.startswith("s ") and command[2:].strip() in STATUSES:
+            self.status = command[2:].strip()
+            self.page = 0
+            self.refresh()
+        elif command == "c":
+            self.query, self.status, self.page = "", None, 0
+            self.refresh()
+        else:
+            return False
+        return True
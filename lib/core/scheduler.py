@@ -0,0 +1,638 @@
+"""
+Decides the order that submissions are graded in.
+
+grade_longest_first grades one assignment's users longest-expected-first, using the
+test times recorded on each user by earlier runs, and splits a user whose tests alone
+would outlast the rest of the run across several workers.
+
+BackgroundGrader grades users on worker threads while the interactive menus stay usable.
+
+BatchScheduler grades several assignments at once with shared download and grading pools.
+Every job streams its submission listing into one download pool, and every finished
+download goes into one grading queue, so downloads for one assignment overlap
+with grading for another and no pool sits idle between jobs.
+"""
+import heapq
+import itertools
+import queue
+import statistics
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set
+
+import attr
+
+from lib.canvas_api import PyCanvasGrader, TestSkeleton, User
+from lib.canvas_api import utils
+from lib.core import instrument
+from lib.core.distributed import Coordinator
+
+
+# Assumed run time of a test that has never been timed, in seconds
+DEFAULT_TEST_SECONDS = 1.0
+
+
+def typical_test_times(histories: Iterable[Dict[str, float]]) -> Dict[str, float]:
+    """
+    :param histories: Recorded test times, such as User.test_times of every user
+    :return: The median recorded time of each test
+    """
+    samples = {}
+    for history in histories:
+        for key, seconds in history.items():
+            samples.setdefault(key, []).append(seconds)
+    return {key: statistics.median(times) for key, times in samples.items()}
+
+
+def expected_seconds(
+    user: User,
+    test_skeleton: TestSkeleton,
+    typical: Dict[str, float],
+    indices: Iterable[int] = None,
+) -> float:
+    """
+    How long some of a user's tests are expected to take: the user's own last time for each test,
+    else the typical time for it, else DEFAULT_TEST_SECONDS
+    :param indices: The tests to include. Default: all of them
+    """
+    if indices is None:
+        indices = range(len(test_skeleton.tests))
+    total = 0.0
+    for index in indices:
+        key = test_skeleton.test_key(index)
+        total += user.test_times.get(key, typical.get(key, DEFAULT_TEST_SECONDS))
+    return total
+
+
+def longest_first(users: List[User], test_skeleton: TestSkeleton) -> List[User]:
+    """
+    :return: users, sorted by how long their tests are expected to take, longest first
+    """
+    typical = typical_test_times(user.test_times for user in users)
+    return sorted(
+        users, key=lambda user: -expected_seconds(user, test_skeleton, typical)
+    )
+
+
+def partition(
+    indices: Sequence[int], weights: Dict[int, float], parts: int
+) -> List[List[int]]:
+    """
+    Cut indices into at most parts contiguous runs of roughly equal total weight
+    """
+    parts = min(parts, len(indices))
+    runs = []
+    remaining = sum(weights[index] for index in indices)
+    current = []
+    current_weight = 0.0
+    for position, index in enumerate(indices):
+        current.append(index)
+        current_weight += weights[index]
+        parts_left = parts - len(runs)
+        indices_left = len(indices) - position - 1
+        if parts_left > 1 and indices_left >= parts_left - 1 and (
+            current_weight >= remaining / parts_left or indices_left == parts_left - 1
+        ):
+            runs.append(current)
+            remaining -= current_weight
+            current = []
+            current_weight = 0.0
+    if current:
+        runs.append(current)
+    return runs
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class _Split:
+    """
+    A user whose tests are graded as several pieces.
+    The head (every test up to the last test_must_pass test) runs first; the rest of the tests
+    are cut into chunks that run concurrently once the head has passed.
+    Each piece runs on its own copy of the user, and the copies are merged by the index of
+    their first test, so logs and comments stay in test order whatever order the pieces
+    ran in.
+    """
+
+    user: User
+    chunks: List[List[int]]
+    # Each piece's copy of the user, by the index of its first test (-1 for an empty head)
+    pieces: Dict[int, User] = attr.Factory(dict)
+    score: Optional[float] = 0.0
+    waiting: int = 0
+
+    def piece(self, indices: List[int]) -> User:
+        piece = attr.evolve(self.user, comment="", test_times={})
+        self.pieces[min(indices, default=-1)] = piece
+        return piece
+
+    def merge(self):
+        user = self.user
+        for _, piece in sorted(self.pieces.items()):
+            user.log.write(piece.log.getvalue())
+            user.comment += piece.comment
+            user.test_times.update(piece.test_times)
+        user.log.flush()
+        if self.score is not None:
+            user.needs_regrade = False
+            user.grade = self.score
+
+
+def grade_longest_first(
+    users: List[User],
+    test_skeleton: TestSkeleton,
+    workers: int = 1,
+    interactive: bool = True,
+    temp_dir: str = None,
+    on_graded: Callable[[User], None] = None,
+):
+    """
+    Grade users on a pool of workers, longest-expected-first, so that no slow submission is
+    left to run alone at the end. When there is more than one worker, a user expected to take
+    longer than an even share of the whole run has the tests after its last test_must_pass
+    test split across workers, if the skeleton enables split_tests.
+    :param interactive: Whether tests may prompt the grader for scores and files
+    :param temp_dir: The directory submissions were downloaded to. Default: INSTALL_DIR/.temp
+    :param on_graded: Called with each user once all of their tests have run
+    """
+    typical = typical_test_times(user.test_times for user in users)
+    workers = max(workers, 1)
+    tests = test_skeleton.tests
+    expected = {
+        user.user_id: expected_seconds(user, test_skeleton, typical) for user in users
+    }
+    share = sum(expected.values()) / workers
+    head = list(range(test_skeleton.independent_from))
+    tail = list(range(test_skeleton.independent_from, len(tests)))
+
+    # Min-heap of (-expected seconds, tiebreak, work); work is a user or a (split, indices) piece
+    ready = []
+    order = itertools.count()
+    for user in users:
+        if (
+            workers > 1
+            and test_skeleton.split_tests
+            and len(tail) > 1
+            and expected[user.user_id] > share
+        ):
+            weights = {
+                index: expected_seconds(user, test_skeleton, typical, [index])
+                for index in tail
+            }
+            split = _Split(user, partition(tail, weights, workers))
+            work = (split, head)
+            seconds = expected_seconds(user, test_skeleton, typical, head)
+        else:
+            work = user
+            seconds = expected[user.user_id]
+        heapq.heappush(ready, (-seconds, next(order), work))
+
+    def run(work):
+        if isinstance(work, User):
+            work.grade_self(test_skeleton, interactive, temp_dir)
+            return None
+        split, indices = work
+        return test_skeleton.run_selected(
+            split.piece(indices), indices, interactive, temp_dir
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while ready or running:
+            while ready and len(running) < workers:
+                _, _, work = heapq.heappop(ready)
+                running[executor.submit(run, work)] = work
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                work = running.pop(future)
+                result = future.result()
+                if isinstance(work, User):
+                    finished_user = work
+                else:
+                    split, indices = work
+                    score, passed = result
+                    split.score = (
+                        None if score is None or split.score is None
+                        else split.score + score
+                    )
+                    if indices is head and passed and split.score is not None:
+                        # The head passed; queue the rest of the tests
+                        split.waiting = len(split.chunks)
+                        for chunk in split.chunks:
+                            seconds = expected_seconds(
+                                split.user, test_skeleton, typical, chunk
+                            )
+                            heapq.heappush(ready, (-seconds, next(order), (split, chunk)))
+                        continue
+                    if indices is not head:
+                        split.waiting -= 1
+                        if split.waiting:
+                            continue
+                    split.merge()
+                    finished_user = split.user
+                if on_graded is not None:
+                    on_graded(finished_user)
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class BackgroundGrader:
+    """
+    Grades users on worker threads while the menus stay responsive.
+
+    Users wait in a queue, longest-expected-first, and each one is queued, running, done
+    or cancelled. A queued user can be moved to the front of the queue or cancelled. A
+    running user that is cancelled stops after its current test and keeps its old grade.
+    Tests never prompt for input, so skeletons that do must be graded in the foreground.
+
+    :param test_skeleton: The skeleton to grade with
+    :param workers: How many users to grade at once
+    :param temp_dir: The directory submissions were downloaded to. Default: INSTALL_DIR/.temp
+    :param on_graded: Called from a worker thread with each user once they are done
+    """
+
+    test_skeleton: TestSkeleton
+    workers: int = 1
+    temp_dir: Optional[str] = None
+    on_graded: Optional[Callable[[User], None]] = None
+    # Min-heap of (priority, tiebreak, user); entries whose user is no longer queued with
+    # that priority are skipped
+    _ready: List[tuple] = attr.ib(default=attr.Factory(list), init=False)
+    _priorities: Dict[int, float] = attr.ib(default=attr.Factory(dict), init=False)
+    _states: Dict[int, str] = attr.ib(default=attr.Factory(dict), init=False)
+    _stopping: Set[int] = attr.ib(default=attr.Factory(set), init=False)
+    _order: Iterator[int] = attr.ib(default=attr.Factory(itertools.count), init=False)
+    _changed: threading.Condition = attr.ib(
+        default=attr.Factory(threading.Condition), init=False
+    )
+    _threads: List[threading.Thread] = attr.ib(default=attr.Factory(list), init=False)
+    _finished: List[User] = attr.ib(default=attr.Factory(list), init=False)
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    CANCELLED = "cancelled"
+
+    def submit(self, users: List[User]) -> int:
+        """
+        Queue users to be graded, longest-expected-first.
+        Users that are already queued or running are left as they are
+        :return: How many users were queued
+        """
+        typical = typical_test_times(user.test_times for user in users)
+        queued = 0
+        with self._changed:
+            for user in users:
+                if self._states.get(user.user_id) in (self.QUEUED, self.RUNNING):
+                    continue
+                self._push(user, -expected_seconds(user, self.test_skeleton, typical))
+                queued += 1
+            self._changed.notify_all()
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return queued
+
+    def _push(self, user: User, priority: float):
+        self._priorities[user.user_id] = priority
+        self._states[user.user_id] = self.QUEUED
+        heapq.heappush(self._ready, (priority, next(self._order), user))
+
+    def state(self, user: User) -> Optional[str]:
+        """
+        :return: The user's grading state, or None if they were never queued
+        """
+        with self._changed:
+            return self._states.get(user.user_id)
+
+    def counts(self) -> Dict[str, int]:
+        """
+        :return: How many users are in each state
+        """
+        with self._changed:
+            counts = dict.fromkeys((self.QUEUED, self.RUNNING, self.DONE), 0)
+            for state in self._states.values():
+                counts[state] = counts.get(state, 0) + 1
+            return counts
+
+    @property
+    def idle(self) -> bool:
+        """
+        Whether no user is queued or running
+        """
+        counts = self.counts()
+        return not counts[self.QUEUED] and not counts[self.RUNNING]
+
+    def prioritize(self, user: User) -> bool:
+        """
+        Move a queued user to the front of the queue
+        :return: Whether the user was queued
+        """
+        with self._changed:
+            if self._states.get(user.user_id) != self.QUEUED:
+                return False
+            front = min(self._priorities.values()) if self._priorities else 0
+            self._push(user, front - 1)
+            return True
+
+    def cancel(self, user: User) -> bool:
+        """
+        Take a user out of the queue, or stop grading them after their current test
+        :return: Whether the user was queued or running
+        """
+        with self._changed:
+            state = self._states.get(user.user_id)
+            if state == self.QUEUED:
+                self._unqueue(user)
+            elif state == self.RUNNING:
+                self._stopping.add(user.user_id)
+            self._changed.notify_all()
+            return state in (self.QUEUED, self.RUNNING)
+
+    def _unqueue(self, user: User):
+        del self._priorities[user.user_id]
+        self._states[user.user_id] = self.CANCELLED
+        self._finished.append(user)
+
+    def cancel_all(self):
+        """
+        Cancel every queued and running user
+        """
+        with self._changed:
+            for _, _, user in self._ready:
+                if self._states.get(user.user_id) == self.QUEUED:
+                    self._unqueue(user)
+            self._stopping.update(
+                user_id
+                for user_id, state in self._states.items()
+                if state == self.RUNNING
+            )
+            self._changed.notify_all()
+
+    def take_finished(self) -> List[User]:
+        """
+        :return: The users that finished or were cancelled since the last call
+        """
+        with self._changed:
+            finished, self._finished = self._finished, []
+            return finished
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait until no user is queued or running
+        :return: Whether grading finished before the timeout
+        """
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: all(
+                    state not in (self.QUEUED, self.RUNNING)
+                    for state in self._states.values()
+                ),
+                timeout,
+            )
+
+    def _next(self) -> User:
+        with self._changed:
+            while True:
+                while self._ready:
+                    priority, _, user = heapq.heappop(self._ready)
+                    if self._priorities.get(user.user_id) == priority:
+                        del self._priorities[user.user_id]
+                        self._states[user.user_id] = self.RUNNING
+                        return user
+                self._changed.wait()
+
+    def _work(self):
+        while True:
+            user = self._next()
+            try:
+                cancelled = self._grade(user)
+            except Exception as e:
+                print("--Grading failed: %s--" % e, file=user.log)
+                cancelled = False
+            user.log.flush()
+            with self._changed:
+                self._stopping.discard(user.user_id)
+                self._states[user.user_id] = self.CANCELLED if cancelled else self.DONE
+                self._finished.append(user)
+                self._changed.notify_all()
+            if self.on_graded is not None and not cancelled:
+                self.on_graded(user)
+
+    def _grade(self, user: User) -> bool:
+        """
+        Run a user's tests, checking for cancellation between tests
+        :return: Whether the user was cancelled
+        """
+        score, _ = self.test_skeleton.run_selected(
+            user,
+            range(len(self.test_skeleton.tests)),
+            False,
+            self.temp_dir,
+            should_stop=lambda: user.user_id in self._stopping,
+        )
+        if user.user_id in self._stopping:
+            print("--Grading cancelled--", file=user.log)
+            return True
+        if score is not None:
+            user.needs_regrade = False
+            user.grade = score
+        return False
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class Job:
+    """
+    One assignment to download and grade.
+
+    :param grader: A grader for the job's course and assignment, with its own workspace
+    :param test_skeleton: The skeleton to grade the assignment with
+    :param ungraded_only: Whether to skip submissions whose grade is already up to date
+    :param history: Test times recorded by earlier runs of this job, by user id. Users are graded
+    longest-expected-first, and keep their history until they are regraded
+    """
+
+    grader: PyCanvasGrader
+    test_skeleton: TestSkeleton
+    ungraded_only: bool = False
+    history: Dict[int, Dict[str, float]] = attr.Factory(dict)
+
+    users: List[User] = attr.Factory(list)
+    total: int = 0
+    failed: int = 0
+    graded: int = 0
+    listed: bool = False
+    error: Optional[str] = None
+
+    _lock: threading.Lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+    _typical: Optional[Dict[str, float]] = attr.ib(default=None, repr=False)
+
+    def expected_seconds(self, user: User) -> float:
+        """
+        How long grading user is expected to take, from this job's history
+        """
+        if self._typical is None:
+            self._typical = typical_test_times(self.history.values())
+        return expected_seconds(user, self.test_skeleton, self._typical)
+
+    @property
+    def name(self) -> str:
+        return f"{self.grader.course_id}/{self.grader.assignment_id}"
+
+    def progress(self) -> str:
+        downloaded = len(self.users) + self.failed
+        listing = "" if self.listed else "+"
+        return (
+            f"{self.name}: downloaded {downloaded}/{self.total}{listing}, "
+            f"graded {self.graded}/{len(self.users)}"
+        )
+
+
+@attr.s(cmp=False, auto_attribs=True)
+class BatchScheduler:
+    """
+    Runs jobs through one download pool and one grading pool.
+    Downloaded users wait for the grading pool in longest-expected-first order.
+
+    :param download_workers: How many submissions to download at once, across all jobs
+    :param grading_workers: How many users to grade at once, across all jobs
+    :param coordinator: If given, users are graded by its remote workers instead of the local grading pool
+    """
+
+    download_workers: int = 8
+    grading_workers: int = 1
+    coordinator: Optional[Coordinator] = None
+
+    # Submissions that are listed but not yet downloaded and graded (or failed), across all jobs
+    _outstanding: int = attr.ib(default=0, init=False, repr=False)
+    _changed: threading.Condition = attr.ib(
+        default=attr.Factory(threading.Condition), init=False, repr=False
+    )
+    # (-expected seconds, tiebreak, job, user); a None job stops a grading thread
+    _grading: "queue.PriorityQueue" = attr.ib(
+        default=attr.Factory(queue.PriorityQueue), init=False, repr=False
+    )
+    _order: Iterator[int] = attr.ib(
+        default=attr.Factory(itertools.count), init=False, repr=False
+    )
+
+    def _finish_one(self):
+        with self._changed:
+            self._outstanding -= 1
+            self._changed.notify_all()
+
+    def run(self, jobs: List[Job], refresh: float = 0.5):
+        """
+        Download and grade every job, showing combined progress until all are finished.
+        Grades are left on each job's users; nothing is posted or saved.
+        :param refresh: Seconds between progress updates
+        """
+        graders = [
+            threading.Thread(target=self._grading_worker, daemon=True)
+            for _ in range(max(self.grading_workers, 1))
+        ]
+        for grader in graders:
+            grader.start()
+
+        with ThreadPoolExecutor(max_workers=max(self.download_workers, 1)) as downloads:
+            listers = [
+                threading.Thread(target=self._list, args=(job, downloads), daemon=True)
+                for job in jobs
+            ]
+            for lister in listers:
+                lister.start()
+
+            # The download pool must stay open until every listed submission is graded,
+            # since listers keep submitting to it until they finish
+            with self._changed:
+                while any(job.listed is False for job in jobs) or self._outstanding:
+                    utils.print_on_curline(" | ".join(job.progress() for job in jobs))
+                    self._changed.wait(refresh)
+            utils.print_on_curline(" | ".join(job.progress() for job in jobs) + "\n")
+
+        for _ in graders:
+            self._grading.put((float("inf"), next(self._order), None, None))
+        for grader in graders:
+            grader.join()
+
+    def _list(self, job: Job, downloads: ThreadPoolExecutor):
+        try:
+            for submission in job.grader.iter_submissions():
+                if submission.get("workflow_state") == "unsubmitted":
+                    continue
+                # progress() reads the counts from the main thread
+                with job._lock:
+                    job.total += 1
+                if (
+                    job.ungraded_only
+                    and submission["grade_matches_current_submission"]
+                    and submission["score"] is not None
+                ):
+                    continue
+                if submission.get("attachments") is None:
+                    continue
+                with self._changed:
+                    self._outstanding += 1
+                future = downloads.submit(self._download, job, submission)
+                future.add_done_callback(
+                    lambda done, job=job: self._downloaded(job, done)
+                )
+        except Exception as e:
+            with job._lock:
+                job.error = str(e)
+        finally:
+            with self._changed:
+                job.listed = True
+                self._changed.notify_all()
+
+    @staticmethod
+    def _download(job: Job, submission: dict) -> Optional[User]:
+        grader = job.grader
+        if not grader.download_submission(submission):
+            return None
+        user = User.from_submission(
+            submission, grader.user(submission["user_id"]), grader.log_dir
+        )
+        user.test_times.update(job.history.get(user.user_id, {}))
+        return user
+
+    def _downloaded(self, job: Job, future: Future):
+        user = None if future.exception() else future.result()
+        with job._lock:
+            if user is not None:
+                job.users.append(user)
+            else:
+                job.failed += 1
+        if user is None:
+            self._finish_one()
+        elif self.coordinator is not None:
+            self.coordinator.submit(
+                user,
+                job.test_skeleton,
+                job.grader.temp_dir,
+                lambda graded, job=job: self._graded(job, graded),
+            )
+        else:
+            self._grading.put((-job.expected_seconds(user), next(self._order), job, user))
+
+    def _grading_worker(self):
+        while True:
+            _, _, job, user = self._grading.get()
+            if job is None:
+                return
+            try:
+                user.grade_self(job.test_skeleton, False, job.grader.temp_dir)
+            except Exception as e:
+                print("--Grading failed: %s--" % e, file=user.log)
+            finally:
+                self._graded(job, user)
+
+    def _graded(self, job: Job, user: User):
+        with job._lock:
+            job.graded += 1
+        instrument.event(
+            "user_graded",
+            user_id=user.user_id,
+            grade=user.grade,
+            queued=self._grading.qsize(),
+        )
+        self._finish_one()
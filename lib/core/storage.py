@@ -0,0 +1,241 @@
+"""
+Compression and disk budgeting for the session cache in .cache/<course>/<assignment>.
+
+Saved states and logs are compressed with zlib or lzma, and the saved workspace is kept
+as one compressed tar file. Cached files are recognised by their first bytes, so caches
+written uncompressed by older versions still load.
+
+Every assignment's cache records when it was last used. When the assignment caches
+outgrow their budget, the least recently used assignments are evicted whole. The HTTP and
+skeleton caches are shared by every assignment and cannot be evicted one assignment at a
+time, so they neither count against the budget nor are evicted.
+"""
+import lzma
+import os
+import shutil
+import tarfile
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from lib.canvas_api import archives
+
+# Codec name: tarfile compression suffix
+CODECS = {"zlib": "gz", "lzma": "xz", "none": ""}
+LZMA_MAGIC = b"\xfd7zXZ\x00"
+# Touched whenever an assignment's cache is saved or loaded
+LAST_USED_FILE = ".last_used"
+
+
+def compress(data: bytes, codec: str = "zlib") -> bytes:
+    """
+    :param codec: One of CODECS
+    :raises ValueError: If codec is unknown
+    """
+    if codec == "zlib":
+        return zlib.compress(data, 6)
+    if codec == "lzma":
+        return lzma.compress(data)
+    if codec == "none":
+        return data
+    raise ValueError(f'Unknown compression "{codec}", expected one of {list(CODECS)}')
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Decompress data written by compress with any codec
+    """
+    if data.startswith(LZMA_MAGIC):
+        return lzma.decompress(data)
+    if data[:1] == b"\x78":
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Uncompressed text that happens to start with "x"
+            pass
+    return data
+
+
+def archive(source: str, destination: str, codec: str = "zlib", exclude: str = None):
+    """
+    Pack a directory into a tar file, replacing destination only once it is complete
+    and synced to disk
+    :param exclude: The name of a top-level entry of source to leave out
+    """
+    suffix = CODECS[codec]
+    options = {"gz": {"compresslevel": 6}, "xz": {"preset": 1}}.get(suffix, {})
+    with open(destination + ".tmp", "wb") as temp_file:
+        with tarfile.open(fileobj=temp_file, mode="w:" + suffix, **options) as tar:
+            for entry in sorted(os.listdir(source)):
+                if entry != exclude:
+                    tar.add(os.path.join(source, entry), entry)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(destination + ".tmp", destination)
+    sync_directory(os.path.dirname(os.path.abspath(destination)))
+
+
+def sync_directory(directory: str):
+    """
+    Make the renames in a directory durable. Not every platform can open a directory
+    """
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+def extract(source: str, destination: str):
+    """
+    Unpack a tar file written by archive, of any codec.
+    Like submitted archives (see archives.extract), only regular files and directories
+    are unpacked, and links and device files are skipped
+    :raises archives.ArchiveError: If a member would be unpacked outside destination
+    """
+    os.makedirs(destination, exist_ok=True)
+    with tarfile.open(source, "r:*") as tar:
+        members = [
+            member
+            for member in tar.getmembers()
+            if (member.isfile() or member.isdir())
+            and archives.member_path(destination, member.name) is not None
+        ]
+        # Newer Pythons can also check each member themselves
+        options = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+        tar.extractall(destination, members, **options)
+
+
+def touch(directory: str):
+    """
+    Record that an assignment's cache was just used
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LAST_USED_FILE), "a"):
+        pass
+    os.utime(os.path.join(directory, LAST_USED_FILE))
+
+
+def disk_usage(directory: str) -> int:
+    """
+    :return: The total size in bytes of the files under directory
+    """
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def assignment_caches(cache_root: str) -> List[Tuple[str, str, str]]:
+    """
+    :return: (course id, assignment id, directory) of every assignment's cache.
+    Other caches in cache_root, such as the HTTP and skeleton caches, are not included
+    """
+    caches = []
+    try:
+        courses = os.listdir(cache_root)
+    except OSError:
+        return caches
+    for course in sorted(courses):
+        course_dir = os.path.join(cache_root, course)
+        if not course.isdigit() or not os.path.isdir(course_dir):
+            continue
+        for assignment in sorted(os.listdir(course_dir)):
+            directory = os.path.join(course_dir, assignment)
+            if assignment.isdigit() and os.path.isdir(directory):
+                caches.append((course, assignment, directory))
+    return caches
+
+
+def last_used(directory: str) -> float:
+    """
+    :return: When an assignment's cache was last saved or loaded, as a timestamp
+    """
+    for path in (os.path.join(directory, LAST_USED_FILE), directory):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            continue
+    return 0.0
+
+
+def enforce_budget(
+    cache_root: str, budget: int, keep: Optional[str] = None
+) -> List[Tuple[str, str, int]]:
+    """
+    Evict the least recently used assignment caches until they fit their budget
+    :param budget: The most bytes the assignment caches in cache_root may hold, not
+    counting the HTTP and skeleton caches. 0 means no limit
+    :param keep: An assignment cache that is never evicted, such as the one in use
+    :return: (course id, assignment id, bytes freed) of every evicted cache
+    """
+    if budget <= 0:
+        return []
+    caches = assignment_caches(cache_root)
+    sizes = {directory: disk_usage(directory) for _, _, directory in caches}
+    total = sum(sizes.values())
+    if total <= budget:
+        return []
+
+    keep = os.path.abspath(keep) if keep else None
+    evictable = [
+        (last_used(directory), course, assignment, directory)
+        for course, assignment, directory in caches
+        if os.path.abspath(directory) != keep
+    ]
+    evicted = []
+    for _, course, assignment, directory in sorted(evictable):
+        if total <= budget:
+            break
+        size = sizes[directory]
+        shutil.rmtree(directory, ignore_errors=True)
+        total -= size
+        evicted.append((course, assignment, size))
+    return evicted
+
+
+def usage_report(cache_root: str, budget: int = 0) -> str:
+    """
+    :return: A table of the disk used by each course and assignment cache, largest
+    course first, with the least recently used assignments first within a course
+    """
+    courses: Dict[str, List[Tuple[str, int, float]]] = {}
+    for course, assignment, directory in assignment_caches(cache_root):
+        courses.setdefault(course, []).append(
+            (assignment, disk_usage(directory), last_used(directory))
+        )
+    total = disk_usage(cache_root)
+    course_totals = {
+        course: sum(size for _, size, _ in assignments)
+        for course, assignments in courses.items()
+    }
+
+    lines = [f"{'Course':>10} {'Assignment':>12} {'Size':>10}  Last used"]
+    for course in sorted(courses, key=course_totals.get, reverse=True):
+        lines.append(f"{course:>10} {'':>12} {format_size(course_totals[course]):>10}")
+        for assignment, size, used in sorted(courses[course], key=lambda a: a[2]):
+            used_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(used))
+            size = format_size(size)
+            lines.append(f"{'':>10} {assignment:>12} {size:>10}  {used_at}")
+    other = total - sum(course_totals.values())
+    lines.append(f"{'Other caches':>23} {format_size(other):>10}")
+    lines.append(f"{'Total':>23} {format_size(total):>10}")
+    if budget > 0:
+        lines.append(f"{'Budget (assignments)':>23} {format_size(budget):>10}")
+    return "\n".join(lines)
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
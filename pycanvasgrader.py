@@ -16,30 +16,81 @@ REQUIRED File structure:
 
 Usage:
     pycanvasgrader [options]
+    pycanvasgrader --batch --course=<id> --assignment=<id> --skeleton=<skeleton> [options]
 
 Options:
     --ua, --ungraded-assignments
     --us, --ungraded-submissions
+    --course=<id>
+    --assignment=<id>
+    --role=<role>
     --skeleton=<skeleton>
+    --workers=<n>
+    --post-grades
+    --download-workers=<n>
+    --rate-limit=<requests per second>
+    --job=<course>:<assignment>:<skeleton>
+    --coordinate=<host>:<port>
+    --worker=<host>:<port>
+    --batch
+    --summary=<file>
+    --watch
+    --calibrate=<reference dir>
+    --runs=<n>
+    --timeout-factor=<factor>
+    --apply-timeouts
+    --profile=<trace file>
+    --profile-top=<n>
+    --event-log=<file>
+    --metrics=<host>:<port>
+    --api-url=<url>
+    --disk-usage
 """
 # built-ins
+import argparse
+import atexit
 import json
 import os
 import shutil
 import signal
+import statistics
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import AuthenticationError
 from importlib import util
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 # 3rd-party
+import requests
 import toml
 
 # library
 from lib.canvas_api import Enrollment, PyCanvasGrader, User, TestSkeleton
 from lib.canvas_api import utils
-
-from lib.core import choices, preferences
+from lib.canvas_api.skeleton_cache import SkeletonCache
+
+from lib.core import (
+    calibration,
+    choices,
+    distributed,
+    instrument,
+    monitoring,
+    pager,
+    preferences,
+    storage,
+)
+from lib.core.checkpoint import Checkpoint, read_state, restore_workspace
+from lib.core.distributed import Coordinator
+from lib.core.roster import Roster
+from lib.core.scheduler import (
+    BackgroundGrader,
+    BatchScheduler,
+    Job,
+    grade_longest_first,
+)
 
 if util.find_spec("py"):
     import py
@@ -49,12 +100,20 @@ RUN_WITH_TESTS = False
 ONLY_RUN_TESTS = False
 os.environ["INSTALL_DIR"] = "."
 CURRENTLY_SAVED = False
+# Grades users while the menus stay usable; see grade_in_background
+BACKGROUND_GRADER: Optional[BackgroundGrader] = None
+# Saves the session's state as it changes; see start_checkpoint
+CHECKPOINT: Optional[Checkpoint] = None
+# How saved states, logs and workspaces are compressed; see lib/core/storage.py
+CACHE_COMPRESSION = "zlib"
 
 
 PREFERENCES_FILE = "preferences.toml"
 
 
 def close_program(grader: PyCanvasGrader, restart=False):
+    if BACKGROUND_GRADER is not None:
+        BACKGROUND_GRADER.cancel_all()
     grader.close()
     if restart:
         init_tempdir()
@@ -94,6 +153,7 @@ def load_preferences() -> Dict[str, Any]:
     return {
         "session": preferences.get("session", {}),
         "quickstart": preferences.get("quickstart", {}),
+        "watch": preferences.get("watch", {}),
     }
 
 
@@ -127,29 +187,19 @@ def save_state(grader: PyCanvasGrader, test_skeleton: TestSkeleton, users: List[
     global CURRENTLY_SAVED
     utils.print_on_curline("Saving state...")
     try:
-        os.chdir(os.environ["INSTALL_DIR"])
-        cache_dir = os.path.join(
-            ".cache", str(grader.course_id), str(grader.assignment_id)
-        )
-        os.makedirs(cache_dir, exist_ok=True)
-        os.chdir(cache_dir)
-
-        if os.path.exists(".temp"):
-            shutil.rmtree(".temp")
-        shutil.copytree(os.path.join(os.environ["INSTALL_DIR"], ".temp"), ".temp")
-
-        with open(".cachefile", mode="w") as cache_file:
-            json.dump(
-                {
-                    "skeleton": test_skeleton.to_json(),
-                    "users": [user.to_json() for user in users],
-                },
-                cache_file,
+        checkpoint = CHECKPOINT
+        if checkpoint is None or checkpoint.users is not users:
+            checkpoint = Checkpoint(
+                grader.cache_file,
+                grader,
+                test_skeleton,
+                users,
+                compression=CACHE_COMPRESSION,
             )
+        checkpoint.snapshot(workspace=True)
 
         utils.print_on_curline("State saved.    \n")
         CURRENTLY_SAVED = True
-        os.chdir(os.environ["INSTALL_DIR"])
     except:
         print("There was an error while saving the state.")
         print(
@@ -161,40 +211,169 @@ def save_state(grader: PyCanvasGrader, test_skeleton: TestSkeleton, users: List[
         os.chdir(os.environ["INSTALL_DIR"])
 
 
+def load_test_times(course_id: int, assignment_id: int) -> Dict[int, Dict[str, float]]:
+    """
+    Read the test times recorded in an assignment's saved state, without loading the state
+    :return: Each user's test times by user id, or an empty dict if there is no saved state
+    """
+    cache_dir = os.path.join(
+        os.environ["INSTALL_DIR"], ".cache", str(course_id), str(assignment_id)
+    )
+    try:
+        cache = read_state(cache_dir)
+    except (OSError, ValueError):
+        return {}
+    return {
+        user["user_id"]: user.get("test_times", {}) for user in cache.get("users", [])
+    }
+
+
 def load_state(course_id: int, assignment_id: int):
     os.chdir(os.environ["INSTALL_DIR"])
     if os.path.exists(".temp"):
         shutil.rmtree(".temp")
 
     os.chdir(os.path.join(".cache", str(course_id), str(assignment_id)))
-    shutil.copytree(".temp", os.path.join(os.environ["INSTALL_DIR"], ".temp"))
-    with open(".cachefile") as cache_file:
-        cache = json.load(cache_file)
+    with instrument.span("state", "load workspace"):
+        restore_workspace(".", os.path.join(os.environ["INSTALL_DIR"], ".temp"))
+    storage.touch(".")
+    with instrument.span("state", "load cachefile"):
+        cache = read_state(".")
         test_skeleton = TestSkeleton.from_json(cache["skeleton"])
-        users = [User.from_json(userdata) for userdata in cache["users"]]
+        log_dir = os.path.join(os.environ["INSTALL_DIR"], ".temp", ".logs")
+        users = [User.from_json(userdata, log_dir) for userdata in cache["users"]]
 
         os.chdir(os.environ["INSTALL_DIR"])
-        return test_skeleton, users
+        return test_skeleton, users, cache.get("last_sync")
 
 
 def grade_all_submissions(
-    test_skeleton: TestSkeleton, users: List[User], only_ungraded: bool = False
+    test_skeleton: TestSkeleton,
+    users: List[User],
+    only_ungraded: bool = False,
+    workers: int = 1,
+    interactive: bool = True,
 ) -> bool:
+    """
+    :param workers: How many users to grade at once. Skeletons that prompt for input
+    are always graded one user at a time while interactive. Users are graded longest-first,
+    by the test times recorded when they were last graded.
+    :param interactive: Whether tests may prompt the grader for scores and files
+    """
     if only_ungraded:
-        users = [u for u in users if u.grade is None]
+        users = [u for u in users if u.grade is None or u.needs_regrade]
         if len(users) == 0:
             print("No currently ungraded submissions to grade.")
             return False
 
     total = len(users)
+    if interactive and test_skeleton.interactive:
+        workers = 1
+
+    graded = 0
 
-    for count, user in enumerate(users):
-        utils.print_on_curline(f"grading ({count}/{total})")
-        user.grade_self(test_skeleton)
+    def show_progress(user: User):
+        nonlocal graded
+        graded += 1
+        instrument.event(
+            "user_graded", user_id=user.user_id, grade=user.grade, queued=total - graded
+        )
+        if CHECKPOINT is not None:
+            CHECKPOINT.changed()
+        utils.print_on_curline(f"grading ({graded}/{total})")
+
+    grade_longest_first(
+        users, test_skeleton, workers, interactive, on_graded=show_progress
+    )
     utils.print_on_curline(f"grading complete ({total}/{total})\n")
     return True
 
 
+def grade_in_background(
+    test_skeleton: TestSkeleton,
+    users: List[User],
+    only_ungraded: bool = False,
+    workers: int = 1,
+) -> int:
+    """
+    Queue users to be graded by BACKGROUND_GRADER while the menus stay usable.
+    The skeleton must not prompt for input.
+    :param workers: How many users to grade at once
+    :return: How many users were queued
+    """
+    global BACKGROUND_GRADER
+    if only_ungraded:
+        users = [u for u in users if u.grade is None or u.needs_regrade]
+    if BACKGROUND_GRADER is None or BACKGROUND_GRADER.test_skeleton is not test_skeleton:
+        if BACKGROUND_GRADER is not None:
+            BACKGROUND_GRADER.cancel_all()
+        background = BackgroundGrader(test_skeleton, workers)
+
+        def graded(user: User):
+            instrument.event(
+                "user_graded",
+                user_id=user.user_id,
+                grade=user.grade,
+                queued=background.counts()[BackgroundGrader.QUEUED],
+            )
+            if CHECKPOINT is not None:
+                CHECKPOINT.changed()
+
+        background.on_graded = graded
+        BACKGROUND_GRADER = background
+    return BACKGROUND_GRADER.submit(users)
+
+
+def grading_state(user: User) -> str:
+    """
+    :return: The user, with their background grading state if they are queued or running
+    """
+    if BACKGROUND_GRADER is not None:
+        state = BACKGROUND_GRADER.state(user)
+        if state in (BackgroundGrader.QUEUED, BackgroundGrader.RUNNING):
+            return f"{user} <{state}>"
+    return str(user)
+
+
+def sync_submissions(grader: PyCanvasGrader, users: List[User]) -> List[User]:
+    """
+    Fetch only the submissions submitted or graded since the last sync,
+    and download the new attempts among them.
+    Users with a new attempt are marked as needing a regrade; new users are appended to users.
+    :return: The users that changed
+    """
+    sync_started = utils.canvas_timestamp()
+    users_by_id = {user.user_id: user for user in users}
+    changed = []
+
+    for submission in grader.iter_changed_submissions(grader.last_sync):
+        if submission.get("workflow_state") == "unsubmitted":
+            continue
+        user = users_by_id.get(submission["user_id"])
+        if user is None:
+            if submission.get("attachments") is None:
+                continue
+            if grader.download_submission(submission):
+                user = User.from_submission(
+                    submission, grader.user(submission["user_id"]), grader.log_dir
+                )
+                user.needs_regrade = True
+                users.append(user)
+                changed.append(user)
+        elif user.apply_submission(grader, submission):
+            changed.append(user)
+        elif submission["score"] != user.last_posted_grade:
+            # Graded by someone else since the last sync
+            user.last_posted_grade = submission["score"]
+            user.grade_matches_submission = submission[
+                "grade_matches_current_submission"
+            ]
+            changed.append(user)
+
+    grader.last_sync = sync_started
+    return changed
+
+
 def submit_all_grades(grader: PyCanvasGrader, users: list) -> bool:
     modified = False
     user_data = []
@@ -211,28 +390,74 @@ def submit_all_grades(grader: PyCanvasGrader, users: list) -> bool:
     return modified
 
 
-def handle_signal(_, frame):
+def handle_signal(*_):
+    """
+    Save the users that changed since the last checkpoint.
+    Only waits briefly for a checkpoint that is already being written
+    """
     print("Received interrupt signal.")
-    grader = None
-    users = None
-    test_skeleton = None
+    if CHECKPOINT is None:
+        return
+    if CHECKPOINT.save(timeout=2):
+        print("Checkpoint saved.")
+    else:
+        print("A checkpoint is already being saved.")
 
-    while frame and None in (grader, users, test_skeleton):
-        try:
-            grader = frame.f_locals["grader"]
-            users = frame.f_locals["users"]
-            test_skeleton = frame.f_locals["test_skeleton"]
-        except KeyError:
-            grader, users, test_skeleton = None, None, None
-            frame = frame.f_back
-        else:
-            break
 
-    if grader and users and test_skeleton:
-        save_state(grader, test_skeleton, users)
+def start_checkpoint(
+    grader: PyCanvasGrader, test_skeleton: TestSkeleton, users: List[User], prefs: dict
+):
+    """
+    Save the session's state in the background from now on, unless autosave is disabled.
+    Either way, an interrupt signal saves it
+    """
+    global CHECKPOINT
+    session = prefs["session"]
+    CHECKPOINT = Checkpoint(
+        grader.cache_file,
+        grader,
+        test_skeleton,
+        users,
+        session.get("checkpoint_interval", 30),
+        session.get("checkpoint_changes", 20),
+        CACHE_COMPRESSION,
+    )
+    if not session.get("disable_autosave"):
+        CHECKPOINT.start()
+    enforce_cache_budget(grader, prefs)
+
 
+def cache_budget(prefs: dict) -> int:
+    """
+    :return: The most bytes .cache may hold, or 0 for no limit
+    """
+    return int(prefs["session"].get("cache_budget_mb", 0) * 1024 * 1024)
+
+
+def enforce_cache_budget(grader: PyCanvasGrader, prefs: dict):
+    """
+    Evict the least recently used assignment caches, other than grader's, until .cache
+    fits its budget
+    """
+    evicted = storage.enforce_budget(
+        os.path.join(os.environ["INSTALL_DIR"], ".cache"),
+        cache_budget(prefs),
+        keep=grader.cache_file,
+    )
+    for course_id, assignment_id, size in evicted:
+        print(
+            f"Evicted the cache of course {course_id}, assignment {assignment_id}",
+            f"({storage.format_size(size)}) to stay within cache_budget_mb.",
+        )
 
-def user_menu(grader: PyCanvasGrader, test_skeleton: TestSkeleton, user: User):
+
+def user_menu(
+    grader: PyCanvasGrader,
+    test_skeleton: TestSkeleton,
+    user: User,
+    users: List[User],
+    prefs: dict,
+):
     global CURRENTLY_SAVED
 
     # This way strings only need to be updated once
@@ -247,14 +472,23 @@ def user_menu(grader: PyCanvasGrader, test_skeleton: TestSkeleton, user: User):
         "update": "Update this user's submission",
         "clear": "Clear this user's grade",
         "back": "Return to the main menu",
+        "prioritize": "Grade this user next",
+        "cancel": "Cancel grading this user",
     }
 
     while True:
+        state = None if BACKGROUND_GRADER is None else BACKGROUND_GRADER.state(user)
+        grading = state in (BackgroundGrader.QUEUED, BackgroundGrader.RUNNING)
         options = []
-        if user.log.getvalue() != "":
-            options.append(possible_opts["rerun"])
+        if grading:
+            if state == BackgroundGrader.QUEUED:
+                options.append(possible_opts["prioritize"])
+            options.append(possible_opts["cancel"])
+        if not user.log.empty:
+            if not grading:
+                options.append(possible_opts["rerun"])
             options.append(possible_opts["log"])
-        else:
+        elif not grading:
             options.append(possible_opts["run"])
         if not user.submitted or not user.grade_matches_submission:
             options.append(possible_opts["submit"])
@@ -262,12 +496,14 @@ def user_menu(grader: PyCanvasGrader, test_skeleton: TestSkeleton, user: User):
         options.append(possible_opts["comment"])
         if user.comment != "":
             options.append(possible_opts["clear-comment"])
-        options.append(possible_opts["update"])
+        if not grading:
+            # Replacing the files while the tests run would corrupt the grade
+            options.append(possible_opts["update"])
         if user.grade is not None:
             options.append(possible_opts["clear"])
         options.append(possible_opts["back"])
 
-        print("User Menu |", user)
+        print("User Menu |", grading_state(user))
         if not user.submitted:
             if user.last_posted_grade is None:
                 print("Last posted grade: ungraded")
@@ -277,8 +513,16 @@ def user_menu(grader: PyCanvasGrader, test_skeleton: TestSkeleton, user: User):
         choice = choices.choose(options)
 
         if choice == possible_opts["log"]:
+            pager.view(user.log.lines, title=f"Test log | {user}")
+            utils.clear_screen()
+        elif choice == possible_opts["prioritize"]:
+            utils.clear_screen()
+            if BACKGROUND_GRADER.prioritize(user):
+                print("This user will be graded next.")
+        elif choice == possible_opts["cancel"]:
             utils.clear_screen()
-            print(user.log.getvalue())
+            if BACKGROUND_GRADER.cancel(user):
+                print("Grading cancelled. A running user stops after their current test.")
         elif choice in (possible_opts["rerun"], possible_opts["run"]):
             utils.clear_screen()
             grade_before = user.grade
@@ -328,6 +572,9 @@ def user_menu(grader: PyCanvasGrader, test_skeleton: TestSkeleton, user: User):
             utils.clear_screen()
             if user.update(grader):
                 CURRENTLY_SAVED = False
+                # The new attempt is in the workspace, which checkpoints do not save
+                if not prefs["session"].get("disable_autosave"):
+                    save_state(grader, test_skeleton, users)
                 print("A new submission has been downloaded for this user.")
             else:
                 print("No available updates for this user.")
@@ -343,18 +590,46 @@ def user_menu(grader: PyCanvasGrader, test_skeleton: TestSkeleton, user: User):
 
 
 def main_menu(
-    grader: PyCanvasGrader, test_skeleton: TestSkeleton, users: list, prefs: dict
+    grader: PyCanvasGrader,
+    test_skeleton: TestSkeleton,
+    users: list,
+    prefs: dict,
+    roster: Roster = None,
 ):
+    """
+    :param roster: The view of users to show, which keeps its page and filters between
+    calls. Default: a new view of every user
+    """
     global CURRENTLY_SAVED
+    roster = roster or Roster(users)
+    session = prefs["session"]
 
-    print("Main Menu\n-")
-    choices.list_choices(users)
+    if BACKGROUND_GRADER is not None and BACKGROUND_GRADER.take_finished():
+        roster.refresh()
+        if session.get("disable_autosave"):
+            CURRENTLY_SAVED = False
+        if BACKGROUND_GRADER.idle:
+            print("Background grading complete.")
+            if not session.get("disable_autosave"):
+                CHECKPOINT.save()
+    shown = roster.shown
+
+    print("Main Menu |", roster.header())
+    if BACKGROUND_GRADER is not None and not BACKGROUND_GRADER.idle:
+        counts = BACKGROUND_GRADER.counts()
+        print(
+            "Grading in the background: {queued} queued, {running} running, "
+            "{done} done (press enter to refresh)".format(**counts)
+        )
+    print("-")
+    choices.list_choices(shown, formatter=grading_state)
     print("-")
 
     options = {
         "grade_all": "Grade all submissions",
         "grade_ungraded": "Grade only ungraded submissions",
         "submit_all": "Submit all grades",
+        "sync": "Sync new and regraded submissions",
         "reload_skeleton": "Reload test skeleton",
         "save": "Save changes",
         "save_and_quit": "Save and quit",
@@ -366,6 +641,7 @@ def main_menu(
         options["grade_all"],
         options["grade_ungraded"],
         options["submit_all"],
+        options["sync"],
         options["reload_skeleton"],
     ]
     if not CURRENTLY_SAVED:
@@ -378,38 +654,68 @@ def main_menu(
         opt_list,
         (
             "Choose a user to work with that user individually,\n"
-            "or enter an action from the menu above."
+            "or enter an action from the menu above.\n" + Roster.HELP
         ),
         msg_below=True,
-        start_at=len(users) + 1,
+        start_at=len(shown) + 1,
     )
 
-    choice = choices.choose_int(len(opt_list) + len(users))
+    for command in iter(input, None):
+        if command.strip() == "" or roster.command(command.strip()):
+            utils.clear_screen()
+            return
+        try:
+            choice = int(command)
+        except ValueError:
+            continue
+        if 1 <= choice <= len(opt_list) + len(shown):
+            break
 
-    if choice <= len(users):
+    if choice <= len(shown):
         utils.clear_screen()
-        user_menu(grader, test_skeleton, users[choice - 1])
+        user_menu(grader, test_skeleton, shown[choice - 1], users, prefs)
     else:
-        selection = opt_list[choice - len(users) - 1]
-        if selection == options["grade_all"]:
+        selection = opt_list[choice - len(shown) - 1]
+        if selection in (options["grade_all"], options["grade_ungraded"]):
             utils.clear_screen()
-            success = grade_all_submissions(test_skeleton, users)
-            if success and not prefs["session"].get("disable_autosave"):
-                save_state(grader, test_skeleton, users)
-            elif success:
-                CURRENTLY_SAVED = False
-        elif selection == options["grade_ungraded"]:
-            utils.clear_screen()
-            success = grade_all_submissions(test_skeleton, users, only_ungraded=True)
-            if success and not prefs["session"].get("disable_autosave"):
-                save_state(grader, test_skeleton, users)
-            elif success:
-                CURRENTLY_SAVED = False
+            only_ungraded = selection == options["grade_ungraded"]
+            if session.get("background_grading", True) and not test_skeleton.interactive:
+                queued = grade_in_background(
+                    test_skeleton, users, only_ungraded, session.get("workers", 1)
+                )
+                if queued:
+                    print(f"Grading {queued} user(s) in the background.")
+                else:
+                    print("No currently ungraded submissions to grade.")
+            else:
+                success = grade_all_submissions(
+                    test_skeleton,
+                    users,
+                    only_ungraded=only_ungraded,
+                    workers=session.get("workers", 1),
+                )
+                # Grading only changes users, which are checkpointed on their own
+                if success and not session.get("disable_autosave"):
+                    CHECKPOINT.save()
+                elif success:
+                    CURRENTLY_SAVED = False
         elif selection == options["submit_all"]:
             utils.clear_screen()
             modified = submit_all_grades(grader, users)
             if modified:
                 CURRENTLY_SAVED = False
+        elif selection == options["sync"]:
+            utils.clear_screen()
+            changed = sync_submissions(grader, users)
+            if changed:
+                CURRENTLY_SAVED = False
+                # New attempts are in the workspace, which checkpoints do not save
+                if not session.get("disable_autosave"):
+                    save_state(grader, test_skeleton, users)
+                print(f"{len(changed)} submission(s) changed since the last sync:")
+                choices.list_choices(changed)
+            else:
+                print("No submissions have changed since the last sync.")
         elif selection == options["reload_skeleton"]:
             utils.clear_screen()
             if not test_skeleton.reload():
@@ -441,6 +747,9 @@ def main_menu(
 
             close_program(grader)
 
+    # Grades, statuses and the list of users may all have changed
+    roster.refresh()
+
 
 def startup(grader: PyCanvasGrader, prefs: dict) -> Tuple[int, int]:
     session = prefs["session"]
@@ -483,7 +792,9 @@ def startup(grader: PyCanvasGrader, prefs: dict) -> Tuple[int, int]:
                 )
                 preferences.dump(prefs, pf)
 
-    assignments = grader.assignments(ungraded=False)
+    assignments = grader.assignments(
+        ungraded=bool(session.get("only_ungraded_assignments"))
+    )
     if not assignments:
         input("No assignments were found. Press enter to restart")
         close_program(grader, restart=True)
@@ -502,56 +813,107 @@ def startup(grader: PyCanvasGrader, prefs: dict) -> Tuple[int, int]:
     return course_id, assignment_id
 
 
+def find_skeleton(skeleton_file: str) -> str:
+    """
+    Resolve a skeleton filename given as-is or relative to the skeletons directory
+    """
+    if os.path.exists(skeleton_file):
+        return skeleton_file
+    return os.path.join(os.environ["INSTALL_DIR"], "skeletons", skeleton_file)
+
+
+def download_submissions(
+    grader: PyCanvasGrader, ungraded_only: bool, workers: int = 1
+) -> Tuple[List[User], int, int]:
+    """
+    Download every submitted attempt of the current assignment
+    as each page of the submission listing arrives.
+    :param ungraded_only: Whether to skip submissions whose grade is already up to date
+    :param workers: How many submissions to download at once
+    :return: (The users whose submissions were downloaded, the number of submissions, the number of failed downloads)
+    """
+    grader.last_sync = utils.canvas_timestamp()
+    # Test times from the last saved session, to schedule grading by
+    history = load_test_times(grader.course_id, grader.assignment_id)
+
+    def download(submission: dict) -> Optional[User]:
+        if not grader.download_submission(submission):
+            return None
+        user = User.from_submission(
+            submission, grader.user(submission["user_id"]), grader.log_dir
+        )
+        user.test_times.update(history.get(user.user_id, {}))
+        return user
+
+    users = []
+    total = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = []
+        for submission in grader.iter_submissions():
+            if submission.get("workflow_state") == "unsubmitted":
+                continue
+            total += 1
+            if (
+                ungraded_only
+                and submission["grade_matches_current_submission"]
+                and submission["score"] is not None
+            ):
+                continue
+            if submission.get("attachments") is not None:
+                futures.append(executor.submit(download, submission))
+
+        for count, future in enumerate(futures, 1):
+            utils.print_on_curline(
+                "downloading submissions... ({}/{})".format(count, len(futures))
+            )
+            user = future.result()
+            if user is None:
+                failed += 1
+            else:
+                users.append(user)
+    return users, total, failed
+
+
+def choose_skeleton(prefs: dict) -> TestSkeleton:
+    skeleton_cache = SkeletonCache(
+        os.path.join(os.environ["INSTALL_DIR"], ".cache", "skeletons")
+    )
+    selected_skeleton = None
+    if prefs["quickstart"].get("skeleton"):
+        selected_skeleton = skeleton_cache.skeleton(
+            find_skeleton(prefs["quickstart"].get("skeleton"))
+        )
+
+    while selected_skeleton is None:
+        # Only the chosen skeleton is built; the picker needs just the descriptors
+        skeleton_list = skeleton_cache.descriptors(
+            os.path.join(os.environ["INSTALL_DIR"], "skeletons")
+        )
+        file_path, _ = choices.choose(
+            skeleton_list,
+            "Choose a skeleton to use for grading this assignment:",
+            formatter=lambda listed: listed[1],
+        )
+        selected_skeleton = skeleton_cache.skeleton(file_path)
+    return selected_skeleton
+
+
 def grade_assignment(grader: PyCanvasGrader, prefs: dict):
     session = prefs["session"]
-    quickstart = prefs["quickstart"]
-
-    # Get list of submissions for this assignment
-    submission_list = [
-        s for s in grader.submissions() if s.get("workflow_state") != "unsubmitted"
-    ]
-    if len(submission_list) < 1:
-        input("There are no submissions for this assignment. Press enter to restart")
-        close_program(grader, restart=True)
 
     ungraded_only = session.get("only_download_ungraded")
     if ungraded_only is None:
         print("Only download currently ungraded submissions? (y or n):")
         ungraded_only = choices.choose_bool()
 
-    # Create users from submissions
-    users = []
-    total = len(submission_list)
-    failed = 0
-
     utils.clear_screen()
-    for count, submission in enumerate(submission_list):
-        if (
-            ungraded_only
-            and submission["grade_matches_current_submission"]
-            and submission["score"] is not None
-        ):
-            continue
-        user_id = submission.get("user_id")
-        if submission.get("attachments") is not None:
-            utils.print_on_curline(
-                "downloading submissions... ({}/{})".format(count, total)
-            )
-            if grader.download_submission(submission):
-                user_data = grader.user(user_id)
-                users.append(
-                    User(
-                        user_id,
-                        submission["id"],
-                        user_data["name"],
-                        user_data.get("email"),
-                        submission["score"],
-                        submission["grade_matches_current_submission"],
-                        submission["attempt"],
-                    )
-                )
-            else:
-                failed += 1
+    users, total, failed = download_submissions(
+        grader, ungraded_only, session.get("workers", 1)
+    )
+    if total < 1:
+        input("There are no submissions for this assignment. Press enter to restart")
+        close_program(grader, restart=True)
     utils.print_on_curline(
         "Submissions downloaded. ({} total, {} failed to validate)\n\n".format(
             total, failed
@@ -561,45 +923,628 @@ def grade_assignment(grader: PyCanvasGrader, prefs: dict):
     if len(users) == 0:
         print("No submissions yet for this assignment.")
 
-    selected_skeleton = None
-    if quickstart.get("skeleton"):
-        selected_skeleton = TestSkeleton.parse_skeleton(quickstart.get("skeleton"))
-
-    if selected_skeleton is None:
-        skeleton_list = TestSkeleton.parse_skeletons(
-            os.path.join(os.environ.get("INSTALL_DIR"), "skeletons")
-        )
-        selected_skeleton = choices.choose(
-            skeleton_list,
-            "Choose a skeleton to use for grading this assignment:",
-            formatter=lambda skel: skel.descriptor,
-        )
+    selected_skeleton = choose_skeleton(prefs)
+    start_checkpoint(grader, selected_skeleton, users, prefs)
     if not session.get("disable_autosave"):
         save_state(grader, selected_skeleton, users)
 
     # Display main menu
+    roster = Roster(users)
     while True:
-        main_menu(grader, selected_skeleton, users, prefs)
+        main_menu(grader, selected_skeleton, users, prefs, roster)
+
+
+def watch(grader: PyCanvasGrader, test_skeleton: TestSkeleton, prefs: dict):
+    """
+    Grade new attempts as they are submitted, until interrupted.
+
+    Canvas is polled for submissions changed since the last poll. The polling interval
+    starts at min_interval and doubles after every idle poll up to max_interval.
+    The session cache doubles as the checkpoint: a restarted watch loads it and only
+    grades attempts newer than the cached ones. Each poll saves only the users that
+    changed. The workspace is saved after polls that download new attempts, and on exit.
+    """
+    watch_prefs = prefs["watch"]
+    min_interval = watch_prefs.get("min_interval", 60)
+    max_interval = watch_prefs.get("max_interval", 900)
+    post_grades = watch_prefs.get("post_grades", False) and not test_skeleton.disarm
+
+    users = []
+    if os.path.exists(os.path.join(grader.cache_file, ".cachefile")):
+        try:
+            _, users, grader.last_sync = load_state(
+                grader.course_id, grader.assignment_id
+            )
+        except:
+            print("The cached session is invalid, starting from scratch.")
+            init_tempdir()
+            users = []
+        else:
+            print(f"Resuming from a checkpoint with {len(users)} user(s).")
+    start_checkpoint(grader, test_skeleton, users, prefs)
+
+    interval = min_interval
+    try:
+        while True:
+            changed = sync_submissions(grader, users)
+            to_grade = [user for user in users if user.needs_regrade]
+            if to_grade:
+                # Nobody is at the keyboard to answer a test's prompts
+                grade_all_submissions(test_skeleton, to_grade, interactive=False)
+            if post_grades:
+                submit_all_grades(grader, users)
+            if to_grade:
+                # New attempts were downloaded, so the saved workspace is out of date
+                CHECKPOINT.snapshot(workspace=True)
+            else:
+                CHECKPOINT.save()
+
+            if changed or to_grade:
+                interval = min_interval
+            else:
+                interval = min(interval * 2, max_interval)
+            print(
+                f"[{datetime.now():%H:%M:%S}]",
+                f"{len(changed)} changed, {len(to_grade)} graded.",
+                f"Next poll in {interval}s.",
+            )
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopping watch mode.")
+        CHECKPOINT.stop()
+        save_state(grader, test_skeleton, users)
+
+
+def watch_main(grader: PyCanvasGrader, prefs: dict) -> int:
+    """
+    Entry point for --watch. Nothing is prompted for: the role, course, assignment and
+    skeleton must all be given as options or in the [quickstart] preferences
+    :return: The process exit status
+    """
+    quickstart = prefs["quickstart"]
+    missing = [
+        option
+        for option, pref in (
+            ("--role", "role"),
+            ("--course", "course_id"),
+            ("--assignment", "assignment_id"),
+            ("--skeleton", "skeleton"),
+        )
+        if not quickstart.get(pref)
+    ]
+    if missing:
+        print("--watch requires", ", ".join(missing), file=sys.stderr)
+        return 2
+
+    try:
+        role = Enrollment[str(quickstart["role"]).lower()]
+    except KeyError:
+        print(f'Unknown role "{quickstart["role"]}"', file=sys.stderr)
+        return 2
+    course_id, assignment_id = quickstart["course_id"], quickstart["assignment_id"]
+    if not any(course.get("id") == course_id for course in grader.iter_courses(role)):
+        print(f"No course {course_id} was found for the {role} role", file=sys.stderr)
+        return 2
+    grader.course_id = course_id
+    if not any(a.get("id") == assignment_id for a in grader.iter_assignments(False)):
+        print(f"No assignment {assignment_id} was found", file=sys.stderr)
+        return 2
+    grader.assignment_id = assignment_id
+
+    test_skeleton = TestSkeleton.parse_skeleton(find_skeleton(quickstart["skeleton"]))
+    if test_skeleton is None:
+        print(f'Invalid skeleton "{quickstart["skeleton"]}"', file=sys.stderr)
+        return 2
+
+    watch(grader, test_skeleton, prefs)
+    return 0
+
+
+def run_batch(
+    grader: PyCanvasGrader, prefs: dict, job_specs: List[Tuple[int, int, str]]
+) -> dict:
+    """
+    Download, grade, and optionally post every submission of several assignments without any prompts.
+    All assignments share grader's session and rate limit, one download pool and one grading pool.
+    Each assignment gets its own .temp/jobs/<course>/<assignment> workspace and its own cache.
+    :param job_specs: (course_id, assignment_id, skeleton file) for each assignment
+    :return: A JSON-compatible summary of the run
+    """
+    session = prefs["session"]
+    workers = session.get("workers", 1)
+    started = time.time()
+
+    jobs = []
+    for course_id, assignment_id, skeleton_file in job_specs:
+        test_skeleton = TestSkeleton.parse_skeleton(find_skeleton(skeleton_file))
+        if test_skeleton is None:
+            raise ValueError(f'Invalid skeleton "{skeleton_file}"')
+        workspace = os.path.join(
+            grader.temp_dir, "jobs", str(course_id), str(assignment_id)
+        )
+        job_grader = grader.for_assignment(course_id, assignment_id, workspace)
+        job_grader.last_sync = utils.canvas_timestamp()
+        jobs.append(
+            Job(
+                job_grader,
+                test_skeleton,
+                bool(session.get("only_download_ungraded")),
+                load_test_times(course_id, assignment_id),
+            )
+        )
+
+    coordinator = None
+    if session.get("coordinate"):
+        coordinator = Coordinator(
+            distributed.parse_address(session["coordinate"]), cluster_key()
+        )
+        coordinator.start()
+        print("Waiting for workers on {}:{}".format(*coordinator.address))
+    try:
+        BatchScheduler(
+            session.get("download_workers", 8), workers, coordinator
+        ).run(jobs)
+    finally:
+        if coordinator is not None:
+            coordinator.close()
+
+    summaries = []
+    for job in jobs:
+        posted = [user for user in job.users if not user.submitted]
+        if session.get("post_grades") and not job.test_skeleton.disarm:
+            submit_all_grades(job.grader, job.users)
+        else:
+            posted = []
+
+        if not session.get("disable_autosave"):
+            save_state(job.grader, job.test_skeleton, job.users)
+
+        summaries.append(
+            {
+                "course_id": job.grader.course_id,
+                "assignment_id": job.grader.assignment_id,
+                "skeleton": job.test_skeleton.file_path,
+                "error": job.error,
+                "submissions": job.total,
+                "downloaded": len(job.users),
+                "failed_downloads": job.failed,
+                "graded": sum(1 for user in job.users if user.grade is not None),
+                "posted": len(posted),
+                "users": [
+                    {
+                        "user_id": user.user_id,
+                        "name": user.name,
+                        "attempt": user.attempt,
+                        "grade": user.grade,
+                        "posted": user.submitted,
+                    }
+                    for user in job.users
+                ],
+            }
+        )
+
+    return {"seconds": round(time.time() - started, 3), "jobs": summaries}
+
+
+def cluster_key() -> bytes:
+    """
+    The shared key for --coordinate and --worker connections
+    """
+    try:
+        return os.environ["PYCANVASGRADER_AUTHKEY"].encode("UTF-8")
+    except KeyError:
+        raise ValueError(
+            "Set PYCANVASGRADER_AUTHKEY to the same secret on the coordinator and every worker"
+        )
+
+
+def worker_main(address: str) -> int:
+    """
+    Entry point for --worker
+    :return: The process exit status
+    """
+    try:
+        authkey = cluster_key()
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    work_dir = os.path.join(os.environ["INSTALL_DIR"], ".temp", f"worker-{os.getpid()}")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        graded = distributed.run_worker(
+            distributed.parse_address(address), authkey, work_dir
+        )
+    except (OSError, AuthenticationError) as e:
+        print("Could not work for the coordinator at", address + ":", e, file=sys.stderr)
+        return 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"Graded {graded} user(s).")
+    return 0
+
+
+def start_profiler(trace_file: str, top: int):
+    """
+    Record spans until the program exits, then write them to trace_file and print a summary
+    """
+    profiler = instrument.Profiler().start()
+
+    def write_profile():
+        profiler.stop()
+        try:
+            with open(trace_file, "w") as f:
+                json.dump(profiler.chrome_trace(), f)
+        except OSError as e:
+            print("Could not write the profile to", trace_file + ":", e, file=sys.stderr)
+        print("\n" + profiler.summary(top), file=sys.stderr)
+
+    atexit.register(write_profile)
+
+
+def calibrate_main(args: argparse.Namespace) -> int:
+    """
+    Entry point for --calibrate
+    :return: The process exit status
+    """
+    if not args.skeleton:
+        print("--calibrate needs a --skeleton to calibrate", file=sys.stderr)
+        return 2
+    skeleton_file = find_skeleton(args.skeleton)
+    test_skeleton = TestSkeleton.parse_skeleton(skeleton_file)
+    if test_skeleton is None:
+        print(f'Invalid skeleton "{args.skeleton}"', file=sys.stderr)
+        return 2
+    if not os.path.isdir(args.calibrate):
+        print(f'"{args.calibrate}" is not a directory', file=sys.stderr)
+        return 2
+
+    print(
+        f"Running {test_skeleton.descriptor} against {args.calibrate} {args.runs} time(s)..."
+    )
+    timings = calibration.calibrate(
+        test_skeleton,
+        args.calibrate,
+        os.path.join(os.environ["INSTALL_DIR"], ".temp"),
+        max(args.runs, 1),
+    )
+
+    timeouts = {}
+    print(f"{'test':<24}{'median':>10}{'max':>10}{'timeout':>10}{'suggested':>11}")
+    for timing in timings:
+        suggested = calibration.suggested_timeout(timing, args.timeout_factor)
+        if timing.samples:
+            median = f"{statistics.median(timing.samples):.3f}"
+            slowest = f"{max(timing.samples):.3f}"
+        else:
+            median = slowest = "-"
+        current = "-" if timing.timeout is None else timing.timeout
+        note = f"  ({timing.failures} failed run(s))" if timing.failures else ""
+        print(
+            f"{timing.name:<24}{median:>10}{slowest:>10}{current:>10}"
+            f"{'-' if suggested is None else suggested:>11}{note}"
+        )
+        # A test that ever failed on the reference solution needs a human to look at it
+        if suggested is not None and not timing.failures:
+            timeouts[timing.name] = suggested
+
+    if args.apply_timeouts:
+        try:
+            calibration.write_timeouts(skeleton_file, timeouts)
+        except (OSError, ValueError, KeyError) as e:
+            print("Could not update", skeleton_file + ":", e, file=sys.stderr)
+            return 1
+        print(f"Wrote {len(timeouts)} timeout(s) to {skeleton_file}")
+    return 1 if any(timing.failures for timing in timings) else 0
+
+
+def job_spec(spec: str) -> Tuple[int, int, str]:
+    """
+    Parse a --job option of the form COURSE:ASSIGNMENT:SKELETON
+    """
+    try:
+        course_id, assignment_id, skeleton_file = spec.split(":", 2)
+        return int(course_id), int(assignment_id), skeleton_file
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'"{spec}" is not of the form COURSE:ASSIGNMENT:SKELETON'
+        )
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="pycanvasgrader",
+        description="Automates the grading of programming assignments on Canvas.",
+    )
+    parser.add_argument(
+        "--ua",
+        "--ungraded-assignments",
+        dest="ungraded_assignments",
+        action="store_true",
+        help="Only list assignments that have ungraded work",
+    )
+    parser.add_argument(
+        "--us",
+        "--ungraded-submissions",
+        dest="ungraded_submissions",
+        action="store_true",
+        help="Only download submissions that are currently ungraded",
+    )
+    parser.add_argument("--course", type=int, help="The ID of the course to grade")
+    parser.add_argument(
+        "--assignment", type=int, help="The ID of the assignment to grade"
+    )
+    parser.add_argument(
+        "--role",
+        choices=[role.name for role in Enrollment],
+        help="The class role to find --course with",
+    )
+    parser.add_argument(
+        "--skeleton", help="The skeleton file to grade with (path or name in skeletons/)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="How many submissions to download and grade at once",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        help="How many submissions to download at once in --batch mode",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        help="The most Canvas API requests to start per second",
+    )
+    parser.add_argument(
+        "--job",
+        action="append",
+        type=job_spec,
+        default=[],
+        metavar="COURSE:ASSIGNMENT:SKELETON",
+        help="An assignment for --batch to grade; repeat to grade several at once",
+    )
+    parser.add_argument(
+        "--post-grades",
+        action="store_true",
+        help="Post grades to Canvas when a --batch run finishes",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Grade --course/--assignment with --skeleton without any menus or prompts",
+    )
+    parser.add_argument(
+        "--summary",
+        metavar="FILE",
+        help='Where --batch writes its JSON summary ("-" for stdout)',
+    )
+    parser.add_argument(
+        "--coordinate",
+        metavar="HOST:PORT",
+        help="Have --batch grade on remote --worker processes that connect to this address",
+    )
+    parser.add_argument(
+        "--worker",
+        metavar="HOST:PORT",
+        help="Grade for the --coordinate process at this address until it is finished",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Grade new submissions continuously, without menus or prompts "
+        "(needs --role, --course, --assignment and --skeleton, or their preferences)",
+    )
+    parser.add_argument(
+        "--calibrate",
+        metavar="DIR",
+        help="Time --skeleton against the reference solution in DIR and suggest test timeouts",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="How many times --calibrate runs the skeleton (default: 5)",
+    )
+    parser.add_argument(
+        "--timeout-factor",
+        type=float,
+        default=3.0,
+        help="Suggested timeouts are this many times the slowest reference run (default: 3)",
+    )
+    parser.add_argument(
+        "--apply-timeouts",
+        action="store_true",
+        help="Write the timeouts suggested by --calibrate into the skeleton file",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Time API calls, downloads, tests and saves; write a Chrome trace to FILE "
+        "and print the slowest operations on exit",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=10,
+        metavar="N",
+        help="How many of the slowest operations of each phase --profile prints (default: 10)",
+    )
+    parser.add_argument(
+        "--api-url",
+        metavar="URL",
+        help="The Canvas API to use, such as a local mock server "
+        "(default: $CANVAS_API_URL or https://sit.instructure.com/api/v1)",
+    )
+    parser.add_argument(
+        "--event-log",
+        metavar="FILE",
+        help="Append downloads, test runs, grades and API throttling to FILE as JSON lines",
+    )
+    parser.add_argument(
+        "--disk-usage",
+        action="store_true",
+        help="Show how much disk each course and assignment cache uses, and exit",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="HOST:PORT",
+        help="Serve Prometheus metrics at http://HOST:PORT/metrics while the grader runs",
+    )
+    return parser.parse_args(argv)
+
+
+def apply_args(prefs: dict, args: argparse.Namespace):
+    """
+    Override preferences with the options given on the command line
+    """
+    quickstart = prefs["quickstart"]
+    session = prefs["session"]
+    if args.course is not None:
+        quickstart["course_id"] = args.course
+    if args.assignment is not None:
+        quickstart["assignment_id"] = args.assignment
+    if args.role:
+        quickstart["role"] = args.role
+    if args.skeleton:
+        quickstart["skeleton"] = args.skeleton
+    if args.ungraded_assignments:
+        session["only_ungraded_assignments"] = True
+    if args.ungraded_submissions:
+        session["only_download_ungraded"] = True
+    if args.workers is not None:
+        session["workers"] = args.workers
+    if args.download_workers is not None:
+        session["download_workers"] = args.download_workers
+    if args.rate_limit is not None:
+        session["rate_limit"] = args.rate_limit
+    if args.coordinate:
+        session["coordinate"] = args.coordinate
+    if args.post_grades:
+        session["post_grades"] = True
+    if args.api_url:
+        session["api_url"] = args.api_url
+
+
+def batch_main(
+    grader: PyCanvasGrader,
+    prefs: dict,
+    job_specs: List[Tuple[int, int, str]],
+    summary_file: str = None,
+) -> int:
+    """
+    Entry point for --batch
+    :param job_specs: The --job options. If empty, the course, assignment and skeleton preferences are used
+    :return: The process exit status
+    """
+    if not job_specs:
+        quickstart = prefs["quickstart"]
+        missing = [
+            option
+            for option, pref in (
+                ("--course", "course_id"),
+                ("--assignment", "assignment_id"),
+                ("--skeleton", "skeleton"),
+            )
+            if not quickstart.get(pref)
+        ]
+        if missing:
+            print("--batch requires --job or", ", ".join(missing), file=sys.stderr)
+            return 2
+        job_specs = [
+            (
+                quickstart["course_id"],
+                quickstart["assignment_id"],
+                quickstart["skeleton"],
+            )
+        ]
+
+    # Keep stdout clean for the summary when it is written there
+    progress_out = sys.stderr if summary_file == "-" else sys.stdout
+    with redirect_stdout(progress_out):
+        try:
+            summary = run_batch(grader, prefs, job_specs)
+        except (ValueError, KeyError, requests.RequestException) as e:
+            print("Batch grading failed:", e, file=sys.stderr)
+            return 1
+
+    if summary_file == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif summary_file:
+        with open(summary_file, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 0
 
 
 def main():
-    global CURRENTLY_SAVED
+    global CURRENTLY_SAVED, CACHE_COMPRESSION
+
+    args = parse_args()
 
     if sys.version_info < (3, 6):
         print("Python 3.6+ is required")
         exit(1)
 
-    signal.signal(signal.SIGINT, handle_signal)
-
-    utils.clear_screen()
+    if not (args.batch or args.watch or args.worker or args.calibrate):
+        signal.signal(signal.SIGINT, handle_signal)
+        utils.clear_screen()
 
     os.environ["INSTALL_DIR"] = os.getcwd()
+    if args.profile:
+        start_profiler(os.path.abspath(args.profile), args.profile_top)
+    if args.event_log:
+        atexit.register(monitoring.EventLog(os.path.abspath(args.event_log)).start().stop)
+    if args.metrics:
+        metrics = monitoring.Metrics().start()
+        metrics.serve(distributed.parse_address(args.metrics))
+
+    if args.disk_usage:
+        print(
+            storage.usage_report(
+                os.path.join(os.environ["INSTALL_DIR"], ".cache"),
+                cache_budget(load_preferences()),
+            )
+        )
+        exit(0)
+
+    if args.worker:
+        # Workers never talk to Canvas, so they need no token or preferences
+        os.makedirs(".temp", exist_ok=True)
+        exit(worker_main(args.worker))
+
+    if args.calibrate:
+        os.makedirs(".temp", exist_ok=True)
+        exit(calibrate_main(args))
 
     init_tempdir()
     # Initialize grading session and fetch courses
     grader = PyCanvasGrader()
 
     prefs = load_preferences()
+    apply_args(prefs, args)
+    compression = prefs["session"].get("cache_compression", CACHE_COMPRESSION)
+    if compression in storage.CODECS:
+        CACHE_COMPRESSION = compression
+    else:
+        print(f'Unknown cache_compression "{compression}", using {CACHE_COMPRESSION}.')
+    grader.session.max_per_second = prefs["session"].get("rate_limit", 0)
+    grader.extract_archives = prefs["session"].get("extract_archives", True)
+    if prefs["session"].get("api_url"):
+        grader.api_url = prefs["session"]["api_url"].rstrip("/")
+    if not prefs["session"].get("disable_http_cache"):
+        grader.enable_http_cache(prefs["session"].get("http_cache_max_age", 0))
+
+    if args.batch:
+        status = batch_main(grader, prefs, args.job, args.summary)
+        grader.close()
+        exit(status)
+
+    if args.watch:
+        status = watch_main(grader, prefs)
+        grader.close()
+        exit(status)
+
     grader.course_id, grader.assignment_id = startup(grader, prefs)
 
     if not prefs["session"].get("ignore_cache") and os.path.exists(grader.cache_file):
@@ -611,7 +1556,7 @@ def main():
         print("Would you like to load it? (y or n)")
         if choices.choose_bool():
             try:
-                test_skeleton, users = load_state(
+                test_skeleton, users, grader.last_sync = load_state(
                     grader.course_id, grader.assignment_id
                 )
             except:
@@ -620,8 +1565,10 @@ def main():
             else:
                 print("Loaded cached version of this grading session.")
                 CURRENTLY_SAVED = True
+                start_checkpoint(grader, test_skeleton, users, prefs)
+                roster = Roster(users)
                 while True:
-                    main_menu(grader, test_skeleton, users, prefs)
+                    main_menu(grader, test_skeleton, users, prefs, roster)
         else:
             grade_assignment(grader, prefs)
     else:
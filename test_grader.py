@@ -5,6 +5,7 @@ Unit tests for PyCanvasGrader
 import json
 
 # 3rd-party
+import pytest
 import requests
 
 # package-specific
@@ -46,3 +47,1760 @@ class TestGrader:
         course_id = g.courses('teacher')[0].get('id')
         assignment_id = g.assignments(course_id, ungraded=False)[0].get('id')
         assert type(g.submissions(course_id, assignment_id)) == list
+
+
+class TestAsyncClient:
+    def test_async_client_against_mock_canvas(self, tmp_path, monkeypatch):
+        """
+        Make sure AsyncPyCanvasGrader lists, resumes interrupted downloads, unpacks
+        archives into its workspace and grades like PyCanvasGrader
+        """
+        import asyncio
+        import io
+        import os
+        import zipfile
+
+        from lib.canvas_api.async_canvas_api import AsyncPyCanvasGrader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        course = generate_course(students=120, assignments=1, seed=3)
+        canvas = MockCanvas([course], interrupt_after=4096)
+        api_url = canvas.serve()
+
+        async def session(grader):
+            async with grader:
+                submissions = [s for s in await grader.submissions() if s["attachments"]]
+                big, packed = submissions[0], submissions[1]
+                big["attachments"] = big["attachments"][:1]
+                data = os.urandom(10000)
+                course.files[big["attachments"][0]["id"]] = data
+                big["attachments"][0]["size"] = len(data)
+
+                archive = io.BytesIO()
+                with zipfile.ZipFile(archive, "w") as zip_file:
+                    zip_file.writestr("work/main.py", "print('packed')\n")
+                attachment = packed["attachments"][0]
+                packed["attachments"] = [attachment]
+                attachment["filename"] = "work.zip"
+                course.files[attachment["id"]] = archive.getvalue()
+                attachment["size"] = len(archive.getvalue())
+
+                downloaded = await grader.download_submissions(submissions)
+                graded = await grader.grade_submissions([(big["user_id"], 7, "")])
+                return submissions, data, downloaded, graded
+
+        loop = asyncio.new_event_loop()
+        try:
+            grader = AsyncPyCanvasGrader(
+                course_id=1,
+                assignment_id=course.assignments[0]["id"],
+                workspace=str(tmp_path / "workspace"),
+                api_url=api_url,
+            )
+            submissions, data, downloaded, graded = loop.run_until_complete(
+                session(grader)
+            )
+        finally:
+            loop.close()
+            canvas.stop()
+
+        assert len(submissions) > 100  # More than one page
+        assert all(downloaded) and graded
+        workspace = tmp_path / "workspace"
+        big, packed = submissions[0], submissions[1]
+        big_dir = workspace / str(big["user_id"])
+        assert [path.name for path in big_dir.iterdir()] == ["main.py"]
+        assert (big_dir / "main.py").read_bytes() == data
+        packed_dir = workspace / str(packed["user_id"])
+        assert (packed_dir / "main.py").read_text() == "print('packed')\n"
+        assert not (packed_dir / "work.zip").exists()
+        for submission in submissions[2:]:
+            for attachment in submission["attachments"]:
+                path = workspace / str(submission["user_id"]) / attachment["filename"]
+                assert path.read_bytes() == course.files[attachment["id"]]
+
+    def test_async_client_backs_off_when_throttled(self, monkeypatch):
+        """
+        Make sure AsyncPyCanvasGrader retries requests that Canvas throttles with the
+        same backoff as CanvasSession
+        """
+        import asyncio
+
+        from lib.canvas_api.async_canvas_api import AsyncPyCanvasGrader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+        from lib.core import instrument
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        sleep = asyncio.sleep
+
+        async def short_sleep(seconds, *args, **kwargs):
+            # The mock refills its rate limit quickly, so the real waits are scaled down
+            await sleep(seconds / 10, *args, **kwargs)
+
+        monkeypatch.setattr(asyncio, "sleep", short_sleep)
+        course = generate_course(students=5, assignments=1, seed=4)
+        canvas = MockCanvas([course], rate_limit=20, burst=1)
+        api_url = canvas.serve()
+
+        async def session(grader):
+            async with grader:
+                return [await grader.courses() for _ in range(5)]
+
+        events = []
+        instrument.add_event_listener(events.append)
+        loop = asyncio.new_event_loop()
+        try:
+            listings = loop.run_until_complete(
+                session(AsyncPyCanvasGrader(api_url=api_url))
+            )
+        finally:
+            loop.close()
+            instrument.remove_event_listener(events.append)
+            canvas.stop()
+
+        assert all([c["id"] for c in courses] == [1] for courses in listings)
+        assert canvas.throttled > 0
+        throttled = [e for e in events if e.name == "api_throttled"]
+        assert len(throttled) == canvas.throttled
+        assert all(
+            event.fields["wait"] == 2 ** (event.fields["attempt"] - 1)
+            for event in throttled
+        )
+
+
+class TestCanvasSession:
+    def test_throttled_requests_back_off_and_retry(self, monkeypatch):
+        """
+        Make sure requests that Canvas throttles are retried with exponential backoff
+        until they succeed
+        """
+        import time
+
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+        from lib.core import instrument
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        sleep = time.sleep
+        waits = []
+
+        def short_sleep(seconds):
+            # The mock refills its rate limit quickly, so the real waits are scaled down
+            waits.append(seconds)
+            sleep(seconds / 10)
+
+        monkeypatch.setattr("lib.canvas_api.canvas_api.time.sleep", short_sleep)
+        course = generate_course(students=5, assignments=1, seed=4)
+        canvas = MockCanvas([course], rate_limit=20, burst=1)
+        api_url = canvas.serve()
+        events = []
+        instrument.add_event_listener(events.append)
+        try:
+            grader = Grader(api_url=api_url)
+            for _ in range(5):
+                assert [c["id"] for c in grader.courses()] == [1]
+        finally:
+            instrument.remove_event_listener(events.append)
+            canvas.stop()
+
+        assert canvas.throttled > 0
+        throttled = [e for e in events if e.name == "api_throttled"]
+        assert len(throttled) == canvas.throttled
+        assert waits == [2 ** (event.fields["attempt"] - 1) for event in throttled]
+
+    def test_next_page_is_prefetched(self, monkeypatch):
+        """
+        Make sure the next page of a listing is requested while the current page is
+        still being consumed, and that items keep their order
+        """
+        import threading
+
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        course = generate_course(students=250, assignments=1, seed=4)
+        canvas = MockCanvas([course])
+        api_url = canvas.serve()
+        try:
+            grader = Grader(api_url=api_url)
+            grader.course_id = 1
+            grader.assignment_id = course.assignments[0]["id"]
+            expected = grader.submissions()
+
+            get_json = grader._get_json
+            requested = []
+            second_page = threading.Event()
+
+            def recording_get_json(url, cached=True):
+                requested.append(url)
+                if len(requested) == 2:
+                    second_page.set()
+                return get_json(url, cached)
+
+            grader._get_json = recording_get_json
+            listing = grader.iter_submissions()
+            first = next(listing)
+            # The first page has only just been handed over, yet the second is on its way
+            assert second_page.wait(5)
+            assert [first] + list(listing) == expected
+            assert len(requested) == 3
+        finally:
+            canvas.stop()
+
+
+class TestMetadataCache:
+    def test_revalidation_max_age_and_offline_fallback(self, tmp_path):
+        """
+        Make sure cached listings are revalidated with their ETag, served without a
+        request within max_age, and served from disk when Canvas cannot be reached
+        """
+        from lib.canvas_api.http_cache import MetadataCache
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        course = generate_course(students=5, assignments=1, seed=5)
+        canvas = MockCanvas([course])
+        api_url = canvas.serve()
+        url = f"{api_url}/courses"
+        statuses = []
+        session = requests.Session()
+        session.hooks["response"].append(
+            lambda response, *args, **kwargs: statuses.append(response.status_code)
+        )
+        cache = MetadataCache(str(tmp_path / "http"), "token")
+        try:
+            body, next_url = cache.get(session, url)
+            assert body[0]["id"] == 1 and next_url is None
+            assert cache.get(session, url) == (body, None)
+            assert statuses == [200, 304]
+
+            course.course["name"] = "Renamed"
+            changed, _ = cache.get(session, url)
+            assert changed[0]["name"] == "Renamed" and statuses[-1] == 200
+
+            fresh = MetadataCache(str(tmp_path / "http"), "token", max_age=60)
+            requests_before = canvas.requests
+            assert fresh.get(session, url)[0] == changed
+            assert canvas.requests == requests_before
+
+            # Another token never sees these responses
+            other = MetadataCache(str(tmp_path / "http"), "other token", max_age=60)
+            assert other.load(url) is None
+        finally:
+            canvas.stop()
+
+        # Drop the kept-alive connection, so the next requests find nothing listening
+        session.close()
+        assert cache.get(session, url)[0] == changed
+        with pytest.raises(requests.ConnectionError):
+            cache.get(session, f"{api_url}/courses/1/assignments")
+
+
+class TestDeltaSync:
+    def test_only_changed_attempts_are_downloaded(self, tmp_path, monkeypatch):
+        """
+        Make sure a sync after the first one downloads only new attempts, flags them
+        for regrading, and picks up grades posted by someone else
+        """
+        from datetime import datetime, timedelta
+
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api import utils
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        from .pycanvasgrader import sync_submissions
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        course = generate_course(students=30, assignments=1, seed=6)
+        assignment_id = course.assignments[0]["id"]
+        canvas = MockCanvas([course])
+        api_url = canvas.serve()
+        try:
+            grader = Grader(api_url=api_url, workspace=str(tmp_path / "workspace"))
+            grader.course_id = 1
+            grader.assignment_id = assignment_id
+            downloaded = []
+            download_submission = grader.download_submission
+
+            def recording_download(submission):
+                downloaded.append(submission["user_id"])
+                return download_submission(submission)
+
+            grader.download_submission = recording_download
+
+            users = []
+            assert len(sync_submissions(grader, users)) == len(users) > 2
+            assert sorted(downloaded) == sorted(user.user_id for user in users)
+            for user in users:
+                user.needs_regrade = False
+
+            resubmitted, regraded = users[0], users[1]
+            later = utils.canvas_timestamp(datetime.utcnow() + timedelta(minutes=1))
+            submission = course.submissions[assignment_id][resubmitted.user_id]
+            submission.update(attempt=resubmitted.attempt + 1, submitted_at=later)
+            attachment = submission["attachments"][0]
+            course.files[attachment["id"]] = b"print('new')\n"
+            attachment["size"] = len(course.files[attachment["id"]])
+            course.submissions[assignment_id][regraded.user_id].update(
+                score=4.0, graded_at=later
+            )
+
+            downloaded.clear()
+            changed = sync_submissions(grader, users)
+            assert downloaded == [resubmitted.user_id]
+            assert changed == [resubmitted, regraded]
+            assert resubmitted.needs_regrade and not regraded.needs_regrade
+            assert resubmitted.attempt == submission["attempt"]
+            assert regraded.last_posted_grade == 4.0
+            user_dir = tmp_path / "workspace" / str(resubmitted.user_id)
+            assert (user_dir / attachment["filename"]).read_bytes() == b"print('new')\n"
+            assert not any(user.needs_regrade for user in users[1:])
+
+            downloaded.clear()
+            assert sync_submissions(grader, users) == [] and downloaded == []
+        finally:
+            canvas.stop()
+
+
+class TestWatch:
+    def test_watch_requires_options(self, monkeypatch, capsys):
+        """
+        Make sure --watch exits with an error instead of prompting for what is missing
+        """
+        from . import pycanvasgrader as app
+
+        def no_prompts(*_):
+            raise AssertionError("--watch prompted for input")
+
+        monkeypatch.setattr("builtins.input", no_prompts)
+        prefs = {"session": {}, "quickstart": {"course_id": 1}, "watch": {}}
+        assert app.watch_main(None, prefs) == 2
+        assert "--role, --assignment, --skeleton" in capsys.readouterr().err
+
+    def test_watch_grades_without_prompts(self, tmp_path, monkeypatch):
+        """
+        Make sure a watch grades new submissions with a skeleton that would prompt for
+        scores, without prompting, and checkpoints them when it is stopped
+        """
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        from . import pycanvasgrader as app
+
+        def no_prompts(*_):
+            raise AssertionError("--watch prompted for input")
+
+        def stop_watching(_):
+            raise KeyboardInterrupt
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        monkeypatch.setenv("INSTALL_DIR", str(tmp_path))
+        monkeypatch.setattr("builtins.input", no_prompts)
+        monkeypatch.setattr(app.time, "sleep", stop_watching)
+        (tmp_path / ".temp").mkdir()
+        skeleton_file = tmp_path / "by_hand.json"
+        skeleton_file.write_text(
+            json.dumps(
+                {
+                    "descriptor": "by hand",
+                    "disarm": True,
+                    "tests": {"score": {"command": "true", "prompt_for_score": True}},
+                }
+            )
+        )
+        course = generate_course(students=4, assignments=1, seed=7)
+        assignment_id = course.assignments[0]["id"]
+        canvas = MockCanvas([course])
+        api_url = canvas.serve()
+        prefs = {
+            "session": {},
+            "quickstart": {
+                "role": "teacher",
+                "course_id": 1,
+                "assignment_id": assignment_id,
+                "skeleton": str(skeleton_file),
+            },
+            "watch": {},
+        }
+        try:
+            grader = Grader(api_url=api_url)
+            assert app.watch_main(grader, prefs) == 0
+            _, users, _ = app.load_state(1, assignment_id)
+        finally:
+            canvas.stop()
+
+        assert users and not any(user.needs_regrade for user in users)
+        for user in users:
+            assert "--Score must be entered by hand--" in user.log.getvalue()
+
+    def test_watch_saves_the_workspace_only_after_downloads(
+        self, tmp_path, monkeypatch
+    ):
+        """
+        Make sure a poll that only sees a changed grade saves that user without saving
+        the workspace, which is saved after downloads and on exit
+        """
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+        from lib.core.checkpoint import Checkpoint, read_state
+
+        from . import pycanvasgrader as app
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        monkeypatch.setenv("INSTALL_DIR", str(tmp_path))
+        (tmp_path / ".temp").mkdir()
+        skeleton_file = tmp_path / "skeleton.json"
+        skeleton_file.write_text(
+            json.dumps({"descriptor": "true", "tests": {"true": {"command": "true"}}})
+        )
+        course = generate_course(students=4, assignments=1, seed=7)
+        assignment_id = course.assignments[0]["id"]
+        regraded = next(
+            s for s in course.submissions[assignment_id].values() if s["attachments"]
+        )
+        workspace_saves = []
+        copy_workspace = Checkpoint._copy_workspace
+
+        def counted_copy_workspace(checkpoint):
+            workspace_saves.append(checkpoint)
+            copy_workspace(checkpoint)
+
+        saved_scores = []
+
+        def next_poll(_):
+            if not saved_scores:
+                # Graded by someone else before the next poll
+                regraded.update(score=4.0, graded_at="2999-01-01T00:00:00Z")
+                saved_scores.append(len(workspace_saves))
+                return
+            state = read_state(str(tmp_path / ".cache" / "1" / str(assignment_id)))
+            saved_scores.extend(
+                user["last_posted_grade"]
+                for user in state["users"]
+                if user["user_id"] == regraded["user_id"]
+            )
+            saved_scores.append(len(workspace_saves))
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(Checkpoint, "_copy_workspace", counted_copy_workspace)
+        monkeypatch.setattr(app.time, "sleep", next_poll)
+        canvas = MockCanvas([course])
+        api_url = canvas.serve()
+        prefs = {
+            "session": {"disable_autosave": True},
+            "quickstart": {
+                "role": "teacher",
+                "course_id": 1,
+                "assignment_id": assignment_id,
+                "skeleton": str(skeleton_file),
+            },
+            "watch": {},
+        }
+        try:
+            assert app.watch_main(Grader(api_url=api_url), prefs) == 0
+        finally:
+            canvas.stop()
+
+        # One save after the first poll's downloads, none after the second poll
+        assert saved_scores == [1, 4.0, 1]
+        assert len(workspace_saves) == 2
+
+
+class TestCommands:
+    def test_arguments_reach_the_command_verbatim(self, tmp_path):
+        """
+        Make sure arguments with spaces, quotes and shell syntax are passed as one
+        argument each, and are not interpreted by the shell
+        """
+        import sys
+
+        from lib.canvas_api import User
+        from lib.canvas_api.testing import AssignmentTest
+
+        args = ["two words", "it's \"quoted\"", "$HOME; echo hi", "*", ""]
+        test = AssignmentTest(
+            sys.executable,
+            ["-c", "import sys; print(sys.argv[1:])"] + args,
+            timeout=10,
+        )
+        user = User(1, 1, "User 1", None, None, True, 1)
+        result = test.run(user, str(tmp_path), interactive=False)
+        assert result["returncode"] == 0
+        assert result["stdout"] == repr(args) + "\n"
+
+    def test_headless_runs_do_not_read_stdin(self, tmp_path):
+        """
+        Make sure a test that reads stdin sees end-of-file when nobody can type, even
+        though the grader's own stdin is still open
+        """
+        import os
+        import sys
+
+        from lib.canvas_api import User
+        from lib.canvas_api.testing import AssignmentTest
+
+        test = AssignmentTest(
+            sys.executable,
+            ["-c", "import sys; print(repr(sys.stdin.read()))"],
+            timeout=2,
+        )
+        user = User(1, 1, "User 1", None, None, True, 1)
+        # A stdin that never sends anything and is never closed, like a terminal
+        saved_stdin = os.dup(0)
+        read_end, write_end = os.pipe()
+        os.dup2(read_end, 0)
+        try:
+            assert test.run(user, str(tmp_path), interactive=True)["timeout"]
+            result = test.run(user, str(tmp_path), interactive=False)
+        finally:
+            os.dup2(saved_stdin, 0)
+            for fd in (saved_stdin, read_end, write_end):
+                os.close(fd)
+        assert not result["timeout"]
+        assert result["stdout"] == "''\n"
+
+
+class TestBatch:
+    def test_batch_grades_and_posts_two_assignments(self, tmp_path, monkeypatch):
+        """
+        Make sure a batch run downloads, grades and posts every submission of two
+        assignments through the shared pools, and summarizes each one
+        """
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        from . import pycanvasgrader as app
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        monkeypatch.setenv("INSTALL_DIR", str(tmp_path))
+        skeleton_file = tmp_path / "prints.json"
+        skeleton_file.write_text(
+            json.dumps(
+                {
+                    "descriptor": "prints",
+                    "disarm": False,
+                    "tests": {
+                        "prints": {
+                            "command": "cat",
+                            "args": ["main.py"],
+                            "output_match": "print",
+                            "point_val": 10,
+                        }
+                    },
+                }
+            )
+        )
+        course = generate_course(students=40, assignments=2, seed=8)
+        canvas = MockCanvas([course])
+        api_url = canvas.serve()
+        prefs = {
+            "session": {
+                "workers": 3,
+                "download_workers": 4,
+                "post_grades": True,
+                "disable_autosave": True,
+            },
+            "quickstart": {},
+            "watch": {},
+        }
+        job_specs = [
+            (1, assignment["id"], str(skeleton_file))
+            for assignment in course.assignments
+        ]
+        try:
+            grader = Grader(api_url=api_url)
+            summary = app.run_batch(grader, prefs, job_specs)
+        finally:
+            canvas.stop()
+
+        assert [job["assignment_id"] for job in summary["jobs"]] == [
+            assignment["id"] for assignment in course.assignments
+        ]
+        for job in summary["jobs"]:
+            submissions = course.submissions[job["assignment_id"]]
+            submitted = [s for s in submissions.values() if s["attachments"]]
+            assert job["error"] is None and job["failed_downloads"] == 0
+            assert job["submissions"] == job["downloaded"] == len(submitted)
+            assert job["graded"] == len(job["users"]) == len(submitted)
+            for user in job["users"]:
+                submission = submissions[user["user_id"]]
+                main_py = course.files[submission["attachments"][0]["id"]]
+                assert user["grade"] == (10 if b"print" in main_py else 0)
+                assert user["posted"] and submission["score"] == user["grade"]
+
+
+class TestDistributed:
+    def test_localhost_workers(self, tmp_path):
+        """
+        Make sure several workers on localhost grade every user exactly once
+        """
+        import threading
+
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core.distributed import Coordinator, run_worker
+
+        temp_dir = tmp_path / "temp"
+        users = []
+        for user_id in range(1, 21):
+            (temp_dir / str(user_id)).mkdir(parents=True)
+            (temp_dir / str(user_id) / "answer.txt").write_text(
+                "right" if user_id % 2 else "wrong"
+            )
+            users.append(User(user_id, user_id, f"User {user_id}", None, None, True, 1))
+
+        skeleton = TestSkeleton.from_json(
+            {
+                "descriptor": "distributed",
+                "disarm": True,
+                "file_path": "",
+                "tests": [
+                    {
+                        "command": "cat %s",
+                        "single_file": True,
+                        "output_match": "right",
+                        "point_val": 10,
+                        "fail_comment": "wrong answer",
+                    }
+                ],
+            }
+        )
+
+        coordinator = Coordinator(("localhost", 0), b"test key")
+        coordinator.start()
+        graded = []
+        workers = [
+            threading.Thread(
+                target=lambda n=n: graded.append(
+                    run_worker(
+                        coordinator.address, b"test key", str(tmp_path / f"w{n}")
+                    )
+                )
+            )
+            for n in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            coordinator.grade(users, skeleton, str(temp_dir))
+        finally:
+            coordinator.close()
+        for worker in workers:
+            worker.join(5)
+
+        assert sum(graded) == len(users)
+        for user in users:
+            if user.user_id % 2:
+                assert user.grade == 10 and user.comment == ""
+            else:
+                assert user.grade == 0 and user.comment == "wrong answer\n"
+            assert "--Running test 1--" in user.log.getvalue()
+
+    def test_fixture_files_reach_workers(self, tmp_path, monkeypatch):
+        """
+        Make sure workers grade with the coordinator's input and expected output files,
+        which need not exist on the worker's machine
+        """
+        import threading
+
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core import distributed
+        from lib.core.distributed import Coordinator, run_worker
+
+        fixtures = tmp_path / "skeleton"
+        fixtures.mkdir()
+        (fixtures / "input.txt").write_text("line\n" * 3)
+        (fixtures / "expected.txt").write_text("3\n")
+        skeleton_file = fixtures / "fixtures.json"
+        skeleton_file.write_text(
+            json.dumps(
+                {
+                    "descriptor": "fixtures",
+                    "tests": {
+                        "count": {
+                            "command": "wc -l",
+                            "input_file": "input.txt",
+                            "expected_file": "expected.txt",
+                            "exact_match": True,
+                            "point_val": 10,
+                        }
+                    },
+                }
+            )
+        )
+        skeleton = TestSkeleton.parse_skeleton(str(skeleton_file))
+        temp_dir = tmp_path / "temp"
+        (temp_dir / "1").mkdir(parents=True)
+        (temp_dir / "1" / "main.py").write_text("")
+        user = User(1, 1, "User 1", None, None, True, 1)
+
+        read_fixtures = distributed.read_fixtures
+
+        def read_then_hide(test_skeleton):
+            files = read_fixtures(test_skeleton)
+            fixtures.rename(tmp_path / "elsewhere")
+            return files
+
+        monkeypatch.setattr(distributed, "read_fixtures", read_then_hide)
+        coordinator = Coordinator(("localhost", 0), b"test key")
+        coordinator.start()
+        work_dir = tmp_path / "worker"
+        worker = threading.Thread(
+            target=run_worker, args=(coordinator.address, b"test key", str(work_dir))
+        )
+        worker.start()
+        try:
+            coordinator.grade([user], skeleton, str(temp_dir))
+        finally:
+            coordinator.close()
+        worker.join(5)
+
+        assert user.grade == 10, user.log.getvalue()
+        assert not (work_dir / ".fixtures").exists()
+
+    def test_bad_key_and_failing_units(self, tmp_path, monkeypatch):
+        """
+        Make sure a client with the wrong key does not stop other workers from
+        connecting, and that units which fail or lose their workers are reported as
+        failed instead of being handed out forever
+        """
+        import threading
+        from multiprocessing import AuthenticationError
+        from multiprocessing.connection import Client
+
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core import distributed
+        from lib.core.distributed import Coordinator, run_worker
+
+        temp_dir = tmp_path / "temp"
+        users = []
+        for user_id in range(1, 4):
+            (temp_dir / str(user_id)).mkdir(parents=True)
+            (temp_dir / str(user_id) / "answer.txt").write_text("right")
+            users.append(User(user_id, user_id, f"User {user_id}", None, None, True, 1))
+        skeleton = TestSkeleton.from_json(
+            {
+                "descriptor": "distributed",
+                "disarm": True,
+                "file_path": "",
+                "tests": [
+                    {"command": "cat %s", "single_file": True, "point_val": 10}
+                ],
+            }
+        )
+
+        grade_unit = distributed.grade_unit
+
+        def crash_on_user_2(unit, test_skeleton, work_dir):
+            if unit["user"]["user_id"] == 2:
+                raise RuntimeError("worker crashed")
+            return grade_unit(unit, test_skeleton, work_dir)
+
+        monkeypatch.setattr(distributed, "grade_unit", crash_on_user_2)
+        coordinator = Coordinator(("localhost", 0), b"test key")
+        coordinator.start()
+        try:
+            with pytest.raises(AuthenticationError):
+                Client(coordinator.address, authkey=b"wrong key")
+
+            # Workers that take user 3's unit and disconnect without answering
+            coordinator.submit(users[2], skeleton, str(temp_dir))
+            for _ in range(distributed.MAX_ATTEMPTS):
+                conn = Client(coordinator.address, authkey=b"test key")
+                conn.send({"type": "ready"})
+                while conn.recv()["type"] != "unit":
+                    pass
+                conn.close()
+            assert coordinator.join(5)
+
+            worker = threading.Thread(
+                target=run_worker,
+                args=(coordinator.address, b"test key", str(tmp_path / "w")),
+            )
+            worker.start()
+            for user in users[:2]:
+                coordinator.submit(user, skeleton, str(temp_dir))
+            assert coordinator.join(5)
+        finally:
+            coordinator.close()
+        worker.join(5)
+
+        assert users[0].grade == 10
+        assert users[1].grade is None
+        assert "--Grading failed: worker crashed--" in users[1].log.getvalue()
+        assert users[2].grade is None
+        assert "3 workers disconnected while grading" in users[2].log.getvalue()
+
+
+class TestScheduling:
+    def test_split_user_matches_sequential(self, tmp_path):
+        """
+        Make sure a user whose tests are split across workers gets the same grade,
+        comment and log order as grading them one test at a time
+        """
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core.scheduler import grade_longest_first, longest_first
+
+        tests = [{"command": "true", "test_must_pass": True, "point_val": 1}]
+        for n in range(2, 7):
+            tests.append(
+                {
+                    "command": "echo %d" % n,
+                    "output_match": "3" if n == 3 else str(n),
+                    "point_val": n,
+                    "fail_comment": "test %d" % n,
+                    "negate_match": n == 4,
+                }
+            )
+        skeleton = TestSkeleton.from_json(
+            {
+                "descriptor": "split",
+                "disarm": True,
+                "file_path": "",
+                "split_tests": True,
+                "tests": tests,
+            }
+        )
+
+        def make_users():
+            users = []
+            for user_id in (1, 2, 3):
+                (tmp_path / str(user_id)).mkdir(exist_ok=True)
+                users.append(User(user_id, user_id, "", None, None, True, 1))
+            # User 2 took far longer than the others last time, so it is split
+            for user in users:
+                user.test_times = {str(n): 0.01 for n in range(1, 7)}
+            users[1].test_times = {str(n): 10.0 for n in range(2, 7)}
+            return users
+
+        sequential = make_users()
+        for user in sequential:
+            user.grade_self(skeleton, False, str(tmp_path))
+
+        split = make_users()
+        assert longest_first(split, skeleton)[0].user_id == 2
+        grade_longest_first(split, skeleton, 3, False, str(tmp_path))
+
+        for before, after in zip(sequential, split):
+            assert after.grade == before.grade == 1 + 2 + 3 + 5 + 6
+            assert after.comment == before.comment == "test 4\n"
+            log = after.log.getvalue()
+            assert [log.index("--Running test %d--" % n) for n in range(1, 7)] == sorted(
+                log.index("--Running test %d--" % n) for n in range(1, 7)
+            )
+            assert set(after.test_times) == {str(n) for n in range(1, 7)}
+
+    def test_unequal_chunks_merge_in_test_order(self, tmp_path):
+        """
+        Make sure pieces of a split user are merged in test order even when a later
+        chunk is heavier, and so starts running before the earlier ones
+        """
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core.scheduler import grade_longest_first
+
+        tests = [{"command": "true", "test_must_pass": True, "point_val": 1}]
+        for n in range(2, 6):
+            tests.append(
+                {
+                    "command": "echo %d" % n,
+                    "output_match": "never",
+                    "point_val": n,
+                    "fail_comment": "fail %d" % n,
+                }
+            )
+        skeleton_json = {
+            "descriptor": "split",
+            "disarm": True,
+            "file_path": "",
+            "tests": tests,
+        }
+        # Splitting is opt-in, since split tests share the submission's directory
+        assert not TestSkeleton.from_json(dict(skeleton_json)).split_tests
+        skeleton = TestSkeleton.from_json({**skeleton_json, "split_tests": True})
+
+        (tmp_path / "1").mkdir()
+        user = User(1, 1, "", None, None, True, 1)
+        user.test_times = {"1": 0.01, "2": 0.1, "3": 0.1, "4": 0.1, "5": 30.0}
+        grade_longest_first([user], skeleton, 2, False, str(tmp_path))
+
+        assert user.grade == 1
+        assert user.comment == "fail 2\nfail 3\nfail 4\nfail 5\n"
+        log = user.log.getvalue()
+        positions = [log.index("--Running test %d--" % n) for n in range(1, 6)]
+        assert positions == sorted(positions)
+
+
+class TestCalibration:
+    def test_calibrate_and_write_timeouts(self, tmp_path):
+        """
+        Make sure calibration times every test and writes its suggestions back to the skeleton
+        """
+        from lib.canvas_api import TestSkeleton
+        from lib.core import calibration
+
+        reference = tmp_path / "reference"
+        reference.mkdir()
+        (reference / "answer.txt").write_text("42")
+        skeleton_file = tmp_path / "skeleton.json"
+        skeleton_file.write_text(
+            json.dumps(
+                {
+                    "descriptor": "calibrate",
+                    "tests": {
+                        "cat": {"command": "cat", "args": ["%s"], "output_match": "42",
+                                "single_file": True, "timeout": 60},
+                        "fails": {"command": "false", "output_match": "never"},
+                    },
+                }
+            )
+        )
+        skeleton = TestSkeleton.parse_skeleton(str(skeleton_file))
+
+        timings = calibration.calibrate(skeleton, str(reference), str(tmp_path), runs=3)
+
+        cat, fails = timings
+        assert len(cat.samples) == 3 and cat.failures == 0 and cat.timeout == 60
+        assert fails.samples == [] and fails.failures == 3
+        assert calibration.suggested_timeout(cat, factor=3.0) == 1
+        assert calibration.suggested_timeout(fails) is None
+
+        calibration.write_timeouts(str(skeleton_file), {"cat": 1})
+        assert TestSkeleton.parse_skeleton(str(skeleton_file)).tests[0].timeout == 1
+
+    def test_write_timeouts_keeps_toml_comments(self, tmp_path):
+        """
+        Make sure timeouts written to a TOML skeleton only change the timeout lines,
+        and that a skeleton that cannot be edited in place is left alone
+        """
+        from lib.core import calibration
+
+        skeleton_file = tmp_path / "skeleton.toml"
+        skeleton_file.write_text(
+            "# Lab 3\n"
+            'descriptor = "lab 3"\n'
+            "\n"
+            "[tests.compile]  # Always first\n"
+            'command = "make"\n'
+            "timeout = 60  # Seconds\n"
+            "\n"
+            '[tests."run it"]\n'
+            'command = "./a.out"\n'
+            "\n"
+            "[tests.unchanged]\n"
+            'command = "true"\n'
+        )
+        calibration.write_timeouts(str(skeleton_file), {"compile": 5, "run it": 2})
+        assert skeleton_file.read_text() == (
+            "# Lab 3\n"
+            'descriptor = "lab 3"\n'
+            "\n"
+            "[tests.compile]  # Always first\n"
+            'command = "make"\n'
+            "timeout = 5  # Seconds\n"
+            "\n"
+            '[tests."run it"]\n'
+            'command = "./a.out"\n'
+            "timeout = 2\n"
+            "\n"
+            "[tests.unchanged]\n"
+            'command = "true"\n'
+        )
+
+        inline = '# Inline tables\ntests = { quick = { command = "true" } }\n'
+        skeleton_file.write_text(inline)
+        with pytest.raises(ValueError):
+            calibration.write_timeouts(str(skeleton_file), {"quick": 1})
+        assert skeleton_file.read_text() == inline
+
+
+class TestInstrument:
+    def test_profiler(self):
+        """
+        Make sure spans are only recorded while a profiler listens, and are exported correctly
+        """
+        from lib.core import instrument
+
+        with instrument.span("api", "ignored"):
+            pass
+
+        profiler = instrument.Profiler().start()
+        try:
+            with instrument.span("api", "GET /courses") as details:
+                details["status"] = 200
+            with instrument.span("execute", "compile", user_id=1):
+                pass
+        finally:
+            profiler.stop()
+        with instrument.span("api", "ignored"):
+            pass
+
+        events = profiler.chrome_trace()["traceEvents"]
+        assert [(e["cat"], e["name"]) for e in events] == [
+            ("api", "GET /courses"),
+            ("execute", "compile"),
+        ]
+        assert events[0]["ph"] == "X" and events[0]["args"] == {"status": 200}
+        summary = profiler.summary(top=1)
+        assert "Slowest api:" in summary and "compile" in summary
+
+    def test_event_log_and_metrics(self, tmp_path):
+        """
+        Make sure events reach the JSON-lines log and the Prometheus endpoint
+        """
+        from lib.core import instrument, monitoring
+
+        log_path = tmp_path / "events.jsonl"
+        event_log = monitoring.EventLog(str(log_path)).start()
+        metrics = monitoring.Metrics().start()
+        try:
+            address = metrics.serve(("127.0.0.1", 0))
+            instrument.event("test_finished", user_id=1, test="compile", seconds=0.2, passed=True)
+            instrument.event("user_graded", user_id=1, grade=10, queued=4)
+            with instrument.span("api", "PUT /api/v1/courses/1") as details:
+                details["status"] = 500
+            body = requests.get("http://%s:%d/metrics" % tuple(address)).text
+        finally:
+            metrics.stop()
+            event_log.stop()
+
+        events = [json.loads(line) for line in log_path.read_text().splitlines()]
+        assert [e["event"] for e in events] == ["test_finished", "user_graded"]
+        assert events[0]["test"] == "compile" and events[1]["queued"] == 4
+        assert 'pycanvasgrader_tests_total{test="compile",passed="true"} 1' in body
+        assert 'pycanvasgrader_test_duration_seconds_bucket{test="compile",le="0.25"} 1' in body
+        assert "pycanvasgrader_grading_queue_depth 4" in body
+        assert 'pycanvasgrader_api_errors_total{method="PUT"} 1' in body
+
+
+class TestMockCanvas:
+    def test_grader_against_mock_canvas(self, tmp_path, monkeypatch):
+        """
+        Make sure PyCanvasGrader can list, download and grade a synthetic course offline
+        """
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        monkeypatch.setenv("INSTALL_DIR", str(tmp_path))
+        course = generate_course(students=150, assignments=2, seed=1)
+        canvas = MockCanvas([course])
+        api_url = canvas.serve()
+        try:
+            grader = Grader(api_url=api_url)
+            assert [c["id"] for c in grader.courses()] == [1]
+            grader.course_id = 1
+            assert len(grader.assignments(ungraded=False)) == 2
+            grader.assignment_id = course.assignments[0]["id"]
+
+            submissions = grader.submissions()
+            assert len(submissions) == 150  # More than one page
+            submission = next(s for s in submissions if s["attachments"])
+            assert grader.download_submission(submission)
+            user_dir = tmp_path / ".temp" / str(submission["user_id"])
+            for attachment in submission["attachments"]:
+                data = (user_dir / attachment["filename"]).read_bytes()
+                assert data == course.files[attachment["id"]]
+
+            assert grader.grade_submissions([(submission["user_id"], 7, "")])
+            assert grader.submission(submission["user_id"])["score"] == 7
+        finally:
+            canvas.stop()
+
+
+class TestSkeletonCache:
+    def test_cache_reparses_only_changed_files(self, tmp_path, monkeypatch):
+        """
+        Make sure unchanged skeletons come from the cache and edited ones are reparsed
+        """
+        from lib.canvas_api import TestSkeleton
+        from lib.canvas_api.skeleton_cache import SkeletonCache
+
+        skeletons = tmp_path / "skeletons"
+        skeletons.mkdir()
+        first = skeletons / "first.json"
+        first.write_text(
+            json.dumps(
+                {
+                    "descriptor": "First",
+                    "default": {"command": "echo", "timeout": 5},
+                    "tests": {"hello": {"args": ["hello"], "output_match": "hello"}},
+                }
+            )
+        )
+        (skeletons / "broken.json").write_text("{")
+        (skeletons / "notes.txt").write_text("not a skeleton")
+        cache_path = str(tmp_path / "cache")
+
+        listed = SkeletonCache(cache_path).descriptors(str(skeletons))
+        assert listed == [(str(first), "First")]
+
+        parsed = []
+        read_plan = TestSkeleton.read_plan
+        monkeypatch.setattr(
+            TestSkeleton,
+            "read_plan",
+            classmethod(lambda cls, *args: parsed.append(args[0]) or read_plan(*args)),
+        )
+        cache = SkeletonCache(cache_path)
+        assert cache.descriptors(str(skeletons)) == listed
+        skeleton = cache.skeleton(str(first))
+        assert parsed == []
+        assert skeleton.tests[0].timeout == 5 and skeleton.tests[0].name == "hello"
+
+        first.write_text(first.read_text().replace("First", "Second"))
+        assert SkeletonCache(cache_path).descriptors(str(skeletons)) == [
+            (str(first), "Second")
+        ]
+        assert parsed == [str(first)]
+
+    def test_missing_fixture_is_not_cached(self, tmp_path, capsys):
+        """
+        Make sure a skeleton whose fixture file is missing becomes available once the
+        file is added, even though the skeleton itself has not changed
+        """
+        from lib.canvas_api.skeleton_cache import SkeletonCache
+
+        skeletons = tmp_path / "skeletons"
+        skeletons.mkdir()
+        skeleton_file = skeletons / "fixtures.json"
+        skeleton_file.write_text(
+            json.dumps(
+                {
+                    "descriptor": "Fixtures",
+                    "tests": {"count": {"command": "wc -l", "input_file": "in.txt"}},
+                }
+            )
+        )
+        cache_path = str(tmp_path / "cache")
+
+        assert SkeletonCache(cache_path).descriptors(str(skeletons)) == []
+        assert 'The input_file "' in capsys.readouterr().out
+
+        (skeletons / "in.txt").write_text("line\n")
+        cache = SkeletonCache(cache_path)
+        assert cache.descriptors(str(skeletons)) == [(str(skeleton_file), "Fixtures")]
+        skeleton = cache.skeleton(str(skeleton_file))
+        assert skeleton.tests[0].input_file == str(skeletons / "in.txt")
+
+        (skeletons / "in.txt").unlink()
+        assert SkeletonCache(cache_path).skeleton(str(skeleton_file)) is None
+
+
+class TestNumericMatch:
+    def test_numeric_match(self):
+        """
+        Make sure each expected number needs its own output number, in order if asked to
+        """
+        from lib.canvas_api import User
+        from lib.canvas_api.testing import AssignmentTest
+
+        user = User(1, 1, "Numbers", None, None, True, 1)
+
+        def matches(numeric_match, stdout, **kwargs):
+            test = AssignmentTest("true", numeric_match=numeric_match, **kwargs)
+            return test._match(user, {"stdout": stdout})
+
+        # The narrower [1.5, 2.5] must take 2, leaving 1 for [0, 10]
+        assert matches([[0, 10], "2, 0.5"], "2 then 1")
+        assert matches([3, 3], "3 and 3")
+        assert not matches([3, 3], "3 only once")
+        assert not matches([[0, 10], "2, 0.5"], "only 2")
+        assert matches([1, 2, 3], "3 2 1")
+        assert not matches([1, 2, 3], "3 2 1", numeric_ordered=True)
+        assert matches([1, 2, 3], "1 x 5 2 3", numeric_ordered=True)
+        assert not matches([4], "4", negate_match=True)
+
+        test = AssignmentTest("true", numeric_match=["1 +- 0.5"])
+        assert "_intervals" not in test.to_json()
+        assert AssignmentTest.from_json_dict(test.to_json()) == test
+        with pytest.raises(ValueError):
+            AssignmentTest("true", numeric_match=["not a number"])
+
+
+class TestFixtureFiles:
+    def test_input_and_expected_files(self, tmp_path):
+        """
+        Make sure stdin streams from input_file and output is compared with expected_file
+        """
+        from lib.canvas_api import TestSkeleton, User
+
+        (tmp_path / "input.txt").write_text("line\n" * 50000)
+        (tmp_path / "expected.txt").write_text("50000\n")
+        (tmp_path / "partial.txt").write_text("000")
+        skeleton_file = tmp_path / "fixtures.json"
+        skeleton_file.write_text(
+            json.dumps(
+                {
+                    "descriptor": "fixtures",
+                    "default": {"command": "wc -l", "input_file": "input.txt"},
+                    "tests": {
+                        "exact": {"expected_file": "expected.txt", "exact_match": True},
+                        "contains": {"expected_file": "partial.txt"},
+                        "not exact": {"expected_file": "partial.txt", "exact_match": True},
+                    },
+                }
+            )
+        )
+        skeleton = TestSkeleton.parse_skeleton(str(skeleton_file))
+        assert skeleton.tests[0].input_file == str(tmp_path / "input.txt")
+        assert "_expected_digest" not in skeleton.tests[0].to_json()
+
+        user = User(1, 1, "Fixtures", None, None, True, 1)
+        (tmp_path / "1").mkdir()
+        results = [
+            test.run_and_match(user, str(tmp_path / "1"), False) for test in skeleton.tests
+        ]
+        assert results == [True, True, False]
+
+        (tmp_path / "input.txt").unlink()
+        assert TestSkeleton.parse_skeleton(str(skeleton_file)) is None
+
+
+class TestLogStore:
+    def test_log_spills_to_disk_and_compresses(self, tmp_path):
+        """
+        Make sure logs spill to disk, old segments are gzipped, and the cache keeps no copy
+        """
+        from lib.canvas_api import User
+        from lib.canvas_api.log_store import UserLog
+
+        log = UserLog(str(tmp_path / "1.log"), memory_limit=100, segment_bytes=1000)
+        assert log.empty
+        lines = [f"line {i}\n" for i in range(500)]
+        for line in lines:
+            log.write(line)
+        assert len(list(tmp_path.glob("1.log.*.gz"))) >= 2
+        assert log.getvalue() == "".join(lines)
+        assert not log.empty
+
+        log_dir = tmp_path / "logs"
+        user = User(2, 2, "Logged", None, None, True, 1)
+        print("in memory", file=user.log)
+        user.store_log(str(log_dir))
+        print("stored", file=user.log)
+        assert user.to_json()["log"] is None
+        restored = User.from_json(user.to_json(), str(log_dir))
+        assert restored.log.getvalue() == "in memory\nstored\n"
+
+        # Caches written before the log store kept the log inline
+        old = {**user.to_json(), "log": "inline\n"}
+        assert User.from_json(old, str(log_dir)).log.getvalue() == "inline\n"
+
+        restored.log.clear()
+        assert restored.log.empty and list(log_dir.iterdir()) == []
+
+
+class TestPager:
+    def test_pager_reads_log_in_windows(self, tmp_path, monkeypatch, capsys):
+        """
+        Make sure the pager finds test sections and search hits across log segments
+        """
+        from lib.canvas_api import utils
+        from lib.canvas_api.log_store import UserLog
+        from lib.core import pager
+
+        log = UserLog(str(tmp_path / "1.log"), memory_limit=50, segment_bytes=500)
+        for test in range(1, 4):
+            print(f"\n--Running test {test}--", file=log)
+            for line in range(100):
+                print(f"test {test} output {line}", file=log)
+        print("--Current score: 3--", file=log, end="")
+
+        lines = list(log.lines())
+        assert "".join(lines) == log.getvalue() and len(lines) == 307
+        assert pager.index_sections(log.lines()) == (307, {1: 1, 2: 103, 3: 205})
+        assert pager.find(log.lines(), "TEST 3 OUTPUT 7") == 213
+        assert pager.find(log.lines(), "test 1 output", 50) == 50
+        assert pager.find(log.lines(), "missing") is None
+        assert pager.window(log.lines(), 305, 10) == ["test 3 output 99\n", lines[-1]]
+
+        monkeypatch.setattr(utils, "clear_screen", lambda: None)
+        commands = iter(["t2", "/output 42", "/", "q"])
+        monkeypatch.setattr("builtins.input", lambda: next(commands))
+        pager.view(log.lines, height=5)
+        pages = capsys.readouterr().out.split(pager.HELP)
+        assert "--Running test 2--" in pages[1]
+        assert pages[2].lstrip().startswith("test 2 output 42")
+        assert pages[3].lstrip().startswith("test 3 output 42")
+
+
+class TestRoster:
+    def test_roster_pages_and_filters(self):
+        """
+        Make sure the roster finds users by name or email prefix and by grade status
+        """
+        from lib.canvas_api import User
+        from lib.core.roster import Roster
+
+        users = [
+            User(i, i, f"Student {i}", f"s{i}@example.edu", None, True, 1)
+            for i in range(1, 46)
+        ]
+        users.append(User(46, 46, "Ada Lovelace", "ada@example.edu", 10, True, 1))
+        roster = Roster(users, page_size=20)
+        assert roster.pages == 3 and roster.shown == users[:20]
+        assert roster.command("n") and roster.shown == users[20:40]
+        assert roster.header() == "Showing 21-40 of 46 users | page 2/3"
+
+        assert roster.command("/LOVE")
+        assert roster.shown == [users[-1]] and roster.page == 0
+        assert roster.command("/student 4")
+        assert [user.user_id for user in roster.shown] == [4, 40, 41, 42, 43, 44, 45]
+        assert roster.command("/s1@")
+        assert roster.shown == [users[0]]
+
+        assert roster.command("c") and roster.command("s posted")
+        assert roster.shown == [users[-1]]
+        users[0].grade = 5
+        users.append(User(47, 47, "Late Student", None, None, False, 2))
+        roster.refresh()
+        assert roster.command("s unposted") and len(roster.shown) == 1
+        assert roster.command("s regrade") and roster.shown == [users[-1]]
+        assert not roster.command("3")
+
+
+class TestBackgroundGrader:
+    def test_queue_prioritize_and_cancel(self, tmp_path):
+        """
+        Make sure users are graded on a worker thread, can jump the queue or be
+        cancelled, and only finished users get a grade
+        """
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core.scheduler import BackgroundGrader
+
+        tests = [
+            {"command": "sleep 0.2", "point_val": 1},
+            {"command": "echo done", "output_match": "done", "point_val": 2},
+        ]
+        skeleton = TestSkeleton.from_json(
+            {"descriptor": "background", "disarm": True, "file_path": "", "tests": tests},
+        )
+        users = []
+        for user_id in range(1, 5):
+            (tmp_path / str(user_id)).mkdir()
+            users.append(User(user_id, user_id, "", None, None, True, 1))
+
+        graded = []
+        background = BackgroundGrader(skeleton, 1, str(tmp_path), graded.append)
+        assert background.submit(users) == 4
+        assert background.submit(users[:2]) == 0
+        assert background.prioritize(users[3])
+        assert background.cancel(users[2])
+        assert background.wait(timeout=30)
+
+        assert background.state(users[2]) == BackgroundGrader.CANCELLED
+        assert users[2].grade is None
+        # The first user was already running when the last one was moved up
+        assert [user.user_id for user in graded][1] == 4
+        assert {user.user_id for user in graded} == {1, 2, 4}
+        assert all(user.grade == 3 for user in graded)
+        assert len(background.take_finished()) == 4
+        assert background.take_finished() == [] and background.idle
+
+
+class TestCheckpoint:
+    def test_delta_saves_and_snapshots(self, tmp_path, monkeypatch):
+        """
+        Make sure only changed users are written to the delta, a stale delta is ignored,
+        and an interrupted write leaves the old state readable
+        """
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core import storage
+        from lib.core.checkpoint import DELTA_FILE, Checkpoint, read_state
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        grader = Grader(workspace=str(tmp_path / "workspace"))
+        skeleton = TestSkeleton.from_json(
+            {"descriptor": "checkpoint", "disarm": True, "file_path": "", "tests": []}
+        )
+        users = [User(i, i, str(i), None, None, True, 1) for i in range(10)]
+        for user in users:
+            user.store_log(grader.log_dir)
+        state_dir = tmp_path / "state"
+        checkpoint = Checkpoint(str(state_dir), grader, skeleton, users, max_changes=3)
+
+        checkpoint.snapshot(workspace=True)
+        assert not (state_dir / DELTA_FILE).exists()
+        assert checkpoint.save() and not (state_dir / DELTA_FILE).exists()
+
+        users[3].grade = 7
+        print("graded", file=users[3].log)
+        assert checkpoint.save()
+        delta = json.loads(storage.decompress((state_dir / DELTA_FILE).read_bytes()))
+        assert list(delta["users"]) == ["3"]
+        saved_log = (state_dir / ".logs" / "3.log").read_bytes()
+        assert storage.decompress(saved_log) == b"graded\n"
+        state = read_state(str(state_dir))
+        assert [user["grade"] for user in state["users"]][3] == 7
+
+        # A delta from an older snapshot must not be applied over a newer one
+        stale = (state_dir / DELTA_FILE).read_bytes()
+        users[3].grade = 9
+        checkpoint.snapshot()
+        (state_dir / DELTA_FILE).write_bytes(stale)
+        assert [user["grade"] for user in read_state(str(state_dir))["users"]][3] == 9
+
+        # Changing most of the users writes a new snapshot instead of a delta
+        for user in users:
+            user.grade = 1
+        assert checkpoint.save()
+        assert not (state_dir / DELTA_FILE).exists()
+        assert {user["grade"] for user in read_state(str(state_dir))["users"]} == {1}
+
+        # A crash mid-write leaves only a temporary file behind
+        (state_dir / ".cachefile.tmp").write_text("{truncated")
+        assert len(read_state(str(state_dir))["users"]) == 10
+
+        checkpoint.start()
+        users[0].grade = 5
+        checkpoint.changed(3)
+        checkpoint.stop()
+        assert read_state(str(state_dir))["users"][0]["grade"] == 5
+
+    def test_files_are_synced_before_they_are_renamed(self, tmp_path, monkeypatch):
+        """
+        Make sure the workspace, the cachefile and every saved log, including compressed
+        log segments, are synced to disk before they replace the previous copies
+        """
+        import os
+
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api import TestSkeleton, User
+        from lib.canvas_api.log_store import UserLog
+        from lib.core.checkpoint import Checkpoint
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        grader = Grader(workspace=str(tmp_path / "workspace"))
+        (tmp_path / "workspace" / "1").mkdir(parents=True)
+        (tmp_path / "workspace" / "1" / "main.py").write_text("print('hi')\n")
+        skeleton = TestSkeleton.from_json(
+            {"descriptor": "checkpoint", "disarm": True, "file_path": "", "tests": []}
+        )
+        user = User(1, 1, "1", None, None, True, 1)
+        os.makedirs(grader.log_dir)
+        user.log = UserLog(
+            os.path.join(grader.log_dir, "1.log"), memory_limit=100, segment_bytes=1000
+        )
+        for i in range(500):
+            print("line", i, file=user.log)
+
+        synced = set()
+        renamed = []
+        fsync, replace = os.fsync, os.replace
+
+        def recording_fsync(fd):
+            synced.add(os.fstat(fd).st_ino)
+            fsync(fd)
+
+        def checked_replace(source, destination):
+            renamed.append((os.path.basename(destination), os.stat(source).st_ino))
+            replace(source, destination)
+
+        monkeypatch.setattr(os, "fsync", recording_fsync)
+        monkeypatch.setattr(os, "replace", checked_replace)
+        state_dir = tmp_path / "state"
+        Checkpoint(str(state_dir), grader, skeleton, [user]).snapshot(workspace=True)
+
+        names = {name for name, _ in renamed}
+        assert {"workspace.tar", ".cachefile", "1.log"} <= names
+        assert any(name.endswith(".gz") for name in names)
+        assert [name for name, inode in renamed if inode not in synced] == []
+
+
+class TestStorage:
+    def test_compressed_workspace_and_budget(self, tmp_path, monkeypatch):
+        """
+        Make sure saved workspaces and logs are compressed and restored, old plain
+        caches still load, and the least recently used caches are evicted first
+        """
+        import os
+
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api import TestSkeleton, User
+        from lib.core import storage
+        from lib.core.checkpoint import Checkpoint, read_state, restore_workspace
+
+        for codec in storage.CODECS:
+            text = b"x" + b"output line\n" * 1000
+            assert storage.decompress(storage.compress(text, codec)) == text
+        assert len(storage.compress(text, "lzma")) < len(text) // 10
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        grader = Grader(workspace=str(tmp_path / "workspace"))
+        (tmp_path / "workspace" / "1").mkdir(parents=True)
+        (tmp_path / "workspace" / "1" / "main.py").write_text("print(1)\n" * 1000)
+        user = User(1, 1, "One", None, None, True, 1)
+        user.store_log(grader.log_dir)
+        print("test output", file=user.log)
+        skeleton = TestSkeleton.from_json(
+            {"descriptor": "storage", "disarm": True, "file_path": "", "tests": []}
+        )
+
+        cache = tmp_path / "cache"
+        saved = cache / "1" / "10"
+        for codec in ("lzma", "zlib"):
+            Checkpoint(str(saved), grader, skeleton, [user], compression=codec).snapshot(
+                workspace=True
+            )
+            restored = tmp_path / ("restored-" + codec)
+            restore_workspace(str(saved), str(restored))
+            assert (restored / "1" / "main.py").read_text() == "print(1)\n" * 1000
+            assert (restored / ".logs" / "1.log").read_text() == "test output\n"
+        assert os.path.getsize(saved / "workspace.tar") < 1000
+
+        # A cache saved uncompressed by an older version
+        legacy = cache / "1" / "11"
+        (legacy / ".temp" / "2").mkdir(parents=True)
+        (legacy / ".temp" / "2" / "main.py").write_text("print(2)")
+        (legacy / ".cachefile").write_text(json.dumps({"skeleton": {}, "users": []}))
+        assert read_state(str(legacy))["users"] == []
+        restore_workspace(str(legacy), str(tmp_path / "restored-legacy"))
+        assert (tmp_path / "restored-legacy" / "2" / "main.py").exists()
+
+        (cache / "2" / "20").mkdir(parents=True)
+        (cache / "2" / "20" / "big").write_bytes(b"0" * 100000)
+        (cache / "http").mkdir()
+        for age, directory in enumerate([saved, legacy, cache / "2" / "20"]):
+            storage.touch(str(directory))
+            os.utime(str(directory / ".last_used"), (1000 + age, 1000 + age))
+        report = storage.usage_report(str(cache), 50000)
+        assert "Budget" in report and report.index("  2 ") < report.index("  1 ")
+
+        # The oldest cache is kept because it is in use, so the next two go
+        evicted = storage.enforce_budget(str(cache), 1, keep=str(saved))
+        assert [(course, assignment) for course, assignment, _ in evicted] == [
+            ("1", "11"),
+            ("2", "20"),
+        ]
+        assert saved.exists() and (cache / "http").exists()
+        assert storage.enforce_budget(str(cache), 0) == []
+
+    def test_budget_ignores_metadata_caches(self, tmp_path):
+        """
+        Make sure large HTTP and skeleton caches neither count against the budget nor
+        cause assignment caches to be evicted
+        """
+        from lib.core import storage
+
+        cache = tmp_path / "cache"
+        for course, assignment in (("1", "10"), ("1", "11")):
+            (cache / course / assignment).mkdir(parents=True)
+            (cache / course / assignment / "workspace.tar").write_bytes(b"0" * 1000)
+            storage.touch(str(cache / course / assignment))
+        for metadata in ("http", "skeletons"):
+            (cache / metadata).mkdir()
+            (cache / metadata / "entry.json").write_bytes(b"0" * 100000)
+
+        assert storage.enforce_budget(str(cache), 2100) == []
+        evicted = storage.enforce_budget(str(cache), 1500)
+        assert evicted == [("1", "10", 1000)]
+        assert (cache / "http" / "entry.json").exists()
+
+    def test_extract_refuses_unsafe_members(self, tmp_path):
+        """
+        Make sure restoring a saved workspace never writes outside its destination and
+        skips links
+        """
+        import io
+        import os
+        import tarfile
+
+        from lib.canvas_api.archives import ArchiveError
+        from lib.core import storage
+
+        def saved_workspace(name, *members):
+            path = tmp_path / name
+            with tarfile.open(str(path), "w:gz") as tar:
+                for member, data in members:
+                    member.size = len(data)
+                    tar.addfile(member, io.BytesIO(data))
+            return str(path)
+
+        link = tarfile.TarInfo("1/passwd")
+        link.type = tarfile.SYMTYPE
+        link.linkname = "/etc/passwd"
+        safe = saved_workspace(
+            "safe.tar", (tarfile.TarInfo("1/main.py"), b"print(1)\n"), (link, b"")
+        )
+        storage.extract(safe, str(tmp_path / "restored"))
+        assert (tmp_path / "restored" / "1" / "main.py").read_bytes() == b"print(1)\n"
+        assert not os.path.lexists(str(tmp_path / "restored" / "1" / "passwd"))
+
+        for name in ("../escaped", "/tmp/escaped"):
+            unsafe = saved_workspace("unsafe.tar", (tarfile.TarInfo(name), b"x"))
+            with pytest.raises(ArchiveError):
+                storage.extract(unsafe, str(tmp_path / "unsafe"))
+        assert not (tmp_path / "escaped").exists()
+
+
+class TestArchives:
+    def test_unpack_download(self, tmp_path, monkeypatch):
+        """
+        Make sure archives are unpacked safely, unwrapped, and reused when unchanged
+        """
+        import io
+        import tarfile
+        import zipfile
+
+        from lib.canvas_api import archives, utils
+
+        user_dir = tmp_path / "1"
+        new_dir = user_dir / ".new"
+
+        def download(name: str, data: bytes):
+            new_dir.mkdir(parents=True)
+            (new_dir / name).write_bytes(data)
+            problems = archives.unpack_download(str(user_dir))
+            utils.promote_download(str(user_dir))
+            return problems
+
+        packed = io.BytesIO()
+        with zipfile.ZipFile(packed, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("hw1/main.py", "print('hi')\n")
+            zip_file.writestr("hw1/lib/util.py", "x = 1\n")
+            zip_file.writestr("__MACOSX/hw1/._main.py", "junk")
+        assert download("hw1.zip", packed.getvalue()) == []
+        assert sorted(p.name for p in user_dir.iterdir()) == ["lib", "main.py"]
+        assert (user_dir / "lib" / "util.py").read_text() == "x = 1\n"
+        store = tmp_path / ".archives" / "1"
+        assert (store / "hw1.zip").exists()
+        manifest = json.loads((store / "manifest.json").read_text())
+        assert manifest["hw1.zip"]["entries"] == ["lib", "main.py"]
+
+        # The same archive again reuses what it unpacked to last time
+        def no_extract(*_):
+            raise AssertionError("extracted again")
+
+        monkeypatch.setattr(archives, "extract", no_extract)
+        assert download("hw1.zip", packed.getvalue()) == []
+        assert (user_dir / "main.py").exists() and (user_dir / "lib").is_dir()
+        monkeypatch.undo()
+
+        evil = io.BytesIO()
+        with zipfile.ZipFile(evil, "w") as zip_file:
+            zip_file.writestr("ok.txt", "fine")
+            zip_file.writestr("../../escaped.txt", "gotcha")
+        problems = download("evil.zip", evil.getvalue())
+        assert len(problems) == 1 and "Unsafe path" in problems[0]
+        assert sorted(p.name for p in user_dir.iterdir()) == ["evil.zip"]
+        assert not (tmp_path / "escaped.txt").exists()
+        assert not (store / "hw1.zip").exists()
+
+        # Streamed tar: links are skipped, and the unpacked size is capped
+        packed = io.BytesIO()
+        with tarfile.open(fileobj=packed, mode="w:gz") as tar_file:
+            data = b"0" * (3 * 1024 * 1024)
+            member = tarfile.TarInfo("big.bin")
+            member.size = len(data)
+            tar_file.addfile(member, io.BytesIO(data))
+            link = tarfile.TarInfo("passwd")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "/etc/passwd"
+            tar_file.addfile(link)
+        (tmp_path / "big.tar.gz").write_bytes(packed.getvalue())
+        archives.extract(str(tmp_path / "big.tar.gz"), str(tmp_path / "out"))
+        assert [p.name for p in (tmp_path / "out").iterdir()] == ["big.bin"]
+        with pytest.raises(archives.ArchiveError):
+            archives.extract(
+                str(tmp_path / "big.tar.gz"), str(tmp_path / "bomb"), max_bytes=1024**2
+            )
+
+
+class TestResumableDownload:
+    def test_interrupted_download_resumes(self, tmp_path, monkeypatch):
+        """
+        Make sure a dropped transfer is resumed with a Range request, throughput is
+        recorded, and an attachment that never matches its size fails
+        """
+        import os
+
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+        from lib.core import instrument
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        monkeypatch.setattr("lib.canvas_api.canvas_api.time.sleep", lambda _: None)
+        course = generate_course(students=3, assignments=1, seed=2)
+        canvas = MockCanvas([course], interrupt_after=4096)
+        api_url = canvas.serve()
+        downloads = []
+        instrument.add_event_listener(downloads.append)
+        try:
+            grader = Grader(api_url=api_url, workspace=str(tmp_path / "workspace"))
+            grader.course_id = 1
+            grader.assignment_id = course.assignments[0]["id"]
+            submission = next(s for s in grader.submissions() if s["attachments"])
+            attachment = submission["attachments"][0]
+            submission["attachments"] = [attachment]
+            data = os.urandom(10000)
+            course.files[attachment["id"]] = data
+            attachment["size"] = len(data)
+
+            assert grader.download_submission(submission)
+            user_dir = tmp_path / "workspace" / str(submission["user_id"])
+            assert (user_dir / attachment["filename"]).read_bytes() == data
+            assert [path.name for path in user_dir.iterdir()] == [attachment["filename"]]
+            downloaded = [e for e in downloads if e.name == "attachment_downloaded"]
+            assert downloaded[0].fields["retries"] == 2
+            assert downloaded[0].fields["resumed_from"] == 4096
+            assert downloaded[0].fields["bytes"] == len(data)
+
+            attachment["size"] = len(data) * 2
+            assert not grader.download_submission(submission)
+        finally:
+            instrument.remove_event_listener(downloads.append)
+            canvas.stop()
+
+    def test_unexpected_range_starts_over(self, tmp_path, monkeypatch):
+        """
+        Make sure a partial response for a range other than the one asked for is not
+        written, and the download starts over from the beginning instead
+        """
+        import os
+
+        from lib.canvas_api import PyCanvasGrader as Grader
+        from lib.canvas_api.mock_canvas import MockCanvas, generate_course
+
+        monkeypatch.setenv("CANVAS_ACCESS_TOKEN", "offline")
+        monkeypatch.setattr("lib.canvas_api.canvas_api.time.sleep", lambda _: None)
+        course = generate_course(students=3, assignments=1, seed=2)
+        canvas = MockCanvas([course], interrupt_after=4096)
+        api_url = canvas.serve()
+        ranges = []
+        try:
+            grader = Grader(api_url=api_url, workspace=str(tmp_path / "workspace"))
+            grader.course_id = 1
+            grader.assignment_id = course.assignments[0]["id"]
+            submission = next(s for s in grader.submissions() if s["attachments"])
+            attachment = submission["attachments"][0]
+            submission["attachments"] = [attachment]
+            data = os.urandom(10000)
+            course.files[attachment["id"]] = data
+            attachment["size"] = len(data)
+
+            get = grader.session.get
+
+            def misplaced_range(url, headers=None, **kwargs):
+                headers = dict(headers or {})
+                if "Range" in headers and not any(ranges):
+                    # A server that answers with a different range than was asked for
+                    start = int(headers["Range"][len("bytes=") : -1])
+                    headers["Range"] = f"bytes={start + 10}-"
+                ranges.append(headers.get("Range"))
+                return get(url, headers=headers, **kwargs)
+
+            monkeypatch.setattr(grader.session, "get", misplaced_range)
+            assert grader.download_submission(submission)
+            user_dir = tmp_path / "workspace" / str(submission["user_id"])
+            assert (user_dir / attachment["filename"]).read_bytes() == data
+        finally:
+            canvas.stop()
+
+        # Every transfer stops after 4096 bytes, so the restart resumes twice
+        assert ranges == [None, "bytes=4106-", None, "bytes=4096-", "bytes=8192-"]